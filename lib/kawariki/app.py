@@ -1,31 +1,177 @@
 
 from abc import abstractmethod
-from collections.abc import Sequence
+from collections.abc import Callable, Iterator, Sequence
+from contextlib import AbstractContextManager, contextmanager
 from functools import cached_property
+from os import environ
 from pathlib import Path
 from platform import machine, system
 from sys import stderr
+from typing import TYPE_CHECKING, TypeVar
 
-from .game import Game
-from .ui import create_gui
 from .ui.common import AKawarikiUi, DummyProgressUi, MsgType
+from .worker import current_job
+
+if TYPE_CHECKING:
+    from .distribution import Distribution, DistributionIndex
+    from .game import Game
+    from .gc import GcResult
+    from .objects import ObjectStore
+    from .plan import LaunchPlan
+
+T = TypeVar("T")
 
 
 class App:
     app_root: Path
     overlayns_binary: Path|None
     platform: str
+    plan: 'LaunchPlan|None'     # Record launches into this plan instead of executing them
+    used_dists: set[Path]       # Distributions used by the current launch
+    used_entries: set[Path]     # Cache entries used by the current launch, see use_file()
 
     def __init__(self, app_root):
         self.app_root = Path(app_root).resolve()
         self.platform = f"{system()}-{machine()}".lower()
         self.overlayns_binary = self.app_root / "overlayns-static" \
             if self.platform == "linux-x86_64" else None
+        self.plan = None
+        self.used_dists = set()
+        self.used_entries = set()
+        self._used_fds: list[int] = []
 
     @property
     def dist_path(self) -> Path:
         return self.app_root / "dist"
 
+    @property
+    def downloads_path(self) -> Path:
+        """ Partial downloads of distribution archives """
+        return self.dist_path / ".downloads"
+
+    @property
+    def objects_path(self) -> Path:
+        """ Content-addressed store for distribution files. Set KAWARIKI_SHARED_OBJECTS=1 to share it """
+        if environ.get("KAWARIKI_SHARED_OBJECTS", "").lower() not in ("", "0", "false", "no", "n"):
+            return self.cache_path / "objects"
+        return self.dist_path / ".objects"
+
+    @cached_property
+    def objects(self) -> 'ObjectStore':
+        from .objects import ObjectStore
+        return ObjectStore(self.objects_path)
+
+    @property
+    def locks_path(self) -> Path:
+        """ Lock files for installing distributions, see dist_lock() """
+        return self.dist_path / ".locks"
+
+    @property
+    def cache_path(self) -> Path:
+        if xdg_cache := environ.get("XDG_CACHE_HOME"):
+            return Path(xdg_cache) / "kawariki"
+        return Path.home() / ".cache" / "kawariki"
+
+    @property
+    def versions_cache_path(self) -> Path:
+        """ Compiled versions.json files, see CompiledVersions """
+        return self.cache_path / "versions"
+
+    def use_dist(self, dist: 'Distribution'):
+        """
+        Record that the current launch uses an installed distribution
+
+        Updates its last-used time for garbage collection and protects it from
+        being collected by other Kawariki processes while the game is running.
+        """
+        if dist.path in self.used_dists or not dist.available:
+            return
+        self.used_dists.add(dist.path)
+        self.use_file(dist.manifest_path)
+
+    def use_file(self, path: Path):
+        """
+        Touch a file marking a cache entry as used and hold a shared lock on it until the game exits
+
+        The entry is the directory containing the file, it isn't collected by this process either.
+        """
+        from fcntl import LOCK_SH, flock
+        from os import O_RDONLY, set_inheritable, utime
+        from os import open as os_open
+
+        utime(path)
+        # The shared lock is held until the game exits, the file descriptor survives exec()
+        fd = os_open(path, O_RDONLY)
+        flock(fd, LOCK_SH)
+        set_inheritable(fd, True)
+        self._used_fds.append(fd)
+        self.used_entries.add(path.parent)
+
+    @property
+    def gc_budget(self) -> int|None:
+        """ Collect garbage after the game exits if KAWARIKI_GC_BUDGET is set, see gc.py """
+        from .misc import parse_size
+        budget = environ.get("KAWARIKI_GC_BUDGET")
+        return parse_size(budget) if budget else None
+
+    def collect_garbage(self, budget: int|None=None, dry: bool=False) -> 'GcResult':
+        """
+        Evict least recently used distributions and unpacked packages
+        until they fit into budget (defaults to gc_budget)
+        """
+        from .gc import collect_garbage
+        from .misc import size_str
+        from .nwjs.unpack_cache import UnpackCache
+
+        budget = budget if budget is not None else self.gc_budget
+        if budget is None:
+            raise ValueError("No garbage collection budget given")
+        packages = UnpackCache(self, budget).entries()
+        result = collect_garbage(self, budget, extra=packages, protect=self.used_dists | self.used_entries, dry=dry)
+        print(f"dist/ and unpacked packages used {size_str(result.usage)},"
+              f" {'would free' if dry else 'freed'} {size_str(result.freed)} (budget {size_str(budget)})")
+        for entry in result.skipped:
+            print(f"Not removing {entry.kind} '{entry.path.name}', it is in use")
+        return result
+
+    def dist_lock(self, dist: 'Distribution') -> AbstractContextManager[None]:
+        """
+        Hold the lock for installing or modifying a distribution
+
+        Other Kawariki processes may be installing the same distribution at the same time.
+        Shows progress while waiting for them. Check dist.available again once the lock is held.
+        """
+        return self.hold_lock(self.locks_path / f"{dist.path.parent.name}-{dist.slug}.lock",
+                              f"download of '{dist.name}'")
+
+    @contextmanager
+    def hold_lock(self, path: Path, description: str) -> Iterator[None]:
+        """
+        Hold a lock file shared with other Kawariki processes, see lock.py
+
+        :param description: What the other process is doing, shown while waiting for it
+        """
+        from .lock import FileLock
+
+        lock = FileLock(path)
+        if not lock.try_acquire():
+            text = f"Waiting for other {description} to finish"
+            with self.show_progress(f"{text}...") as p:
+                lock.acquire(lambda waited: p.update(text=f"{text}... ({waited:.0f}s)"))
+        try:
+            yield
+        finally:
+            lock.release()
+
+    def run_in_background(self, func: Callable[..., T], /, *args, **kwds) -> T:
+        """
+        Run a long job on a worker thread, keeping its progress dialogs responsive
+
+        Its progress updates raise worker.Cancelled if the user cancels it, see worker.py
+        """
+        from .worker import run_in_background
+        return run_in_background(self, func, *args, **kwds)
+
     # +-------------------------------------------------+
     # Error reporting
     # +-------------------------------------------------+
@@ -41,6 +187,7 @@ class App:
 
     @cached_property
     def gui(self) -> AKawarikiUi:
+        from .ui import create_gui
         return create_gui()
 
     def free_gui(self):
@@ -51,7 +198,10 @@ class App:
 
     def show_msg(self, type, title, message):
         self.stderr_show_msg(type, title, message)
-        if self.gui:
+        if (job := current_job()) is not None:
+            # The UI belongs to the main thread
+            job.show_msg(type, title, message)
+        elif self.gui:
             self.gui.show_msg(type, title, message)
 
     def show_error(self, message, title="Kawariki Runtime Error"):
@@ -64,7 +214,9 @@ class App:
         self.show_msg(MsgType.Info, title, message)
 
     def show_progress(self, text, progress=0, maximum=100, title="Kawariki Runtime"):
-        if self.gui and hasattr(self.gui, "show_progress"):
+        if (job := current_job()) is not None:
+            return job.show_progress(title, text, progress, maximum)
+        elif self.gui and hasattr(self.gui, "show_progress"):
             return self.gui.show_progress(title, text, progress, maximum)
         elif stderr.isatty():
             from .ui.tty import TtyProgress
@@ -75,12 +227,16 @@ class App:
 
 class IRuntime:
     @abstractmethod
-    def run(self, game: Game, arguments: Sequence[str], *,
+    def run(self, game: 'Game', arguments: Sequence[str], *,
             nwjs_name=None, dry=False, sdk=None,
             no_overlayns=False, no_unpack=False,
             renpy_launcher=False) -> int:
         pass
 
     @abstractmethod
-    def get_patcher(self, game: Game):
+    def get_patcher(self, game: 'Game'):
         pass
+
+    def distributions(self) -> dict[str, 'DistributionIndex']:
+        """ Distributions the runtime can download, by name of their dist/ subdirectory """
+        return {}
@@ -0,0 +1,290 @@
+# :---------------------------------------------------------------------------:
+#   Micro-benchmarks
+# :---------------------------------------------------------------------------:
+# Developer tool, not used by Kawariki itself. Run from the repository root:
+#   PYTHONPATH=lib python3 -m kawariki.bench [-n ITERATIONS]
+#   PYTHONPATH=lib python3 -m kawariki.bench --extract URL [URL...] [--cancel SECONDS]
+#   PYTHONPATH=lib python3 -m kawariki.bench --detect [--files N]
+# The default run first checks that compiled templates render like Formatter.vformat.
+# Use a local HTTP server serving (synthetic) archives for --extract.
+# --detect generates a game tree with N (default 50k) files in a temporary directory.
+
+import json
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
+from pathlib import Path
+from string import Formatter
+from time import perf_counter
+
+from .distribution import Distribution
+from .utils.interpolated_chain_map import compile_condition, compile_format
+
+__all__ = ["bench_cancel", "bench_detect", "bench_extract", "bench_versions", "check_formats", "make_game_tree"]
+
+# Share of the files in each directory of a generated game tree, roughly an RPG Maker MV game
+GAME_TREE_LAYOUT: list[tuple[str, float]] = [
+    ("www/js/plugins", 0.005),
+    ("www/data", 0.005),
+    ("www/img/pictures", 0.3),
+    ("www/img/characters", 0.15),
+    ("www/img/faces", 0.05),
+    ("www/img/tilesets", 0.05),
+    ("www/audio/bgm", 0.1),
+    ("www/audio/se", 0.3),
+    ("www/movies", 0.01),
+    ("locales", 0.03),
+]
+
+# Templates exercising escaped braces, nested specs and conversions
+FORMAT_EDGE_CASES: tuple[str, ...] = (
+    "", "plain", "{{", "}}", "{{}}", "a{{b}}c", "{{{a}}}", "{a}{{", "}}{a}", "{a:>{b}}", "{a!r}", "{a!s:^{b}}",
+)
+
+
+class _AnyKey(dict):
+    """ Mapping that has a value for every key """
+    def __missing__(self, key: str) -> str:
+        return key.upper()
+
+
+def bench_versions(cls: type[Distribution], filename: Path, platform: str, iterations: int) -> tuple[float, float, int]:
+    """
+    Time loading and fully resolving all distributions in a versions.json file
+
+    :return: Time of the first run with empty template caches (ms), mean time of
+             the following runs (ms) and the number of distributions
+    """
+    dist_path = Path("/nonexistent") / filename.parent.name
+
+    def run() -> int:
+        dists = cls.load_json(filename, dist_path, platform)
+        for dist in dists:
+            dist.resolve()
+        return len(dists)
+
+    compile_format.cache_clear()
+    compile_condition.cache_clear()
+    start = perf_counter()
+    count = run()
+    cold = perf_counter() - start
+
+    start = perf_counter()
+    for _ in range(iterations):
+        run()
+    warm = (perf_counter() - start) / iterations
+    return cold * 1000, warm * 1000, count
+
+
+def check_formats(templates: list[str]) -> int:
+    """
+    Check that compiled templates render exactly like Formatter.vformat
+
+    :param templates: Format strings to check
+    :return: The number of mismatches, each is printed
+    """
+    formatter = Formatter()
+    mapping = _AnyKey(b="8")
+    mismatches = 0
+    for template in templates:
+        results = []
+        for render in (lambda: compile_format(template).render(formatter, mapping),
+                       lambda: formatter.vformat(template, (), mapping)):
+            try:
+                results.append(render())
+            except Exception as e:
+                results.append(type(e))
+        if results[0] != results[1]:
+            print(f"Mismatch for {template!r}: compiled {results[0]!r}, vformat {results[1]!r}")
+            mismatches += 1
+    return mismatches
+
+
+def _json_strings(value) -> list[str]:
+    """ Collect all strings in a JSON document, including keys """
+    if isinstance(value, str):
+        return [value]
+    if isinstance(value, dict):
+        return [s for k, v in value.items() for s in (k, *_json_strings(v))]
+    if isinstance(value, list):
+        return [s for v in value for s in _json_strings(v)]
+    return []
+
+
+def bench_extract(url: str) -> tuple[float, float]:
+    """
+    Time downloading and extracting a tar archive
+
+    :return: Seconds taken by a single-threaded stream extraction and by the pipeline
+    """
+    from shutil import rmtree
+    from tarfile import open as taropen
+    from tempfile import mkdtemp
+    from urllib.request import urlopen
+
+    from .extract import TarPipeline
+    from .fetch import RangedDownload
+
+    tmp = Path(mkdtemp(prefix="kawariki-bench-"))
+    try:
+        start = perf_counter()
+        with urlopen(url) as f, taropen(mode="r|*", fileobj=f) as tar:
+            while info := tar.next():
+                tar.extract(info, tmp / "sequential")
+        sequential = perf_counter() - start
+
+        start = perf_counter()
+        download = RangedDownload(url, tmp / "archive")
+        with ThreadPoolExecutor(1) as executor:
+            downloading = executor.submit(download.run)
+            TarPipeline(download.iter_contiguous(), tmp / "pipelined").run()
+            downloading.result()
+        pipelined = perf_counter() - start
+    finally:
+        rmtree(tmp)
+    return sequential, pipelined
+
+
+def bench_cancel(url: str, after: float) -> float:
+    """
+    Time stopping a pipelined download and extraction cancelled part way through
+
+    The progress callback raises after the given number of seconds, like worker.Cancelled does.
+    :return: Seconds between cancelling and the pipeline returning
+    """
+    from shutil import rmtree
+    from tempfile import mkdtemp
+
+    from .extract import ExtractionCancelled, TarPipeline
+    from .fetch import RangedDownload
+
+    tmp = Path(mkdtemp(prefix="kawariki-bench-"))
+    start = perf_counter()
+    cancelled = start
+
+    def progress(pipeline: TarPipeline):
+        nonlocal cancelled
+        if perf_counter() - start >= after:
+            cancelled = perf_counter()
+            raise ExtractionCancelled()
+
+    try:
+        download = RangedDownload(url, tmp / "archive")
+        with ThreadPoolExecutor(1) as executor:
+            downloading = executor.submit(download.run)
+            try:
+                TarPipeline(download.iter_contiguous(), tmp / "pipelined").run(progress)
+            except ExtractionCancelled:
+                stopped = perf_counter() - cancelled
+            else:
+                raise RuntimeError(f"Extraction finished within {after} s, nothing was cancelled")
+            finally:
+                download.cancel()
+            with suppress(Exception):
+                downloading.result()
+    finally:
+        rmtree(tmp)
+    return stopped
+
+
+def make_game_tree(root: Path, files: int):
+    """ Create a tree of empty files shaped like a game with lots of assets """
+    root.mkdir(parents=True, exist_ok=True)
+    (root / "package.json").write_text('{"main": "www/index.html"}')
+    (root / "www").mkdir()
+    (root / "www" / "index.html").touch()
+    for directory, share in GAME_TREE_LAYOUT:
+        count = int(files * share)
+        # Games split assets into subdirectories of a few hundred files
+        for i in range(count):
+            path = root / directory / f"part{i // 500}"
+            if i % 500 == 0:
+                path.mkdir(parents=True)
+            (path / f"file{i}.dat").touch()
+
+
+def bench_detect(root: Path, pattern: str, iterations: int) -> tuple[float, float, int]:
+    """
+    Time a recursive search during detection, unbounded and bounded by FsProbe.SEARCH_MAX_DEPTH/SEARCH_PRUNE
+
+    Each run uses a fresh probe, so the bounded search doesn't benefit from a populated index.
+    :return: Mean time of Path.rglob (ms), mean time of FsProbe.rglob (ms) and the number of matches of the latter
+    """
+    from .detect_cache import FsProbe
+
+    start = perf_counter()
+    for _ in range(iterations):
+        list(root.rglob(pattern))
+    unbounded = (perf_counter() - start) / iterations
+
+    start = perf_counter()
+    for _ in range(iterations):
+        found = list(FsProbe().rglob(root, pattern))
+    bounded = (perf_counter() - start) / iterations
+    return unbounded * 1000, bounded * 1000, len(found)
+
+
+def main(argv: list[str]|None=None) -> int:
+    from .nwjs.runtime import NWjs
+
+    parser = ArgumentParser(prog="python -m kawariki.bench",
+                            description="Benchmark versions.json template resolution")
+    parser.add_argument("-n", "--iterations", type=int, default=200)
+    parser.add_argument("--platform", default="linux-x86_64")
+    parser.add_argument("--root", type=Path, default=Path(__file__).resolve().parents[2],
+                        help="Kawariki installation root [%(default)s]")
+    parser.add_argument("--extract", nargs="+", metavar="URL",
+                        help="Benchmark downloading and extracting tar archives instead")
+    parser.add_argument("--cancel", type=float, metavar="SECONDS",
+                        help="With --extract, also time stopping an extraction cancelled after SECONDS")
+    parser.add_argument("--detect", action="store_true",
+                        help="Benchmark recursive searches during detection on a generated game tree instead")
+    parser.add_argument("--files", type=int, default=50_000,
+                        help="Number of files in the generated game tree [%(default)s]")
+    args = parser.parse_args(argv)
+
+    if args.detect:
+        from shutil import rmtree
+        from tempfile import mkdtemp
+
+        tmp = Path(mkdtemp(prefix="kawariki-bench-"))
+        try:
+            make_game_tree(tmp / "game", args.files)
+            iterations = max(1, args.iterations // 20)
+            # A file found near the root and one that isn't there (the RGSS check for NW.js games)
+            for pattern in ("package.json", "RGSS*.dll"):
+                unbounded, bounded, found = bench_detect(tmp / "game", pattern, iterations)
+                print(f"{pattern}: Path.rglob {unbounded:.2f} ms, FsProbe.rglob {bounded:.2f} ms "
+                      f"({found} found, {args.files} files, {iterations} iterations)")
+        finally:
+            rmtree(tmp)
+        return 0
+
+    if args.extract:
+        for url in args.extract:
+            sequential, pipelined = bench_extract(url)
+            print(f"{url}: sequential {sequential:.2f} s, pipelined {pipelined:.2f} s")
+            if args.cancel is not None:
+                print(f"{url}: stopped {bench_cancel(url, args.cancel):.2f} s after cancelling")
+        return 0
+
+    cases: list[tuple[type[Distribution], Path]] = [
+        (NWjs, args.root / "nwjs" / "versions.json"),
+        (Distribution, args.root / "godot" / "versions.json"),
+    ]
+    templates = list(FORMAT_EDGE_CASES)
+    for _, filename in cases:
+        templates += _json_strings(json.loads(filename.read_text()))
+    if check_formats(templates):
+        return 1
+    print(f"{len(templates)} templates render like Formatter.vformat")
+
+    for cls, filename in cases:
+        cold, warm, count = bench_versions(cls, filename, args.platform, args.iterations)
+        print(f"{filename.relative_to(args.root)}: {count} distributions, "
+              f"first {cold:.2f} ms, then {warm:.2f} ms per load ({args.iterations} iterations)")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
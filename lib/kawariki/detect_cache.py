@@ -0,0 +1,243 @@
+# :---------------------------------------------------------------------------:
+#   Persistent engine detection cache
+# :---------------------------------------------------------------------------:
+
+from collections.abc import Iterator
+from contextlib import contextmanager
+from json import dump as json_dump
+from json import load as json_load
+from os import replace
+from pathlib import Path
+from stat import S_ISDIR
+from threading import Event, local
+from typing import Any
+
+from . import trace
+from .game_tree import GameTree
+
+__all__ = ["DetectionCache", "FsProbe", "ProbeCancelled", "RecordingProbe", "game_key"]
+
+
+Stamp = tuple[int, int, int]|None
+
+
+def stamp(path: Path, *, listing: bool=False) -> Stamp:
+    """
+    Identify the current state of a path: (mtime, inode, size) or None if missing
+
+    :param listing: Include mtime for directories, i.e. whether entries were added or removed
+    """
+    try:
+        st = path.stat()
+    except OSError:
+        return None
+    if not listing and S_ISDIR(st.st_mode):
+        return 0, st.st_ino, 0
+    return st.st_mtime_ns, st.st_ino, st.st_size
+
+
+def game_key(root: Path, binary_name_hint: str|None) -> str:
+    """ Stable key identifying a game for cache file names """
+    from hashlib import sha1
+    return sha1(f"{root}\0{binary_name_hint or ''}".encode("utf-8", "surrogateescape")).hexdigest()
+
+
+class ProbeCancelled(Exception):
+    """ Raised inside a detection probe that is no longer needed """
+
+
+class FsProbe:
+    """
+    Filesystem queries made during engine detection
+
+    Detection code goes through a probe instead of touching the filesystem
+    directly, so that the things it looked at can be recorded (see RecordingProbe).
+    Queries are answered from a GameTree index shared by all detectors.
+    """
+    tree: GameTree
+
+    # Limits for recursive searches during detection.
+    # Asset directories can contain tens of thousands of files but never anything interesting
+    SEARCH_MAX_DEPTH: int|None = 4
+    SEARCH_PRUNE: tuple[str, ...] = ("www/audio", "img", "movies", "node_modules", "locales")
+
+    def __init__(self, tree: GameTree|None=None):
+        self.tree = tree if tree is not None else GameTree()
+        self._thread = local()
+
+    # Cancellation
+    @contextmanager
+    def cancellable(self, event: Event) -> Iterator[None]:
+        """ Make queries from the current thread raise ProbeCancelled once event is set """
+        self._thread.cancel = event
+        try:
+            yield
+        finally:
+            self._thread.cancel = None
+
+    def check_cancelled(self):
+        if (event := getattr(self._thread, "cancel", None)) is not None and event.is_set():
+            raise ProbeCancelled()
+
+    # Queries
+    def find(self, path: Path, *, casefold: bool=False) -> Path|None:
+        """ Return the path as it exists on disk, optionally ignoring case """
+        self.check_cancelled()
+        return self.tree.resolve(path, casefold=casefold)
+
+    def exists(self, path: Path) -> bool:
+        self.check_cancelled()
+        return self.tree.exists(path)
+
+    def is_file(self, path: Path) -> bool:
+        self.check_cancelled()
+        return self.tree.is_file(path)
+
+    def read(self, path: Path) -> None:
+        """ Note that the content of a file is used by detection """
+        pass
+
+    def _visit_dir(self, path: Path) -> None:
+        pass
+
+    def rglob(self, root: Path, pattern: str, *, casefold: bool=False) -> Iterator[Path]:
+        """
+        Recursively find files matching pattern
+
+        Breadth-first and bounded by SEARCH_MAX_DEPTH and SEARCH_PRUNE.
+        Stop iterating once the wanted file was found to avoid scanning further
+        """
+        for listing in self.tree.walk(root, max_depth=self.SEARCH_MAX_DEPTH, prune=self.SEARCH_PRUNE):
+            self.check_cancelled()
+            self._visit_dir(listing.path)
+            yield from listing.glob(pattern, casefold=casefold)
+
+
+class RecordingProbe(FsProbe):
+    """
+    Probe that records the state of every path detection looked at
+
+    Files and directories that were looked up are recorded in stamps,
+    directories that were listed in listings.
+    """
+    stamps: dict[str, Stamp]
+    listings: dict[str, Stamp]
+
+    def __init__(self, tree: GameTree|None=None):
+        super().__init__(tree)
+        self.stamps = {}
+        self.listings = {}
+
+    def _record(self, path: Path):
+        key = str(path)
+        if key not in self.stamps:
+            self.stamps[key] = stamp(path)
+
+    def find(self, path: Path, *, casefold: bool=False) -> Path|None:
+        actual = super().find(path, casefold=casefold)
+        if casefold:
+            # Any file matching case-insensitively could appear, watch the directories instead
+            self._record_case_insensitive(path)
+        self._record(actual if actual is not None else path)
+        return actual
+
+    def _record_case_insensitive(self, path: Path):
+        root = self.tree.root
+        if root is not None and path.is_relative_to(root):
+            parent = root
+            for name in path.relative_to(root).parts:
+                self._visit_dir(parent)
+                parent = self.tree.resolve(parent / name, casefold=True) or parent / name
+        else:
+            self._visit_dir(path.parent)
+
+    def exists(self, path: Path) -> bool:
+        self._record(path)
+        return super().exists(path)
+
+    def is_file(self, path: Path) -> bool:
+        self._record(path)
+        return super().is_file(path)
+
+    def read(self, path: Path) -> None:
+        self._record(path)
+
+    def _visit_dir(self, path: Path) -> None:
+        key = str(path)
+        if key not in self.listings:
+            self.listings[key] = stamp(path, listing=True)
+
+    def is_valid(self) -> bool:
+        """ Check that nothing changed since the stamps were recorded """
+        return (all(stamp(Path(path)) == st for path, st in self.stamps.items())
+                and all(stamp(Path(path), listing=True) == st for path, st in self.listings.items()))
+
+    def refresh(self) -> 'RecordingProbe':
+        """ Return a copy with all stamps updated to the current state """
+        probe = RecordingProbe()
+        probe.stamps = {path: stamp(Path(path)) for path in self.stamps}
+        probe.listings = {path: stamp(Path(path), listing=True) for path in self.listings}
+        return probe
+
+
+class DetectionCache:
+    """
+    On-disk record of detection results for a single game
+
+    Entries are keyed by game root and binary name hint and are only
+    considered valid as long as none of the files and directories looked
+    at during detection have changed.
+    """
+    FORMAT = 3
+
+    path: Path
+    root: Path
+    binary_name_hint: str|None
+    probe: RecordingProbe
+    values: dict[str, Any]
+
+    def __init__(self, cache_dir: Path, root: Path, binary_name_hint: str|None):
+        self.root = root
+        self.binary_name_hint = binary_name_hint
+        self.path = cache_dir / f"{game_key(root, binary_name_hint)}.json"
+        self.probe = RecordingProbe(GameTree(root))
+        with trace.span("load detection cache"):
+            self.values = self._load()
+
+    def _load(self) -> dict[str, Any]:
+        try:
+            with self.path.open("r", encoding="utf-8") as f:
+                data = json_load(f)
+        except (OSError, ValueError):
+            return {}
+        if (not isinstance(data, dict) or data.get("format") != self.FORMAT
+                or data.get("root") != str(self.root) or data.get("hint") != self.binary_name_hint):
+            return {}
+        probe = RecordingProbe(self.probe.tree)
+        probe.stamps = {path: tuple(st) if st is not None else None for path, st in data["stamps"].items()}
+        probe.listings = {path: tuple(st) if st is not None else None for path, st in data["listings"].items()}
+        if not probe.is_valid():
+            print("Game files changed since last launch, re-detecting")
+            return {}
+        # Keep the old stamps so the updated record stays complete
+        self.probe = probe
+        return data["values"]
+
+    def save(self, values: dict[str, Any]):
+        """ Write detection results. Failures are not fatal """
+        data = {
+            "format": self.FORMAT,
+            "root": str(self.root),
+            "hint": self.binary_name_hint,
+            "stamps": self.probe.stamps,
+            "listings": self.probe.listings,
+            "values": values,
+        }
+        tmp = self.path.with_suffix(".tmp")
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with tmp.open("w", encoding="utf-8") as f:
+                json_dump(data, f)
+            replace(tmp, self.path)
+        except OSError as e:
+            print(f"Warning: Could not write detection cache {self.path}: {e}")
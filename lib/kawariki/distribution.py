@@ -1,6 +1,9 @@
-from collections.abc import Callable, Iterable, Sequence
+from bisect import bisect_left, bisect_right
+from collections.abc import Callable, Iterable, Iterator, Mapping, Sequence
+from json import dump as json_dump
 from json import load as json_load
-from pathlib import Path
+from os import fsync, replace, walk
+from pathlib import Path, PurePath
 from string import Formatter
 from typing import Any, ClassVar, Generic, Literal, TypedDict, TypeVar, cast, overload
 from warnings import warn
@@ -11,6 +14,18 @@ from .utils.interpolated_chain_map import PatternInterpolatedChainMap
 
 T = TypeVar("T")
 
+# Written into a distribution directory once it is completely installed
+MANIFEST_NAME = ".kawariki-manifest.json"
+MANIFEST_FORMAT = 1
+# Written instead of the manifest when an installation needs to be downloaded again
+REINSTALL_NAME = ".kawariki-reinstall"
+
+
+def mark_for_reinstall(path: Path):
+    """ Make an installed distribution count as incomplete, so it is downloaded again on next use """
+    (path / REINSTALL_NAME).touch()
+    (path / MANIFEST_NAME).unlink(missing_ok=True)
+
 
 class DistributionInfo(TypedDict, total=False):
     """ Common items in distribution info JSON objects """
@@ -22,7 +37,11 @@ class DistributionInfo(TypedDict, total=False):
     binary: str                     # Binary name
     alias: Sequence[str]            # Aliases for humans
     strip_leading: str|bool         # Strip leading component from archive filename
+    include: Sequence[str]          # Only extract archive members matching these globs
+    exclude: Sequence[str]          # Don't extract archive members matching these globs
     template: str                   # Template the distribution is extended from
+    sha256: str                     # Hex SHA-256 of the downloaded archive
+    size: int                       # Size of the downloaded archive
 
 
 class DistributionList(TypedDict, total=False): # Generic[DI], unsupported w/ TypedDict until 3.11
@@ -191,11 +210,19 @@ class Distribution(Generic[DI]):
     dist_platform = DistributionInfoProperty[str]("platform")
     strip_leading = DistributionInfoProperty[str|bool]("strip_leading")
     aliases = DistributionInfoProperty[list[str]]("alias")
+    include = DistributionInfoPropertyOptional[list[str]]("include")
+    exclude = DistributionInfoPropertyOptional[list[str]]("exclude")
+    sha256 = DistributionInfoPropertyOptional[str]("sha256")
+    size = DistributionInfoPropertyOptional[int]("size", int)
+
+    @property
+    def manifest_path(self) -> Path:
+        return self.path / MANIFEST_NAME
 
     @property
     def available(self) -> bool:
-        """ Whether distribution is avaliable locally """
-        return self.path.exists()
+        """ Whether distribution is completely installed locally """
+        return self.manifest_path.exists() or self.adopt_legacy()
 
     @property
     def binary(self) -> Path:
@@ -210,6 +237,93 @@ class Distribution(Generic[DI]):
     def __repr__(self):
         return f"<{self.__class__.__name__} {version_str(self.version)} '{self.slug}' at 0x{id(self):x}>"
 
+    # Installation manifest
+    def write_manifest(self, root: Path|None=None, objects: Mapping[str, str]|None=None):
+        """
+        Record the files of a completely installed distribution
+
+        :param root: Directory containing the installed files, defaults to self.path.
+                     Usually a staging directory that is moved into place afterwards.
+        :param objects: Object store keys of files linked into the store, by relative path
+        """
+        root = self.path if root is None else root
+        files: dict[str, int] = {}
+        for parent, dirs, filenames in walk(root):
+            dirs.sort()
+            rel = Path(parent).relative_to(root)
+            for name in sorted(filenames):
+                path = Path(parent, name)
+                if not path.is_symlink():
+                    files[str(rel / name)] = path.stat().st_size
+        files.pop(MANIFEST_NAME, None)
+        manifest = {
+            "format": MANIFEST_FORMAT,
+            "slug": self.slug,
+            "version": list(self.version),
+            "url": self.url,
+            "sha256": self.sha256,
+            "files": files,
+            "objects": dict(objects) if objects else {},
+        }
+        temp = root / f"{MANIFEST_NAME}.tmp"
+        with open(temp, "w", encoding="utf-8") as f:
+            json_dump(manifest, f, indent=1)
+            f.flush()
+            fsync(f.fileno())
+        replace(temp, root / MANIFEST_NAME)
+
+    def adopt_legacy(self) -> bool:
+        """
+        Write the manifest for an installation made by a Kawariki version that didn't write one
+
+        Those removed the directory when an installation failed, so it is complete if it exists.
+        :return: Whether the installation was adopted
+        """
+        if not self.path.is_dir() or (self.path / REINSTALL_NAME).exists():
+            return False
+        if "binary" in self.info and not self.binary.exists():
+            return False
+        try:
+            self.write_manifest()
+        except OSError as e:
+            # Still complete, just can't be recorded
+            print(f"Could not write manifest for '{self.path}': {e}")
+        return True
+
+    def read_manifest(self) -> dict[str, Any]|None:
+        """ Load the installation manifest, None if the distribution isn't (completely) installed """
+        try:
+            with open(self.manifest_path, "r", encoding="utf-8") as f:
+                manifest = json_load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        return manifest if manifest.get("format") == MANIFEST_FORMAT else None
+
+    # Resolved form
+    def resolve(self) -> dict[str, Any]:
+        """ Compute all info keys, dropping ones that can't be resolved (e.g. missing required keys) """
+        resolved: dict[str, Any] = {}
+        for key in self.info:
+            if key in ("REQUIRED", "dist_path"):
+                continue
+            try:
+                value = self.info[key]
+            except (LookupError, ValueError):
+                continue
+            resolved[key] = str(value) if isinstance(value, PurePath) else value
+        return resolved
+
+    @classmethod
+    def from_resolved(cls, info: dict[str, Any], dist_path: Path) -> Self:
+        """ Re-create a distribution from resolve() output """
+        self = cls.__new__(cls)
+        self.info = self.raw = cast(DI, info)
+        self.templates = ()
+        self.computed = {}
+        self.platform_map = None
+        self.path = dist_path / info["slug"]
+        return self
+
     # Loading from JSON
     @classmethod
     def _build_template_order(cls, data: DI, templates: dict[str,DI]) -> tuple[DI, ...]:
@@ -263,8 +377,17 @@ class Distribution(Generic[DI]):
                 for ver in cls.load_variants(cast(DI, i), dist_path, platform, platform_map, templates)]
 
     @classmethod
-    def load_json(cls, filename: Path, dist_path: Path, platform: str|None = None) -> list[Self]:
-        """ Load distributions from versions.json file """
+    def load_json(cls, filename: Path, dist_path: Path, platform: str|None = None, *,
+                  cache: Path|None = None) -> list[Self]:
+        """
+        Load distributions from versions.json file
+
+        :param cache: Directory to keep compiled versions.json files in.
+                      Resolving all templates and patterns is skipped as long as
+                      versions.json and the Kawariki version are unchanged.
+        """
+        if cache is not None:
+            return CompiledVersions(cache, cls, filename, dist_path, platform).load()
         with open(filename, "r", encoding="utf8") as f:
             data = json_load(f)
             if isinstance(data, dict):
@@ -273,6 +396,15 @@ class Distribution(Generic[DI]):
                 return cls.load_data(data, dist_path, platform)  # type: ignore
             raise ValueError(f"Old versions.json format: {filename}")
 
+    @classmethod
+    def load_index(cls, filename: Path, dist_path: Path, platform: str|None = None, *,
+                   cache: Path|None = None) -> 'DistributionIndex[Self]':
+        """ Load distributions from versions.json file into an index. See load_json """
+        if cache is not None:
+            records, dists = CompiledVersions(cache, cls, filename, dist_path, platform).load_records()
+            return DistributionIndex(cls, dist_path, records, dists)
+        return DistributionIndex.from_distributions(cls, dist_path, cls.load_json(filename, dist_path, platform))
+
 
 def get_first(key: str, templates: Sequence[dict[str, T]], default: T|None=None) -> T|None:
     for t in templates:
@@ -281,3 +413,208 @@ def get_first(key: str, templates: Sequence[dict[str, T]], default: T|None=None)
         except KeyError:
             pass
     return default
+
+
+class CompiledVersions:
+    """
+    On-disk cache of fully resolved distributions from a versions.json file
+
+    Stored using marshal, so loading it is a single read without any
+    template or pattern processing.
+    """
+    FORMAT = 1
+
+    path: Path
+
+    def __init__(self, cache_dir: Path, cls: type[Distribution], filename: Path, dist_path: Path, platform: str|None):
+        from hashlib import sha1
+        self.cls = cls
+        self.filename = filename.resolve()
+        self.dist_path = dist_path
+        self.platform = platform
+        key = sha1(f"{self.filename}\0{dist_path}".encode("utf-8", "surrogateescape")).hexdigest()[:16]
+        self.path = cache_dir / f"{dist_path.name}-{cls.__name__}-{platform}-{key}.marshal"
+
+    def _header(self) -> dict[str, Any]:
+        from .main import __version__
+        st = self.filename.stat()
+        return {
+            "format": self.FORMAT,
+            "version": __version__,
+            "class": f"{self.cls.__module__}.{self.cls.__qualname__}",
+            "source": str(self.filename),
+            "source_stamp": (st.st_mtime_ns, st.st_size),
+            "dist_path": str(self.dist_path),
+            "platform": self.platform,
+        }
+
+    def load_records(self) -> tuple[list[dict[str, Any]], list|None]:
+        """
+        Load resolved distribution info, compiling versions.json if necessary
+
+        :return: The resolved records and, if they had to be compiled, the distributions they came from
+        """
+        from marshal import dump as marshal_dump
+        from marshal import load as marshal_load
+        header = self._header()
+        try:
+            with self.path.open("rb") as f:
+                data = marshal_load(f)
+        except (OSError, EOFError, ValueError, TypeError):
+            pass
+        else:
+            if isinstance(data, dict) and data.get("header") == header:
+                return data["dists"], None
+
+        dists = self.cls.load_json(self.filename, self.dist_path, self.platform)
+        records = [dist.resolve() for dist in dists]
+        tmp = self.path.with_suffix(".tmp")
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with tmp.open("wb") as f:
+                marshal_dump({"header": header, "dists": records}, f)
+            replace(tmp, self.path)
+        except (OSError, ValueError) as e:
+            print(f"Warning: Could not write compiled versions file {self.path}: {e}")
+        return records, dists
+
+    def load(self) -> list:
+        records, dists = self.load_records()
+        if dists is not None:
+            return dists
+        return [self.cls.from_resolved(info, self.dist_path) for info in records]
+
+
+D = TypeVar("D", bound=Distribution)
+
+class DistributionIndex(Sequence[D]):
+    """
+    Distributions from a versions.json file, indexed for selection
+
+    Lookups by alias or slug are a dict access, version range queries use
+    bisection over a version-sorted array. Only the resolved info records are
+    looked at during selection, Distribution objects are created on access.
+    """
+    cls: type[D]
+    dist_path: Path
+    records: Sequence[Mapping[str, Any]]
+
+    def __init__(self, cls: type[D], dist_path: Path, records: Sequence[Mapping[str, Any]],
+                 dists: Sequence[D]|None=None):
+        self.cls = cls
+        self.dist_path = dist_path
+        self.records = records
+        self._dists: list[D|None] = list(dists) if dists is not None else [None] * len(records)
+        self._available: dict[int, bool] = {}
+
+        self._names: dict[str, int] = {}
+        for i, info in enumerate(records):
+            for name in (info["slug"], *info.get("alias", ())):
+                self._names.setdefault(name, i)
+
+        self._order = sorted(range(len(records)), key=lambda i: tuple(records[i]["version"]))
+        self._versions = [tuple(records[i]["version"]) for i in self._order]
+
+    @classmethod
+    def from_distributions(cls, dist_cls: type[D], dist_path: Path, dists: Sequence[D]) -> 'DistributionIndex[D]':
+        return cls(dist_cls, dist_path, [dist.info for dist in dists], dists)
+
+    # +-------------------------------------------------+
+    # Sequence
+    # +-------------------------------------------------+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    @overload
+    def __getitem__(self, i: int) -> D: ...
+    @overload
+    def __getitem__(self, i: slice) -> Sequence[D]: ...
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(len(self))[i]]
+        if (dist := self._dists[i]) is None:
+            dist = self._dists[i] = self.cls.from_resolved(self.records[i], self.dist_path)  # type: ignore[arg-type]
+        return dist
+
+    def __iter__(self) -> Iterator[D]:
+        return (self[i] for i in range(len(self)))
+
+    # +-------------------------------------------------+
+    # Queries
+    # +-------------------------------------------------+
+    def get(self, name: str) -> D|None:
+        """ Get a distribution by slug or alias """
+        if (i := self._names.get(name)) is None:
+            return None
+        return self[i]
+
+    def find(self, where: Callable[[Mapping[str, Any]], bool]) -> D|None:
+        """ First distribution in file order with matching info """
+        for i, info in enumerate(self.records):
+            if where(info):
+                return self[i]
+        return None
+
+    def is_available(self, i: int) -> bool:
+        """ Whether the i-th distribution exists locally. Memoized, see invalidate() """
+        try:
+            return self._available[i]
+        except KeyError:
+            path = self.dist_path / self.records[i]["slug"]
+            available = self._available[i] = (path / MANIFEST_NAME).exists() or (path.is_dir() and self[i].available)
+            return available
+
+    def invalidate(self):
+        """ Forget availability after downloading or removing distributions """
+        self._available.clear()
+
+    def range(self, minver: Sequence[int]|None=None, maxver: Sequence[int]|None=None,
+              prefix: Sequence[int]|None=None) -> Sequence[int]:
+        """
+        Indices of distributions within a version range, in ascending version order
+
+        :param minver: Minimum version (inclusive)
+        :param maxver: Maximum version (inclusive)
+        :param prefix: Only versions starting with these components
+        """
+        lo, hi = 0, len(self._versions)
+        if minver is not None:
+            lo = max(lo, bisect_left(self._versions, tuple(minver)))
+        if maxver is not None:
+            hi = min(hi, bisect_right(self._versions, tuple(maxver)))
+        if prefix is not None:
+            prefix = tuple(prefix)
+            n = len(prefix)
+            lo = max(lo, bisect_left(self._versions, prefix, key=lambda v: v[:n]))
+            hi = min(hi, bisect_right(self._versions, prefix, key=lambda v: v[:n]))
+        return self._order[lo:hi]
+
+    def select(self, minver: Sequence[int]|None=None, maxver: Sequence[int]|None=None,
+               prefix: Sequence[int]|None=None, *,
+               where: Callable[[Mapping[str, Any]], bool]|None=None,
+               prefer: Callable[[Mapping[str, Any]], Any]|None=None) -> D|None:
+        """
+        Select the latest distribution matching the requirements
+
+        Between distributions of the same version, ones available locally are preferred,
+        then ones with the highest prefer() key and finally later ones in the file.
+
+        :param where: Filter on the distribution info
+        :param prefer: Ranks distributions of the same version
+        """
+        indices = self.range(minver, maxver, prefix)
+        best: int|None = None
+        best_key: tuple|None = None
+        for i in reversed(indices):
+            if best is not None and self._version(i) != self._version(best):
+                break
+            info = self.records[i]
+            if where is not None and not where(info):
+                continue
+            key = (self.is_available(i), prefer(info) if prefer is not None else 0)
+            if best_key is None or key > best_key:
+                best, best_key = i, key
+        return self[best] if best is not None else None
+
+    def _version(self, i: int) -> tuple:
+        return tuple(self.records[i]["version"])
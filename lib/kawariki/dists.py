@@ -0,0 +1,227 @@
+# :---------------------------------------------------------------------------:
+#   Distribution management verbs
+# :---------------------------------------------------------------------------:
+# 'kawariki dist list/prefetch/verify': Inspect and pre-provision dist/
+# without launching a game.
+
+from collections.abc import Iterator, Sequence
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from importlib import import_module
+from pathlib import Path
+from sys import stderr
+
+from .app import App
+from .distribution import Distribution, DistributionIndex
+from .misc import ErrorCode, size_str, version_str
+from .ui.common import DummyProgressUi, MsgType
+
+__all__ = ["RUNTIMES", "component_indexes", "find_dists", "list_dists", "prefetch", "verify_dist"]
+
+
+RUNTIMES = ("nwjs", "godot", "renpy", "mkxp")
+
+
+def component_indexes(app: App, components: Sequence[str]|None=None) -> dict[str, DistributionIndex]:
+    """ Distribution indexes of all runtimes by dist/ subdirectory name """
+    indexes: dict[str, DistributionIndex] = {}
+    for name in RUNTIMES:
+        runtime = import_module(f".{name}.runtime", __package__).Runtime(app)
+        indexes.update(runtime.distributions())
+    if components:
+        unknown = set(components) - indexes.keys()
+        if unknown:
+            raise ValueError(f"Unknown distribution component(s): {', '.join(sorted(unknown))}. "
+                             f"Available: {', '.join(indexes)}")
+        return {name: index for name, index in indexes.items() if name in components}
+    return indexes
+
+
+def find_dists(indexes: dict[str, DistributionIndex], names: Sequence[str]) -> list[Distribution]:
+    """
+    Look up distributions by slug or alias
+
+    :param names: Names, optionally qualified with the component like 'nwjs:0.100'
+    :raise ValueError: if a name doesn't match exactly one distribution
+    """
+    found: dict[Path, Distribution] = {}
+    for name in names:
+        component, sep, alias = name.rpartition(":")
+        if sep and component not in indexes:
+            raise ValueError(f"Unknown distribution component '{component}' in '{name}'")
+        matches = [dist for comp, index in indexes.items()
+                   if (not sep or comp == component) and (dist := index.get(alias)) is not None]
+        if not matches:
+            raise ValueError(f"No distribution named '{name}'")
+        if len(matches) > 1:
+            raise ValueError(f"Distribution name '{name}' is ambiguous, qualify it with one of: "
+                             + ", ".join(f"{dist.path.parent.name}:{alias}" for dist in matches))
+        found.setdefault(matches[0].path, matches[0])
+    return list(found.values())
+
+
+def installed_size(dist: Distribution) -> int|None:
+    """ Total size of the installed files according to the manifest """
+    if (manifest := dist.read_manifest()) is None:
+        return None
+    return sum(manifest["files"].values())
+
+
+# +-------------------------------------------------+
+# List
+# +-------------------------------------------------+
+def list_dists(indexes: dict[str, DistributionIndex], installed_only: bool=False) -> Iterator[str]:
+    """ Format a table of distributions """
+    for component, index in indexes.items():
+        rows = []
+        for i in index.range():
+            info = index.records[i]
+            available = index.is_available(i)
+            if installed_only and not available:
+                continue
+            if available:
+                size = installed_size(index[i])
+                state = f"installed {size_str(size)}" if size is not None else "installed"
+            else:
+                state = f"download {size_str(info['size'])}" if "size" in info else ""
+            aliases = ", ".join(info.get("alias", ()))
+            rows.append((info["slug"], version_str(info["version"]), state, aliases))
+        if not rows:
+            continue
+        yield f"{component}:"
+        widths = [max(len(row[col]) for row in rows) for col in range(3)]
+        for row in reversed(rows):
+            yield "  " + "  ".join(cell.ljust(width) for cell, width in zip(row, widths)) + \
+                  (f"  ({row[3]})" if row[3] else "")
+
+
+# +-------------------------------------------------+
+# Prefetch
+# +-------------------------------------------------+
+class _JobProgress(DummyProgressUi):
+    status: str     # Last line of the progress text
+
+    def __init__(self, title: str, text: str, progress=0, maximum=100):
+        super().__init__(title, text, progress, maximum)
+        self.status = text.splitlines()[-1] if text else ""
+
+    def _update(self, t, x, p, m):
+        if x:
+            self.status = x.splitlines()[-1]
+
+    @property
+    def fraction(self) -> float:
+        return min(1.0, self.progress / self.maximum) if self.maximum else 0.0
+
+
+class _JobApp(App):
+    """ App for a background download: Records progress and messages instead of showing them """
+    gui = None  # type: ignore[assignment]
+
+    def __init__(self, app: App):
+        super().__init__(app.app_root)
+        self.current = _JobProgress("", "Waiting")
+        self.messages: list[tuple[MsgType, str]] = []
+
+    def show_msg(self, type, title, message):
+        self.messages.append((type, message))
+
+    def show_progress(self, text, progress=0, maximum=100, title="Kawariki Runtime"):
+        self.current = _JobProgress(title, text, progress, maximum)
+        return self.current
+
+
+@dataclass
+class _Job:
+    dist: Distribution
+    app: _JobApp
+    future: Future|None = None
+
+
+def _install(app: App, dist: Distribution) -> bool:
+    from .download import download_dist_progress_archive
+
+    with app.dist_lock(dist):
+        if dist.available:
+            return False
+        download_dist_progress_archive(app, dist)
+        return True
+
+
+def prefetch(app: App, dists: Sequence[Distribution], jobs: int=3) -> int:
+    """
+    Download and install distributions concurrently, showing aggregate progress
+
+    :return: Number of distributions that failed to install
+    """
+    pending = [_Job(dist, _JobApp(app)) for dist in dists if not dist.available]
+    for dist in dists:
+        if dist.available:
+            print(f"{dist.name} is already installed")
+    if not pending:
+        return 0
+
+    description = f"Downloading {len(pending)} distribution{'s' if len(pending) > 1 else ''}"
+    with app.show_progress(f"{description}...", maximum=1000) as p, \
+            ThreadPoolExecutor(max(1, jobs), thread_name_prefix="kawariki-prefetch") as executor:
+        for job in pending:
+            job.future = executor.submit(_install, job.app, job.dist)
+        futures = [job.future for job in pending]
+        while True:
+            done, not_done = wait(futures, timeout=0.25)
+            finished = sum(1 for job in pending if job.future in done)
+            running = [job for job in pending if job.future in not_done and job.future.running()]
+            lines = [f"{job.dist.name}: {job.app.current.status}" for job in running]
+            p.update(text=f"{description} ({finished}/{len(pending)} done)\n\n" + "\n".join(lines),
+                     progress=int(sum(1.0 if job.future in done else job.app.current.fraction
+                                      for job in pending) * 1000 / len(pending)))
+            if not not_done:
+                break
+
+    failed = 0
+    for job in pending:
+        assert job.future is not None
+        for type, message in job.app.messages:
+            if type is not MsgType.Info:
+                print(f"{job.dist.name}: {message}", file=stderr)
+        if (error := job.future.exception()) is not None:
+            failed += 1
+            if not isinstance(error, ErrorCode) and not job.app.messages:
+                print(f"{job.dist.name}: {error!r}", file=stderr)
+            print(f"Failed to install {job.dist.name}")
+        elif job.future.result():
+            print(f"Installed {job.dist.name}")
+        else:
+            print(f"{job.dist.name} was installed by another process")
+    return failed
+
+
+# +-------------------------------------------------+
+# Verify
+# +-------------------------------------------------+
+def verify_dist(app: App, dist: Distribution, *, hash: bool=False) -> list[str]:
+    """
+    Check an installed distribution against its manifest
+
+    :param hash: Also check the content of files linked to the object store
+    :return: Descriptions of problems found
+    """
+    from .objects import hash_file
+
+    manifest = dist.read_manifest()
+    if manifest is None:
+        return ["Manifest is missing or unreadable"]
+    problems = []
+    objects = manifest.get("objects", {})
+    for name, size in manifest["files"].items():
+        path = dist.path / name
+        try:
+            st = path.lstat()
+        except FileNotFoundError:
+            problems.append(f"Missing file: {name}")
+            continue
+        if st.st_size != size:
+            problems.append(f"Size mismatch: {name} ({st.st_size} bytes, expected {size})")
+        elif hash and (key := objects.get(name)) is not None and hash_file(path) != key.split("-", 1)[0]:
+            problems.append(f"Content mismatch: {name}")
+    return problems
@@ -1,53 +1,179 @@
-from os import chmod
-from pathlib import Path
+from fnmatch import translate
+from pathlib import Path, PurePosixPath
+from re import compile as re_compile
 from shutil import rmtree
-from tarfile import open as taropen
-from tempfile import NamedTemporaryFile
-from collections.abc import Callable
-from typing import IO
+from collections.abc import Callable, Sequence
+from typing import IO, TYPE_CHECKING, Any
 from urllib.error import URLError
+from urllib.parse import urlsplit
 from urllib.request import urlopen
-from zipfile import ZipFile
 
+from . import trace
 from .app import App
 from .distribution import Distribution
 from .misc import ErrorCode, size_str
+from .worker import Cancelled
 
+if TYPE_CHECKING:
+    from .extract import ZipExtractor
+    from .fetch import Checksum
 
+
+@trace.traced("download_progress_tar")
 def download_progress_tar(app: App, url: str, dest: Path, description: str="Downloading file...",
-        *, modify_entry: Callable|None=None):
+        *, modify_entry: Callable|None=None, archive: Path|None=None, checksum: 'Checksum|None'=None,
+        finish: Callable[[Path], Any]|None=None):
     """
-    Download and directly extract a tar archive
+    Download and extract a tar archive
+
+    Downloading, decompression and writing files happen on separate threads.
+    Files are extracted into a staging directory that is only moved to dest once
+    the whole archive was extracted (and verified).
     :param app: The global app instance
     :param url: The url to download
     :param dest: Path to extract into
     :param description: Description text for the progress dialog
     :param modify_entry: May be a function (entry: TarInfo)->None to modify archive entries before extracting
+    :param archive: Where to keep the archive while downloading, so interrupted downloads can be resumed.
+                    Extraction follows the download as it progresses.
+                    If None, the archive is streamed directly from the server.
+    :param checksum: Verify the archive while it streams through
+    :param finish: Called with the staging directory once extraction is complete, before moving it to dest
     """
-    with app.show_progress(f"{description}\n\nConnecting") as p:
+    from concurrent.futures import ThreadPoolExecutor
+    from contextlib import ExitStack
+    from functools import partial
+
+    from .extract import TarPipeline
+    from .fetch import ChecksumError, DownloadError, RangedDownload
+
+    with app.show_progress(f"{description}\n\nConnecting") as p, \
+            ThreadPoolExecutor(1, thread_name_prefix="kawariki-download") as executor, \
+            ExitStack() as stack:
+        download = None
         try:
-            with urlopen(url) as f:
-                maxi = p.maximum = int(f.info().get("content-length", 0))
-                with taropen(mode="r|*", fileobj=f, encoding="utf-8") as tar:
-                    dest.mkdir(parents=True)
-                    while info := tar.next():
-                        if modify_entry is not None and modify_entry(info) is False:
-                            continue
-                        p.text = f"{description}\n\nExtracting '{info.name}'"
-                        # Make sure we never go over 100%
-                        if info.offset >= maxi:
-                            p.maximum = info.offset + 1
-                        p.progress = info.offset
-                        # Actually do the work
-                        tar.extract(info, dest)
+            if archive is not None:
+                download = RangedDownload(url, archive)
+                downloading = executor.submit(download.run)
+                source = download.iter_contiguous()
+            else:
+                response = stack.enter_context(urlopen(url))
+                source = iter(partial(response.read, 1 << 20), b"")
+            if checksum:
+                source = checksum.wrap(source)
+            staging = staging_path(dest)
+            rmtree(staging, ignore_errors=True)
+            pipeline = TarPipeline(source, staging, modify_entry=modify_entry)
+
+            def progress(pipeline: TarPipeline):
+                size = download.size if download is not None else int(response.headers.get("content-length", 0))
+                if download is not None and download.downloaded > pipeline.consumed:
+                    state = f"Downloaded {size_str(download.downloaded)}/{size_str(size or 0)}"
+                else:
+                    state = f"{size_str(pipeline.consumed)}/{size_str(size or 0)}"
+                p.update(text=f"{description}\n\n{state}, extracting '{pipeline.current}'",
+                         progress=pipeline.consumed, maximum=max(size or 0, pipeline.consumed + 1))
+
+            try:
+                pipeline.run(progress)
+            except BaseException:
+                # Report why the download failed rather than the extraction error it caused
+                if download is not None:
+                    download.cancel()
+                    error = downloading.exception()
+                    if error is not None and not isinstance(error, DownloadError):
+                        raise error
+                raise
+            if download is not None:
+                downloading.result()
+            if finish is not None:
+                finish(staging)
+            staging.rename(dest)
         except URLError as e:
             app.show_error(f"Could not connect to '{url}':\n{e.reason}")
+            rmtree(staging_path(dest), ignore_errors=True)
+            raise
+        except ChecksumError as e:
+            app.show_error(f"Download from '{url}' is corrupted:\n{e}")
+            rmtree(staging_path(dest), ignore_errors=True)
+            if download is not None:
+                # Don't resume from corrupted data next time
+                download.part_path.unlink(missing_ok=True)
+                download.journal_path.unlink(missing_ok=True)
+            raise
+        except Cancelled:
+            rmtree(staging_path(dest), ignore_errors=True)
             raise
         except:
             import traceback
             app.show_error(f"Error downloading from '{url}':\n\n{traceback.format_exc()}")
-            rmtree(dest, ignore_errors=True)
+            rmtree(staging_path(dest), ignore_errors=True)
             raise
+        finally:
+            if archive is not None:
+                archive.unlink(missing_ok=True)
+
+
+def staging_path(dest: Path) -> Path:
+    """ Temporary location to extract into before moving to dest """
+    return dest.with_name(f".{dest.name}.partial")
+
+
+def dist_checksum(dist: Distribution) -> 'Checksum|None':
+    """ Expected size and hash of a distribution archive, if versions.json has them """
+    from .fetch import Checksum
+    checksum = Checksum(dist.sha256, dist.size)
+    return checksum if checksum else None
+
+
+def member_filter(include: Sequence[str]|None, exclude: Sequence[str]|None) -> Callable[[str], bool]|None:
+    """
+    Create a predicate deciding whether an archive member should be extracted
+
+    Patterns are fnmatch globs matched against the member path and each of its parent
+    directories, so "locales" also covers everything inside that directory.
+    :return: None if there is nothing to filter
+    """
+    def compile(patterns: Sequence[str]|None) -> Callable|None:
+        if not patterns:
+            return None
+        return re_compile("|".join(f"(?:{translate(pattern.rstrip('/'))})" for pattern in patterns)).match
+
+    included, excluded = compile(include), compile(exclude)
+    if included is None and excluded is None:
+        return None
+
+    def wanted(name: str) -> bool:
+        parts = name.rstrip("/").split("/")
+        paths = ["/".join(parts[:i]) for i in range(1, len(parts) + 1)]
+        if excluded is not None and any(excluded(path) for path in paths):
+            return False
+        return included is None or any(included(path) for path in paths)
+    return wanted
+
+
+def finish_dist(app: App, dist: Distribution, staging: Path):
+    """ Deduplicate the files of a freshly extracted distribution and mark it complete """
+    if "binary" in dist.info and (binary := staging / dist.info["binary"]).is_file():
+        # Make sure it's executable, some archives don't preserve permissions
+        binary.chmod(binary.stat().st_mode | 0o111)
+    with trace.span("deduplicate"):
+        objects, saved = app.objects.import_tree(staging)
+    if saved:
+        print(f"Linked {dist.name} to existing files, saving {size_str(saved)}")
+    dist.write_manifest(staging, objects)
+
+
+def remove_incomplete_dist(dist: Distribution):
+    """ Remove an installation without manifest, left over from an interrupted install or marked for reinstallation """
+    if dist.path.exists() and not dist.available:
+        print(f"Removing incomplete distribution at '{dist.path}'")
+        rmtree(dist.path)
+
+
+def dist_archive_path(app: App, dist: Distribution) -> Path:
+    """ Where to keep the archive of a distribution while downloading it """
+    return app.downloads_path / f"{dist.slug}-{PurePosixPath(urlsplit(dist.url).path).name}"
 
 
 def download_dist_progress_tar(app: App, dist: Distribution):
@@ -72,19 +198,32 @@ def download_dist_progress_tar(app: App, dist: Distribution):
     else:
         strip_prefix = None
 
+    modify_entry: Callable|None = strip_prefix
+    if (wanted := member_filter(dist.include, dist.exclude)) is not None:
+        def filter_entry(entry):
+            if strip_prefix is not None and strip_prefix(entry) is False:
+                return False
+            if not wanted(entry.name):
+                return False
+        modify_entry = filter_entry
+
+    remove_incomplete_dist(dist)
     download_progress_tar(app, dist.url, dist.path,
         description=f"Downloading distribution '{dist.name}'",
-        modify_entry=strip_prefix)
+        modify_entry=modify_entry, archive=dist_archive_path(app, dist), checksum=dist_checksum(dist),
+        finish=lambda staging: finish_dist(app, dist, staging))
 
 
+@trace.traced("download_progress")
 def download_progress(app: App, url: str, dest: IO[bytes], description: str="Downloading file...",
-        buffer_size: int=16384):
+        buffer_size: int=16384, checksum: 'Checksum|None'=None):
     """
     Download a file with progress dialog
     :param app: The global app instance
     :param url: The url to download
     :param dest: The destination file object
     :param description: Description text for the progress dialog
+    :param checksum: Verify the data while downloading
     """
     with app.show_progress(f"{description}\n\nConnecting") as p:
         try:
@@ -96,20 +235,90 @@ def download_progress(app: App, url: str, dest: IO[bytes], description: str="Dow
                 bytes = 0
                 read = f.readinto(buffer)
                 while read > 0:
-                    dest.write(buffer)
+                    if checksum is not None:
+                        checksum.update(memoryview(buffer)[:read])
+                    dest.write(buffer[:read])
                     bytes += read
+                    trace.count("bytes downloaded", read)
                     p.update(text=fmt.format(size=size_str(bytes)), progress=bytes)
                     read = f.readinto(buffer)
+                if checksum is not None:
+                    checksum.verify()
         except URLError as e:
             app.show_error(f"Could not connect to '{url}':\n{e.reason}")
             raise
+        except Cancelled:
+            raise
         except:
             import traceback
             app.show_error(f"Error downloading from '{url}':\n\n{traceback.format_exc()}")
             raise
 
 
+@trace.traced("download_file_progress")
+def download_file_progress(app: App, url: str, dest: Path, description: str="Downloading file...",
+        connections: int=4, checksum: 'Checksum|None'=None) -> Path:
+    """
+    Download a file with progress dialog, using multiple connections and resuming earlier attempts
+    :param app: The global app instance
+    :param url: The url to download
+    :param dest: The destination path. Partial downloads are kept next to it
+    :param description: Description text for the progress dialog
+    :param connections: Maximum number of parallel connections
+    :param checksum: Verify the file while it is being downloaded. It is deleted if it doesn't match
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    from .fetch import ChecksumError, RangedDownload
+
+    download = RangedDownload(url, dest, connections=connections)
+    with app.show_progress(f"{description}\n\nConnecting") as p:
+        def progress(done: int, size: int|None):
+            resumed = f" (resumed at {size_str(download.resumed)})" if download.resumed else ""
+            text = f"{description}\n\nDownloading {size_str(done)}/{size_str(size) if size else '?'}{resumed}..."
+            p.update(text=text, progress=done, maximum=size or done + 1)
+        try:
+            if not checksum:
+                return download.run(progress)
+            # Hash the data in order as it arrives, while the download runs in the background
+            with ThreadPoolExecutor(1, thread_name_prefix="kawariki-download") as executor:
+                downloading = executor.submit(download.run)
+                try:
+                    for chunk in download.iter_contiguous():
+                        checksum.update(chunk)
+                        progress(download.downloaded, download.size)
+                    checksum.verify()
+                except ChecksumError:
+                    download.cancel()
+                    downloading.exception()
+                    dest.unlink(missing_ok=True)
+                    download.part_path.unlink(missing_ok=True)
+                    download.journal_path.unlink(missing_ok=True)
+                    raise
+                except BaseException:
+                    download.cancel()
+                    if (error := downloading.exception()) is not None:
+                        raise error
+                    raise
+                return downloading.result()
+        except ChecksumError as e:
+            app.show_error(f"Download from '{url}' is corrupted:\n{e}")
+            raise
+        except URLError as e:
+            app.show_error(f"Could not connect to '{url}':\n{e.reason}")
+            raise
+        except Cancelled:
+            raise
+        except:
+            import traceback
+            app.show_error(f"Error downloading from '{url}':\n\n{traceback.format_exc()}")
+            raise
+
+
+@trace.traced("download_dist_progress_zip")
 def download_dist_progress_zip(app: App, dist: Distribution):
+    from .extract import ZipExtractor
+
     strip_prefix: Callable|None
     if dist.strip_leading is True:
         def strip_prefix(entry):
@@ -131,33 +340,46 @@ def download_dist_progress_zip(app: App, dist: Distribution):
     else:
         strip_prefix = None
 
-    # Download file first
-    with NamedTemporaryFile("w+b") as tmp:
-        download_progress(app, dist.url, tmp,
-            description=f"Downloading distribution '{dist.name}'")
+    modify_entry: Callable|None = strip_prefix
+    if (wanted := member_filter(dist.include, dist.exclude)) is not None:
+        def filter_entry(entry):
+            if strip_prefix is not None and strip_prefix(entry) is False:
+                return False
+            # Stripped leading directory
+            if entry.filename and not wanted(entry.filename):
+                return False
+        modify_entry = filter_entry
 
-        tmp.seek(0)
+    remove_incomplete_dist(dist)
 
+    # Download file first
+    archive = download_file_progress(app, dist.url, dist_archive_path(app, dist),
+        description=f"Downloading distribution '{dist.name}'", checksum=dist_checksum(dist))
+    try:
         text = f"Extracting distribution '{dist.name}'\n\n"
+        staging = staging_path(dist.path)
+        rmtree(staging, ignore_errors=True)
         with app.show_progress(text) as p:
+            def progress(extractor: 'ZipExtractor'):
+                p.update(text=f"{text}{extractor.current}", progress=extractor.written,
+                         maximum=extractor.total or 1)
+
             try:
-                with ZipFile(tmp, 'r') as zf:
-                    infos = zf.infolist()
-                    p.maximum = len(infos)
-                    dist.path.mkdir(parents=True)
-                    for i in infos:
-                        if strip_prefix is not None and strip_prefix(i) is False:
-                            continue
-                        p.text = f"{text}{i.filename}"
-                        zf.extract(i, dist.path)
-                        if i.create_system == 3 or i.create_system == 19: # ZIP_CREATE_UNIX/OS_X
-                            chmod(dist.path / i.filename, (i.external_attr >> 16) & 0o777)
-                        p.progress += 1
+                ZipExtractor(archive, staging, modify_entry=modify_entry).run(progress)
+                finish_dist(app, dist, staging)
+                staging.rename(dist.path)
             except:
-                rmtree(dist.path, ignore_errors=True)
+                rmtree(staging, ignore_errors=True)
                 raise
+    finally:
+        archive.unlink(missing_ok=True)
 
 def download_dist_progress_archive(app: App, dist: Distribution):
+    """
+    Download and install a distribution on a worker thread, see App.run_in_background()
+
+    :raise Cancelled: if the user cancelled the download
+    """
     # TODO: Decide from content-type instead and unify d/l logic
     try:
         url = dist.url
@@ -165,6 +387,6 @@ def download_dist_progress_archive(app: App, dist: Distribution):
         app.show_error(f"Cannot download distribution '{dist.name}': No download URL specified")
         raise ErrorCode(10)
     if url.endswith(".zip"):
-        download_dist_progress_zip(app, dist)
+        app.run_in_background(download_dist_progress_zip, app, dist)
     else:
-        download_dist_progress_tar(app, dist)
+        app.run_in_background(download_dist_progress_tar, app, dist)
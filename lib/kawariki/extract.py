@@ -0,0 +1,434 @@
+# :---------------------------------------------------------------------------:
+#   Parallel archive extraction
+# :---------------------------------------------------------------------------:
+# Extracting a compressed tar stream consists of three kinds of work:
+# Fetching the compressed data, decompressing/parsing it and writing files.
+# Each runs on its own thread(s), connected by bounded queues, so a network
+# stall doesn't stop disk writes and slow LZMA/bz2 decompression doesn't stall
+# the network.
+#
+# Zip members are compressed individually and can be read in any order, so
+# ZipExtractor simply has several threads extract different members at once.
+
+from collections import deque
+from collections.abc import Callable, Iterable
+from concurrent.futures import FIRST_EXCEPTION, Future, ThreadPoolExecutor, wait
+from contextlib import suppress
+from io import RawIOBase
+from os import chmod, cpu_count, makedirs, replace, utime
+from os.path import isabs, normpath
+from pathlib import Path
+from queue import Empty, Full, Queue
+from shutil import copyfileobj
+from tarfile import TarInfo
+from tarfile import open as taropen
+from threading import BoundedSemaphore, Event, Lock, Thread
+from typing import IO, Any
+from zipfile import ZipFile, ZipInfo
+
+from . import trace
+
+__all__ = ["ExtractionCancelled", "TarPipeline", "ZipExtractor"]
+
+
+class ExtractionCancelled(Exception):
+    pass
+
+
+def _member_path(dest: Path, name: str) -> Path|None:
+    """ Where to extract an archive member to, None if it would end up outside of dest """
+    name = normpath(name)
+    if isabs(name) or name == ".." or name.startswith("../"):
+        print(f"Warning: Skipping archive entry outside of destination: {name}")
+        return None
+    return dest / name
+
+
+class _QueueReader(RawIOBase):
+    """
+    Read-only file object over a queue of chunks. None marks the end, exceptions are re-raised
+
+    Raises ExtractionCancelled once stop is set while waiting for a chunk.
+    """
+    def __init__(self, queue: Queue, stop: Event):
+        self._queue = queue
+        self._stop = stop
+        self._buffer = memoryview(b"")
+        self._eof = False
+        self.consumed = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        while not self._buffer:
+            if self._eof:
+                return 0
+            try:
+                item = self._queue.get(timeout=0.1)
+            except Empty:
+                if self._stop.is_set():
+                    raise ExtractionCancelled()
+                continue
+            if item is None:
+                self._eof = True
+                return 0
+            if isinstance(item, BaseException):
+                raise item
+            self._buffer = memoryview(item)
+        n = min(len(b), len(self._buffer))
+        b[:n] = self._buffer[:n]
+        self._buffer = self._buffer[n:]
+        self.consumed += n
+        return n
+
+
+class TarPipeline:
+    """
+    Extract a (compressed) tar stream using separate reader, decompressor and writer threads
+
+    :param source: Chunks of the archive, consumed on the reader thread
+    :param dest: Directory to extract into, must not exist yet
+    :param modify_entry: Called with each TarInfo before extracting it. Returning False skips the entry
+    :param writers: Number of file writer threads
+    :param queue_size: Number of source chunks buffered ahead of the decompressor
+    :param inline_size: Files larger than this are written by the decompressor thread itself
+                        instead of being buffered in memory for a writer
+    :param buffer_size: Buffer size for writing large files
+    """
+    dest: Path
+    current: str        # Name of the entry currently being decompressed
+    members: int        # Number of entries extracted
+    written: int        # Bytes of file data written
+
+    def __init__(self, source: Iterable[bytes], dest: Path, *, modify_entry: Callable[[TarInfo], Any]|None=None,
+                 writers: int=4, queue_size: int=16, inline_size: int=4 << 20, buffer_size: int=1 << 20):
+        self.source = source
+        self.dest = dest
+        self.modify_entry = modify_entry
+        self.writers = max(1, writers)
+        self.inline_size = inline_size
+        self.buffer_size = buffer_size
+
+        self.current = ""
+        self.members = 0
+        self.written = 0
+        self._queue: Queue = Queue(queue_size)
+        self._stop = Event()
+        self._reader = _QueueReader(self._queue, self._stop)
+        self._lock = Lock()
+        self._dirs: set[str] = set()
+
+    @property
+    def consumed(self) -> int:
+        """ Number of archive bytes passed to the decompressor so far """
+        return self._reader.consumed
+
+    def cancel(self):
+        self._stop.set()
+
+    # +-------------------------------------------------+
+    # Running
+    # +-------------------------------------------------+
+    def run(self, progress: Callable[['TarPipeline'], Any]|None=None, interval: float=0.1):
+        """
+        Extract the archive
+
+        :param progress: Called periodically from the calling thread with the pipeline as argument
+        :param interval: Seconds between progress calls
+        """
+        self.dest.mkdir(parents=True)
+        reader = Thread(target=self._pump, name="kawariki-extract-read", daemon=True)
+        reader.start()
+        try:
+            with ThreadPoolExecutor(self.writers, thread_name_prefix="kawariki-extract-write") as writers, \
+                    ThreadPoolExecutor(1, thread_name_prefix="kawariki-extract") as decompressor:
+                future = decompressor.submit(self._extract, writers)
+                try:
+                    while not wait([future], timeout=interval).done:
+                        if progress is not None:
+                            progress(self)
+                except BaseException:
+                    # Stop the decompressor before leaving the executors waits for it. It checks
+                    # between entries and while waiting for chunks (_QueueReader), so this returns promptly
+                    self._stop.set()
+                    raise
+                future.result()
+        except BaseException:
+            # The reader may be blocked on the source, don't wait for it
+            self._stop.set()
+            raise
+        reader.join()
+        if progress is not None:
+            progress(self)
+
+    def _put(self, item) -> bool:
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def _pump(self):
+        """ Reader thread: Move source chunks into the queue """
+        end: BaseException|None = None
+        try:
+            with trace.span("extract: read"):
+                for chunk in self.source:
+                    if not self._put(chunk):
+                        end = ExtractionCancelled()
+                        break
+        except BaseException as e:
+            end = e
+        finally:
+            # Always terminate the stream. When stopped, the queue may be full, the reader stops on its own then
+            if not self._put(end):
+                with suppress(Full):
+                    self._queue.put_nowait(end)
+
+    def _extract(self, writers: ThreadPoolExecutor):
+        """ Decompressor thread: Parse the tar stream and hand files to the writers """
+        pending: set[Future] = set()
+        slots = BoundedSemaphore(self.writers * 4)
+        with trace.span("extract: decompress"), \
+                taropen(mode="r|*", fileobj=self._reader, encoding="utf-8") as tar:
+            while (info := tar.next()) is not None:
+                if self._stop.is_set():
+                    raise ExtractionCancelled()
+                if self.modify_entry is not None and self.modify_entry(info) is False:
+                    continue
+                self.current = info.name
+                if info.isreg():
+                    if (target := self._target(info)) is None:
+                        continue
+                    self._makedirs(target.parent)
+                    fileobj = tar.extractfile(info)
+                    assert fileobj is not None
+                    if info.size > self.inline_size:
+                        self._write_stream(target, fileobj, info)
+                    else:
+                        data = fileobj.read()
+                        while not slots.acquire(timeout=0.1):
+                            if self._stop.is_set():
+                                raise ExtractionCancelled()
+                        future = writers.submit(self._write, target, data, info)
+                        future.add_done_callback(lambda _: slots.release())
+                        pending.add(future)
+                else:
+                    if info.islnk():
+                        # Hard link targets must be complete
+                        self._drain(pending, all=True)
+                    tar.extract(info, self.dest)
+                    with self._lock:
+                        self.members += 1
+                self._drain(pending)
+            # Consume anything after the end-of-archive marker, so the source runs to completion
+            while self._reader.read(self.buffer_size):
+                pass
+        self._drain(pending, all=True)
+
+    @staticmethod
+    def _drain(pending: set[Future], all: bool=False):
+        """ Forget finished writes, raising their errors """
+        if all:
+            wait(pending)
+        for future in [f for f in pending if f.done()]:
+            pending.discard(future)
+            future.result()
+
+    # +-------------------------------------------------+
+    # Writing
+    # +-------------------------------------------------+
+    def _target(self, info: TarInfo) -> Path|None:
+        return _member_path(self.dest, info.name)
+
+    def _makedirs(self, path: Path):
+        key = str(path)
+        if key not in self._dirs:
+            makedirs(path, exist_ok=True)
+            self._dirs.add(key)
+
+    def _finish_file(self, target: Path, info: TarInfo):
+        chmod(target, info.mode & 0o7777)
+        utime(target, (info.mtime, info.mtime))
+        with self._lock:
+            self.members += 1
+            self.written += info.size
+        trace.count("bytes extracted", info.size)
+
+    def _write(self, target: Path, data: bytes, info: TarInfo):
+        with open(target, "wb") as f:
+            f.write(data)
+        self._finish_file(target, info)
+
+    def _write_stream(self, target: Path, fileobj: IO[bytes], info: TarInfo):
+        with open(target, "wb", buffering=0) as f:
+            copyfileobj(fileobj, f, self.buffer_size)
+        self._finish_file(target, info)
+
+
+# +-------------------------------------------------+
+# Zip
+# +-------------------------------------------------+
+ZIP_CREATE_UNIX = 3
+ZIP_CREATE_OS_X = 19
+
+
+class ZipExtractor:
+    """
+    Extract a zip archive using a pool of threads
+
+    Members are handed out to the workers in archive order (or by priority) as they
+    become free. Each worker reads through its own ZipFile handle, since reading members
+    concurrently through a shared one serializes on its file object.
+
+    :param archive: The zip file, may have data prepended (e.g. an executable)
+    :param dest: Directory to extract into
+    :param modify_entry: Called with each ZipInfo before extracting it. May change its filename.
+                         Returning False skips the entry
+    :param priority: Sort key for the order in which files are extracted
+    :param atomic: Write files under a temporary name and rename them once complete,
+                   so other processes never see partial files
+    :param extracted: Called on the worker thread with the ZipInfo and path of each extracted file
+    :param workers: Number of extraction threads, defaults to the number of CPUs (at most 8).
+                    Decompression releases the GIL, so workers run in parallel
+    :param buffer_size: Buffer size for writing files
+    """
+    archive: Path
+    dest: Path
+    current: str        # Name of the member most recently started
+    members: int        # Number of files extracted
+    written: int        # Bytes of file data written
+    total: int          # Bytes of file data to write
+
+    def __init__(self, archive: Path, dest: Path, *, modify_entry: Callable[[ZipInfo], Any]|None=None,
+                 priority: Callable[[ZipInfo], Any]|None=None, atomic: bool=False,
+                 extracted: Callable[[ZipInfo, Path], Any]|None=None,
+                 workers: int|None=None, buffer_size: int=1 << 20):
+        self.archive = archive
+        self.dest = dest
+        self.modify_entry = modify_entry
+        self.priority = priority
+        self.atomic = atomic
+        self.extracted = extracted
+        self.workers = max(1, workers if workers is not None else min(8, cpu_count() or 1))
+        self.buffer_size = buffer_size
+
+        self.current = ""
+        self.members = 0
+        self.written = 0
+        self.total = 0
+        self._stop = Event()
+        self._lock = Lock()
+        self._files: list[tuple[ZipInfo, Path]] = []
+        self._next = 0
+        self._by_name: dict[str, tuple[ZipInfo, Path]] = {}
+        self._urgent: deque[tuple[ZipInfo, Path]] = deque()
+        self._taken: set[str] = set()
+
+    def cancel(self):
+        self._stop.set()
+
+    def promote(self, name: str) -> bool:
+        """
+        Extract a member next, ahead of the regular order. May be called from any thread while running
+
+        :return: False if there is no such file left to extract
+        """
+        with self._lock:
+            member = self._by_name.get(name)
+            if member is None or name in self._taken:
+                return False
+            self._urgent.append(member)
+            return True
+
+    # +-------------------------------------------------+
+    # Running
+    # +-------------------------------------------------+
+    def run(self, progress: Callable[['ZipExtractor'], Any]|None=None, interval: float=0.1):
+        """
+        Extract the archive
+
+        :param progress: Called periodically from the calling thread with the extractor as argument
+        :param interval: Seconds between progress calls
+        """
+        self._plan()
+        with ThreadPoolExecutor(self.workers, thread_name_prefix="kawariki-unzip") as executor:
+            futures = [executor.submit(self._work) for _ in range(min(self.workers, len(self._files)))]
+            try:
+                while wait(futures, timeout=interval, return_when=FIRST_EXCEPTION).not_done:
+                    if any(f.done() and f.exception() is not None for f in futures):
+                        # Stop the other workers, the error is raised below
+                        self._stop.set()
+                        break
+                    if progress is not None:
+                        progress(self)
+            except BaseException:
+                self._stop.set()
+                raise
+            for future in futures:
+                future.result()
+        if self._stop.is_set():
+            raise ExtractionCancelled()
+        trace.count("bytes extracted", self.written)
+        if progress is not None:
+            progress(self)
+
+    def _plan(self):
+        """ Decide the target of each member and create all directories up front """
+        dirs = {self.dest}
+        with ZipFile(self.archive) as zf:
+            for info in zf.infolist():
+                if self.modify_entry is not None and self.modify_entry(info) is False:
+                    continue
+                if not info.filename or (target := _member_path(self.dest, info.filename)) is None:
+                    continue
+                if info.is_dir():
+                    dirs.add(target)
+                else:
+                    dirs.add(target.parent)
+                    self._files.append((info, target))
+                    self.total += info.file_size
+        for path in sorted(dirs):
+            makedirs(path, exist_ok=True)
+        if self.priority is not None:
+            priority = self.priority
+            self._files.sort(key=lambda member: priority(member[0]))
+        self._by_name = {info.filename: (info, target) for info, target in self._files}
+
+    def _take(self) -> tuple[ZipInfo, Path]|None:
+        with self._lock:
+            while not self._stop.is_set():
+                if self._urgent:
+                    member = self._urgent.popleft()
+                elif self._next < len(self._files):
+                    member = self._files[self._next]
+                    self._next += 1
+                else:
+                    break
+                if member[0].filename not in self._taken:
+                    self._taken.add(member[0].filename)
+                    self.current = member[0].filename
+                    return member
+            return None
+
+    def _work(self):
+        """ Worker thread: Extract members until there are none left """
+        with ZipFile(self.archive) as zf:
+            while (member := self._take()) is not None:
+                info, target = member
+                path = target.with_name(f".{target.name}.kawariki-part") if self.atomic else target
+                with zf.open(info) as src, open(path, "wb") as dst:
+                    copyfileobj(src, dst, self.buffer_size)
+                mode = (info.external_attr >> 16) & 0o777
+                if info.create_system in (ZIP_CREATE_UNIX, ZIP_CREATE_OS_X) and mode:
+                    chmod(path, mode)
+                if self.atomic:
+                    replace(path, target)
+                if self.extracted is not None:
+                    self.extracted(info, target)
+                with self._lock:
+                    self.members += 1
+                    self.written += info.file_size
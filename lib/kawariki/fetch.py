@@ -0,0 +1,379 @@
+# :---------------------------------------------------------------------------:
+#   Resumable multi-connection downloads
+# :---------------------------------------------------------------------------:
+# Files are downloaded into '<name>.part' using HTTP Range requests over
+# several connections. Progress of each segment is recorded in
+# '<name>.part.json', so an interrupted download continues where it left off.
+# Servers without range support get a single plain stream.
+
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import FIRST_EXCEPTION, Future, ThreadPoolExecutor, wait
+from http.client import HTTPException, HTTPResponse
+from json import dump as json_dump
+from json import load as json_load
+from os import O_CREAT, O_RDONLY, O_WRONLY, close, fdatasync, ftruncate, pread, pwrite, replace
+from os import open as os_open
+from pathlib import Path
+from re import compile as re_compile
+from threading import Condition, Event, Lock
+from time import monotonic
+from typing import Any
+from urllib.request import Request, urlopen
+
+from . import trace
+
+__all__ = ["Checksum", "ChecksumError", "DownloadError", "RangedDownload"]
+
+
+class DownloadError(Exception):
+    """ Download failed in a way that retrying won't fix """
+
+
+class ChecksumError(DownloadError):
+    """ Downloaded data doesn't match the expected size or hash """
+
+
+class Checksum:
+    """
+    Incrementally verify data against an expected size and/or SHA-256 digest
+
+    Feed it the data in order as it streams past using update() or wrap(),
+    then call verify() at the end.
+    """
+    sha256: str|None
+    size: int|None
+    length: int
+
+    def __init__(self, sha256: str|None=None, size: int|None=None):
+        from hashlib import sha256 as sha256_new
+        self.sha256 = sha256.lower() if sha256 else None
+        self.size = size
+        self.length = 0
+        self._hash = sha256_new() if self.sha256 else None
+
+    def __bool__(self):
+        return self.sha256 is not None or self.size is not None
+
+    def update(self, data: bytes|memoryview):
+        self.length += len(data)
+        if self.size is not None and self.length > self.size:
+            raise ChecksumError(f"Download larger than expected {self.size} bytes")
+        if self._hash is not None:
+            self._hash.update(data)
+
+    def verify(self):
+        """ :raise ChecksumError: if the data seen so far doesn't match """
+        if self.size is not None and self.length != self.size:
+            raise ChecksumError(f"Size mismatch: Expected {self.size} bytes, got {self.length}")
+        if self._hash is not None and (digest := self._hash.hexdigest()) != self.sha256:
+            raise ChecksumError(f"SHA-256 mismatch: Expected {self.sha256}, got {digest}")
+
+    def wrap(self, chunks: Iterable[bytes]) -> Iterator[bytes]:
+        """ Pass through chunks, checking them. Raises ChecksumError after the last one if they don't match """
+        for chunk in chunks:
+            self.update(chunk)
+            yield chunk
+        self.verify()
+
+
+CONTENT_RANGE_RE = re_compile(r"bytes\s+(\d+)-(\d+)/(\d+|\*)")
+
+
+class RangedDownload:
+    """
+    Download a single URL into a file, using parallel ranged requests if possible
+
+    :param url: The URL to download
+    :param path: The destination file. Only created once the download is complete
+    :param connections: Maximum number of parallel connections
+    :param min_segment: Don't split the file into segments smaller than this
+    :param chunk_size: Read/write buffer size per connection
+    :param retries: Attempts per segment after a connection error before giving up
+    :param timeout: Socket timeout in seconds
+    """
+    JOURNAL_INTERVAL = 1.0  # Seconds between journal updates
+
+    url: str
+    path: Path
+    size: int|None
+    downloaded: int
+    ranged: bool
+    resumed: int    # Bytes already present from an earlier attempt
+
+    def __init__(self, url: str, path: Path, *, connections: int=4, min_segment: int=1 << 20,
+                 chunk_size: int=1 << 18, retries: int=3, timeout: float=30):
+        self.url = url
+        self.path = path
+        self.connections = max(1, connections)
+        self.min_segment = min_segment
+        self.chunk_size = chunk_size
+        self.retries = retries
+        self.timeout = timeout
+
+        self.size = None
+        self.downloaded = 0
+        self.ranged = False
+        self.resumed = 0
+        self._validator: dict[str, str] = {}
+        self._segments: list[list[int]] = []  # [start, end, position], end exclusive
+        self._lock = Lock()
+        self._changed = Condition(self._lock)   # Notified when data arrives or the download ends
+        self._stop = Event()
+        self._started = Event()                 # Set once the .part file exists
+        self._finished = False
+        self._error: BaseException|None = None
+
+    @property
+    def part_path(self) -> Path:
+        return self.path.with_name(self.path.name + ".part")
+
+    @property
+    def journal_path(self) -> Path:
+        return self.path.with_name(self.path.name + ".part.json")
+
+    def cancel(self):
+        """ Stop the download. The journal is kept, so it can be resumed later """
+        self._stop.set()
+
+    # +-------------------------------------------------+
+    # Running
+    # +-------------------------------------------------+
+    def run(self, progress: Callable[[int, int|None], Any]|None=None) -> Path:
+        """
+        Download the file
+
+        :param progress: Called from the calling thread as progress(downloaded, size)
+                         size is None if the server didn't tell
+        :return: The destination path
+        """
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with trace.span("probe download", url=self.url):
+                response = self._probe()
+            if response is not None:
+                with response:
+                    self._run_single(response, progress)
+            else:
+                self._run_ranged(progress)
+            replace(self.part_path, self.path)
+            self.journal_path.unlink(missing_ok=True)
+        except BaseException as e:
+            self._error = e
+            raise
+        finally:
+            with self._changed:
+                self._finished = True
+                self._changed.notify_all()
+            self._started.set()
+        return self.path
+
+    # +-------------------------------------------------+
+    # Streaming
+    # +-------------------------------------------------+
+    @property
+    def contiguous(self) -> int:
+        """ Number of bytes downloaded without gaps from the start of the file """
+        if not self.ranged:
+            return self.downloaded
+        if not self._segments:
+            return 0
+        for _, end, position in self._segments:
+            if position < end:
+                return position
+        return self._segments[-1][1]
+
+    def iter_contiguous(self, chunk_size: int=1 << 20) -> Iterator[bytes]:
+        """
+        Yield the file content in order while run() is downloading it in another thread
+
+        Data is read back from the partial file as soon as the start of the file is complete,
+        so the file can be processed while the rest of it is still being downloaded.
+        :raise DownloadError: if the download fails
+        """
+        self._started.wait()
+        if self._error is not None:
+            raise DownloadError(f"Download failed: {self._error}") from self._error
+        try:
+            fd = os_open(self.part_path, O_RDONLY)
+        except FileNotFoundError:
+            # Already done and renamed
+            fd = os_open(self.path, O_RDONLY)
+        try:
+            position = 0
+            while True:
+                with self._changed:
+                    while (available := self.contiguous) <= position and not self._finished:
+                        self._changed.wait()
+                    if available <= position:
+                        if self._error is not None:
+                            raise DownloadError(f"Download failed: {self._error}") from self._error
+                        return
+                while position < available:
+                    data = pread(fd, min(chunk_size, available - position), position)
+                    if not data:
+                        raise DownloadError(f"Partial download truncated at {position}")
+                    position += len(data)
+                    yield data
+        finally:
+            close(fd)
+
+    def _probe(self) -> HTTPResponse|None:
+        """ Find out if the server supports ranges. Returns the response if it doesn't """
+        response = urlopen(Request(self.url, headers={"Range": "bytes=0-0"}), timeout=self.timeout)
+        if response.status == 206 and (m := CONTENT_RANGE_RE.fullmatch(response.headers.get("Content-Range", ""))) \
+                and m.group(3) != "*":
+            response.close()
+            self.size = int(m.group(3))
+            self.ranged = True
+            etag = response.headers.get("ETag")
+            if etag and not etag.startswith("W/"):
+                self._validator["If-Range"] = etag
+            elif last_modified := response.headers.get("Last-Modified"):
+                self._validator["If-Range"] = last_modified
+            return None
+        if response.status == 206:
+            # Partial content we can't make sense of, start over without a range
+            response.close()
+            response = urlopen(self.url, timeout=self.timeout)
+        if length := response.headers.get("Content-Length"):
+            self.size = int(length)
+        return response
+
+    def _run_single(self, response: HTTPResponse, progress: Callable[[int, int|None], Any]|None):
+        self.journal_path.unlink(missing_ok=True)
+        buffer = bytearray(self.chunk_size)
+        with self.part_path.open("wb", buffering=0) as f:
+            self._started.set()
+            while (read := response.readinto(buffer)) > 0:
+                if self._stop.is_set():
+                    raise DownloadError("Download cancelled")
+                f.write(memoryview(buffer)[:read])
+                with self._changed:
+                    self.downloaded += read
+                    self._changed.notify_all()
+                trace.count("bytes downloaded", read)
+                if progress is not None:
+                    progress(self.downloaded, self.size)
+        if self.size is not None and self.downloaded != self.size:
+            raise DownloadError(f"Download incomplete: Got {self.downloaded} of {self.size} bytes")
+
+    def _run_ranged(self, progress: Callable[[int, int|None], Any]|None):
+        assert self.size is not None
+        if not self._load_journal():
+            self._segments = self._split(self.size)
+            self.part_path.unlink(missing_ok=True)
+        self.resumed = self.downloaded = sum(pos - start for start, _, pos in self._segments)
+
+        fd = os_open(self.part_path, O_WRONLY | O_CREAT, 0o644)
+        try:
+            # Sparse preallocation, segments fill in the holes
+            ftruncate(fd, self.size)
+            self._save_journal(fd)
+            self._started.set()
+            pending = [seg for seg in self._segments if seg[2] < seg[1]]
+            with ThreadPoolExecutor(len(pending) or 1, thread_name_prefix="kawariki-download") as pool:
+                futures: set[Future] = {pool.submit(self._fetch_segment, fd, seg) for seg in pending}
+                last_journal = monotonic()
+                try:
+                    while futures:
+                        done, futures = wait(futures, timeout=0.2, return_when=FIRST_EXCEPTION)
+                        for future in done:
+                            future.result()
+                        if progress is not None:
+                            progress(self.downloaded, self.size)
+                        if monotonic() - last_journal >= self.JOURNAL_INTERVAL:
+                            self._save_journal(fd)
+                            last_journal = monotonic()
+                    if any(pos < end for _, end, pos in self._segments):
+                        raise DownloadError("Download cancelled")
+                except BaseException:
+                    self._stop.set()
+                    wait(futures)
+                    self._save_journal(fd)
+                    raise
+        finally:
+            close(fd)
+
+    # +-------------------------------------------------+
+    # Segments
+    # +-------------------------------------------------+
+    def _split(self, size: int) -> list[list[int]]:
+        count = max(1, min(self.connections, size // self.min_segment))
+        bounds = [size * i // count for i in range(count + 1)]
+        return [[start, end, start] for start, end in zip(bounds, bounds[1:])]
+
+    def _fetch_segment(self, fd: int, segment: list[int]):
+        attempts = 0
+        while segment[2] < segment[1] and not self._stop.is_set():
+            before = segment[2]
+            try:
+                self._fetch_range(fd, segment)
+            except (OSError, HTTPException):
+                if segment[2] > before:
+                    attempts = 0
+                attempts += 1
+                if attempts > self.retries:
+                    raise
+                # Back off a bit before reconnecting
+                self._stop.wait(min(0.5 * 2 ** attempts, 5))
+
+    def _fetch_range(self, fd: int, segment: list[int]):
+        _, end, position = segment
+        request = Request(self.url, headers={"Range": f"bytes={position}-{end - 1}", **self._validator})
+        with urlopen(request, timeout=self.timeout) as response:
+            if response.status != 206:
+                raise DownloadError(f"File changed on server while downloading: {self.url}")
+            buffer = bytearray(self.chunk_size)
+            view = memoryview(buffer)
+            while position < end:
+                if self._stop.is_set():
+                    return
+                read = response.readinto(view[:min(self.chunk_size, end - position)])
+                if not read:
+                    raise HTTPException(f"Connection closed at {position} of range ending at {end}")
+                written = 0
+                while written < read:
+                    written += pwrite(fd, view[written:read], position + written)
+                position += read
+                with self._changed:
+                    segment[2] = position
+                    self.downloaded += read
+                    self._changed.notify_all()
+                trace.count("bytes downloaded", read)
+
+    # +-------------------------------------------------+
+    # Journal
+    # +-------------------------------------------------+
+    def _load_journal(self) -> bool:
+        """ Restore segment progress from an interrupted download of the same file """
+        try:
+            with self.journal_path.open("r", encoding="utf-8") as f:
+                journal = json_load(f)
+            if journal["url"] != self.url or journal["size"] != self.size \
+                    or journal["validator"] != self._validator.get("If-Range") \
+                    or self.part_path.stat().st_size != self.size:
+                return False
+            segments = [[int(start), int(end), int(pos)] for start, end, pos in journal["segments"]]
+        except (OSError, ValueError, KeyError, TypeError):
+            return False
+        if not self._validator:
+            # No way to tell if the file changed in the meantime
+            return False
+        self._segments = segments
+        return True
+
+    def _save_journal(self, fd: int):
+        # Make sure the journal never claims more than what is on disk:
+        # Snapshot the progress first, then sync, so everything it records has been flushed
+        with self._lock:
+            journal = {
+                "url": self.url,
+                "size": self.size,
+                "validator": self._validator.get("If-Range"),
+                "segments": [list(seg) for seg in self._segments],
+            }
+        fdatasync(fd)
+        tmp = self.journal_path.with_suffix(".tmp")
+        with tmp.open("w", encoding="utf-8") as f:
+            json_dump(journal, f)
+        replace(tmp, self.journal_path)
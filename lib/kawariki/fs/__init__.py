@@ -87,6 +87,12 @@ class Fs(ABC):
         with self.open(path, "rb") as f:
             return f.read()
 
+    def iter_chunks(self, path: AnyPath, chunk_size: int=16384) -> Iterator[bytes]:
+        """ Read a file piece by piece. Nothing past the last chunk consumed is read (or decompressed) """
+        with self.open(path, "rb") as f:
+            while chunk := f.read(chunk_size):
+                yield chunk
+
     def get_os_path(self, path: AnyPath) -> OsPath | None:
         return None
 
@@ -161,3 +167,6 @@ class Path(PurePath):
     def read_bytes(self) -> bytes:
         return self.fs.read_bytes(self)
 
+    def iter_chunks(self, chunk_size: int=16384) -> Iterator[bytes]:
+        return self.fs.iter_chunks(self, chunk_size)
+
@@ -1,4 +1,5 @@
 from collections.abc import Iterator
+from mmap import ACCESS_READ, mmap
 from os import DirEntry, scandir
 from typing import IO
 
@@ -69,3 +70,15 @@ class OsFs(Fs):
     @override
     def open(self, path: AnyPath, mode: FileModeRO, *, encoding=None, errors=None) -> IO[str] | IO[bytes]:
         return self.get_os_path(path).open(mode, encoding=encoding, errors=errors)
+
+    @override
+    def iter_chunks(self, path: AnyPath, chunk_size: int=16384) -> Iterator[bytes]:
+        with self.get_os_path(path).open("rb") as f:
+            try:
+                mm = mmap(f.fileno(), 0, access=ACCESS_READ)
+            except ValueError:
+                # Empty file
+                return
+            with mm:
+                for offset in range(0, len(mm), chunk_size):
+                    yield mm[offset:offset+chunk_size]
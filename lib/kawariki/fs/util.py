@@ -1,12 +1,34 @@
 
+from collections.abc import Iterator
+from re import Match, Pattern
 from shutil import copyfileobj
 
-from . import Path, OsPath
+from . import AnyPath, Fs, Path, OsPath
 
-__all__ = ["copy_from"]
+__all__ = ["copy_from", "sniff"]
 
 def copy_from(src: Path, dst: OsPath):
     if dst.is_dir():
         dst /= src.name
     with src.open('rb') as f, dst.open('wb') as fd:
         copyfileobj(f, fd)
+
+
+def sniff(fs: Fs, path: AnyPath, pattern: Pattern[bytes], *,
+          chunk_size: int=16384, overlap: int=256) -> Iterator[Match[bytes]]:
+    """
+    Search a file for pattern while streaming it from the start
+
+    Reading stops when the caller stops iterating, so looking for something
+    near the top of a big file (or a compressed archive member) is cheap.
+    Matches must be shorter than overlap and self-delimiting, i.e. a match
+    cut off at a chunk boundary must not match by itself.
+    """
+    buf = b""
+    for chunk in fs.iter_chunks(path, chunk_size):
+        buf += chunk
+        pos = 0
+        for m in pattern.finditer(buf):
+            yield m
+            pos = m.end()
+        buf = buf[max(pos, len(buf) - overlap):]
@@ -2,32 +2,141 @@
 #   Information about an installed game
 # :---------------------------------------------------------------------------:
 
+from collections.abc import Callable
 from functools import cached_property
 from os import environ
 from pathlib import Path
 from re import compile as re_compile
+from typing import TYPE_CHECKING, Any
 
+from . import trace
+from .detect_cache import DetectionCache, FsProbe, ProbeCancelled
+from .fs.util import sniff
+from .game_tree import GameTree
 from .misc import DetectedProperty
 from .nwjs.package import PackageNw
-from .renpy.detect import RenpyVersion
+
+if TYPE_CHECKING:
+    from .renpy.detect import RenpyVersion
 
 __all__ = ["Game"]
 
 
+def _renpy_version_from_dict(d: dict[str, Any]) -> 'RenpyVersion':
+    from .renpy.detect import RenpyVersion
+    return RenpyVersion.from_dict(d)
+
+
 class Game:
     root: Path
     binary_name_hint: str|None
+    cache: DetectionCache|None
+    probe: FsProbe
 
-    def __init__(self, game_root: Path, binary_name_hint: str|None):
+    def __init__(self, game_root: Path, binary_name_hint: str|None, cache: DetectionCache|None=None):
         self.root = game_root
         self.binary_name_hint = binary_name_hint
+        self.cache = cache
+        self.probe = cache.probe if cache is not None else FsProbe(GameTree(game_root))
+        if cache is not None:
+            self._restore_cache(cache.values)
+
+    @property
+    def tree(self) -> GameTree:
+        """ Directory index shared by everything looking at the game files """
+        return self.probe.tree
+
+    # +-------------------------------------------------+
+    # Detection cache
+    # +-------------------------------------------------+
+    # attribute: (serialize, deserialize)
+    CACHED_ATTRIBUTES: dict[str, tuple[Callable[[Any], Any], Callable[[Any], Any]]] = {
+        "runtime":          (str, str),
+        "package_nw":       (lambda p: {"path": str(p.path), "json": p.json, "is_archive": p.is_archive},
+                             lambda d: PackageNw(Path(d["path"]), d["json"], d["is_archive"])),
+        "rpgmaker_release": (str, str),
+        "rpgmaker_version": (list, tuple),
+        "rpgmaker_runtime": (str, str),
+        "tyrano_version":   (str, str),
+        "renpy_version":    (lambda v: v.as_dict(), _renpy_version_from_dict),
+        "godot_pack":       (str, Path),
+        "steam_appid_file": (str, str),
+    }
+
+    def _restore_cache(self, values: dict[str, Any]):
+        for attr, value in values.items():
+            if attr in self.CACHED_ATTRIBUTES:
+                _, deserialize = self.CACHED_ATTRIBUTES[attr]
+                self.__dict__[attr] = deserialize(value) if value is not None else None
+
+    def save_cache(self):
+        """ Store everything detected so far in the detection cache """
+        if self.cache is None:
+            return
+        self.cache.save({
+            attr: serialize(value) if (value := self.__dict__[attr]) is not None else None
+            for attr, (serialize, _) in self.CACHED_ATTRIBUTES.items()
+            if attr in self.__dict__
+        })
+
+    # +-------------------------------------------------+
+    # Runtime
+    # +-------------------------------------------------+
+    @cached_property
+    @trace.traced("detect runtime")
+    def runtime(self) -> str|None:
+        """
+        The name of the Kawariki runtime suitable for this game, if any
+
+        Engine probes run concurrently, but the first one in order of priority wins.
+        Lower priority probes are cancelled as soon as a higher priority one confirms
+        """
+        from concurrent.futures import Future, ThreadPoolExecutor
+        from threading import Event
+
+        futures: dict[str, Future[bool]] = {}
+        probes: dict[str, Callable[[], bool]] = {
+            "nwjs":  lambda: self.is_nwjs_app,
+            # NW.js packages take precedence and detect() needs to know about them
+            "mkxp":  lambda: not futures["nwjs"].result() and self.is_rpgmaker_rgss,
+            "godot": lambda: self.is_godot,
+            "renpy": lambda: self.is_renpy,
+        }
+        cancel = {name: Event() for name in probes}
+
+        def run_probe(name: str) -> bool:
+            with trace.span(f"probe {name}"), self.probe.cancellable(cancel[name]):
+                try:
+                    return probes[name]()
+                except ProbeCancelled:
+                    if name == "mkxp":
+                        # Don't leave partial detect() results behind
+                        for attr in self.DETECT_ATTRIBUTES:
+                            self.__dict__.pop(attr, None)
+                    return False
+
+        result = None
+        with ThreadPoolExecutor(len(probes), thread_name_prefix="kawariki-probe") as pool:
+            for name in probes:
+                futures[name] = pool.submit(run_probe, name)
+            for name, future in futures.items():
+                if future.result():
+                    result = name
+                    break
+            # Wait for the cancelled probes to finish before anything else looks at the game
+            for name, future in futures.items():
+                if not future.done():
+                    future.cancel()
+                    cancel[name].set()
+        return result
 
     # +-------------------------------------------------+
     # NW.js
     # +-------------------------------------------------+
     @cached_property
+    @trace.traced("find package.nw")
     def package_nw(self) -> PackageNw|None:
-        return PackageNw.find(self.root, self.binary_name_hint)
+        return PackageNw.find(self.root, self.binary_name_hint, probe=self.probe)
 
     @property
     def is_nwjs_app(self) -> bool:
@@ -38,10 +147,14 @@ class Game:
     # Engine detection
     # +-------------------------------------------------+
     # www/js/rpg_core.js, js/rmmz_core.js
-    RPGMAKER_INFO_RE    = re_compile(r'''Utils.RPGMAKER_(VERSION|NAME)\s*\=\s*["']([^"']+)["']''')
+    RPGMAKER_INFO_RE    = re_compile(rb'''Utils.RPGMAKER_(VERSION|NAME)\s*\=\s*["']([^"']+)["']''')
     RPGMAKER_LIBRARY_RE = re_compile(r'''RGSS(\d+\w)(?:\.dll)?$''') # Game.ini[Game.Library]
-    TYRANO_VERSION_RE   = re_compile(r'''(?<!\w)version:\s*(\d+),''') # tyrano/plugins/kag.js
+    TYRANO_VERSION_RE   = re_compile(rb'''(?<!\w)version:\s*(\d+),''') # tyrano/plugins/kag.js
+
+    # Attributes set by detect()
+    DETECT_ATTRIBUTES = ("rpgmaker_release", "rpgmaker_version", "rpgmaker_runtime", "tyrano_version")
 
+    @trace.traced("detect")
     def detect(self):
         # Do all engine detection in a single run
         # Ensure all attributes are initialized to None
@@ -53,33 +166,50 @@ class Game:
         # NW.js
         if pkg := self.package_nw:
             with pkg.open_fs() as fs:
+                def fs_exists(path: str) -> bool:
+                    if not pkg.is_archive:
+                        self.probe.read(pkg.path / path[1:])
+                        return self.probe.is_file(pkg.path / path[1:])
+                    # Archive itself was already looked at by PackageNw.find
+                    return fs.exists(path)
+
                 # Detect RPGMaker MV, MZ
+                # Only read up to the version constants near the top of the file
                 for candidate in ("/www/js/rpg_core.js", "/js/rmmz_core.js"):
-                    if fs.exists(candidate):
-                        content = fs.read_text(candidate)
-                        for m in self.RPGMAKER_INFO_RE.finditer(content):
-                            if m.group(1) == "VERSION":
-                                self.rpgmaker_version = tuple(int(x) for x in m.group(2).split('.'))
-                            elif m.group(1) == "NAME":
-                                self.rpgmaker_release = m.group(2)
+                    if fs_exists(candidate):
+                        info: dict[bytes, str] = {}
+                        for m in sniff(fs, candidate, self.RPGMAKER_INFO_RE):
+                            info[m.group(1)] = m.group(2).decode("utf-8", "replace")
+                            if len(info) == 2:
+                                break
+                        if b"VERSION" in info:
+                            self.rpgmaker_version = tuple(int(x) for x in info[b"VERSION"].split('.'))
+                        if b"NAME" in info:
+                            self.rpgmaker_release = info[b"NAME"]
 
                 # Detect Tyrano Builder
-                if fs.exists("/tyrano/plugins/kag/kag.js"): # noqa: SIM102
-                    if m := self.TYRANO_VERSION_RE.search(fs.read_text("/tyrano/plugins/kag/kag.js")):
-                        self.tyrano_version = m.group(1)
+                if fs_exists("/tyrano/plugins/kag/kag.js"):
+                    for m in sniff(fs, "/tyrano/plugins/kag/kag.js", self.TYRANO_VERSION_RE):
+                        self.tyrano_version = m.group(1).decode("ascii")
+                        break
 
         # Detect legacy RPGMaker (RGSS)
         game_ini = self.root / "Game.ini" # TODO: perform search?
-        if game_ini.exists():
+        if self.probe.exists(game_ini):
             from configparser import ConfigParser
             cfg = ConfigParser()
             cfg.read(game_ini, "sjis") # TODO: encoding
             self._detect_rgss_version(cfg["Game"]["Library"])
             self.rpgmaker_runtime = cfg.get("Game", "RTP", fallback=None)
         else:
-            for dllname in self.root.rglob("RGSS*.dll"):
+            for dllname in self.probe.rglob(self.root, "RGSS*.dll"):
                 self._detect_rgss_version(dllname.name)
 
+    def detect_once(self):
+        """ Run detect() unless the results are already known (e.g. restored from cache) """
+        if "rpgmaker_release" not in self.__dict__:
+            self.detect()
+
     def _detect_rgss_version(self, dllname):
         if m := self.RPGMAKER_LIBRARY_RE.search(dllname):
             vt = tuple(int(d) if d.isdigit() else d for d in m.group(1))
@@ -120,8 +250,10 @@ class Game:
     # Ren'Py
     # +-------------------------------------------------+
     @cached_property
-    def renpy_version(self) -> RenpyVersion|None:
-        return RenpyVersion.find(self.root)
+    @trace.traced("detect renpy")
+    def renpy_version(self) -> 'RenpyVersion|None':
+        from .renpy.detect import RenpyVersion
+        return RenpyVersion.find(self.root, self.probe)
 
     @property
     def is_renpy(self) -> bool:
@@ -131,16 +263,18 @@ class Game:
     # Godot
     # +-------------------------------------------------+
     @cached_property
+    @trace.traced("detect godot")
     def godot_pack(self) -> Path|None:
         # TODO: support merged exe, heuristics?
         if self.binary_name_hint is None:
             return None
         exe = self.root / self.binary_name_hint
         pck = exe.with_suffix(".pck")
-        if pck.exists():
+        if self.probe.exists(pck):
             return pck
         if exe.suffix in {'.exe', ".x86_64"}:
             from .godot.pack import PackReader
+            self.probe.read(exe)
             try:
                 with open(exe, 'rb') as f:
                     PackReader.find_offset(f)
@@ -157,11 +291,15 @@ class Game:
     # +-------------------------------------------------+
     # Steam meta-information
     # +-------------------------------------------------+
-    @cached_property
+    @property
     def steam_appid(self) -> str|None:
         if "SteamAppId" in environ:
             return environ["SteamAppId"]
+        return self.steam_appid_file
+
+    @cached_property
+    def steam_appid_file(self) -> str|None:
         appid_txt = self.root / "steam_appid.txt"
-        if appid_txt.is_file():
+        if self.probe.is_file(appid_txt):
             return appid_txt.read_text("ascii")
         return None
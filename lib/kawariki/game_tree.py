@@ -0,0 +1,195 @@
+# :---------------------------------------------------------------------------:
+#   Shared directory index for engine detection
+# :---------------------------------------------------------------------------:
+
+from collections import deque
+from collections.abc import Collection, Iterator
+from fnmatch import fnmatchcase
+from os import DirEntry, scandir
+from os.path import exists as os_exists
+from pathlib import Path
+
+from . import trace
+
+__all__ = ["DirListing", "GameTree"]
+
+
+class DirListing:
+    """ Contents of a single directory """
+    __slots__ = ("path", "entries", "_folded")
+
+    path: Path
+    entries: dict[str, DirEntry]
+
+    def __init__(self, path: Path, entries: dict[str, DirEntry]):
+        self.path = path
+        self.entries = entries
+        self._folded: dict[str, str]|None = None
+
+    def get(self, name: str, *, casefold: bool=False) -> DirEntry|None:
+        if (entry := self.entries.get(name)) is not None or not casefold:
+            return entry
+        if self._folded is None:
+            self._folded = {n.casefold(): n for n in self.entries}
+        if (actual := self._folded.get(name.casefold())) is not None:
+            return self.entries[actual]
+        return None
+
+    def glob(self, pattern: str, *, casefold: bool=False) -> Iterator[Path]:
+        """ Files in this directory with names matching pattern """
+        if casefold:
+            pattern = pattern.casefold()
+        for name, entry in self.entries.items():
+            if fnmatchcase(name.casefold() if casefold else name, pattern) and entry.is_file():
+                yield self.path / name
+
+    def subdirs(self) -> Iterator[DirEntry]:
+        """ Subdirectories, not following symlinks (like os.walk) """
+        return (e for e in self.entries.values() if e.is_dir(follow_symlinks=False))
+
+
+class GameTree:
+    """
+    Index of the directories looked at during detection
+
+    Every directory is scanned at most once using os.scandir and the result
+    is shared between all queries, so detectors can ask many questions about
+    the same tree without walking it repeatedly.
+
+    Lookups work for any absolute path. Case-insensitive lookups resolve path
+    components below root, which is useful for files coming from Windows builds.
+    """
+    root: Path|None
+    _listings: dict[Path, DirListing|None]
+
+    def __init__(self, root: Path|None=None):
+        self.root = root
+        self._listings = {}
+
+    # +-------------------------------------------------+
+    # Directory listings
+    # +-------------------------------------------------+
+    def listing(self, path: Path) -> DirListing|None:
+        """ Contents of a directory, or None if it isn't one """
+        try:
+            return self._listings[path]
+        except KeyError:
+            pass
+        try:
+            with scandir(path) as it:
+                listing: DirListing|None = DirListing(path, {e.name: e for e in it})
+        except OSError:
+            listing = None
+        else:
+            trace.count("directories scanned")
+        self._listings[path] = listing
+        return listing
+
+    def invalidate(self, path: Path|None=None):
+        """ Forget a directory listing (or all of them) after modifying it """
+        if path is None:
+            self._listings.clear()
+        else:
+            self._listings.pop(path, None)
+
+    # +-------------------------------------------------+
+    # Lookups
+    # +-------------------------------------------------+
+    def resolve(self, path: Path, *, casefold: bool=False) -> Path|None:
+        """ Return the path as it exists on disk, or None if it doesn't """
+        if casefold and self.root is not None and path.is_relative_to(self.root):
+            actual = self.root
+            for name in path.relative_to(self.root).parts:
+                if (listing := self.listing(actual)) is None \
+                        or (entry := listing.get(name, casefold=True)) is None:
+                    return None
+                actual = actual / entry.name
+            return actual if self._entry_exists(self._entry(actual)) else None
+        entry = self._entry(path, casefold=casefold)
+        if entry is None or not self._entry_exists(entry):
+            return None
+        return path.parent / entry.name
+
+    def _entry(self, path: Path|None, *, casefold: bool=False) -> DirEntry|None:
+        if path is None or path.parent == path:
+            return None
+        if (listing := self.listing(path.parent)) is None:
+            return None
+        return listing.get(path.name, casefold=casefold)
+
+    @staticmethod
+    def _entry_exists(entry: DirEntry|None) -> bool:
+        if entry is None:
+            return False
+        # Dangling symlinks don't exist as far as Path.exists() is concerned
+        return not entry.is_symlink() or os_exists(entry.path)
+
+    def exists(self, path: Path, *, casefold: bool=False) -> bool:
+        return self.resolve(path, casefold=casefold) is not None
+
+    def is_file(self, path: Path, *, casefold: bool=False) -> bool:
+        if (actual := self.resolve(path, casefold=casefold)) is None:
+            return False
+        entry = self._entry(actual)
+        return entry is not None and entry.is_file()
+
+    def is_dir(self, path: Path, *, casefold: bool=False) -> bool:
+        if (actual := self.resolve(path, casefold=casefold)) is None:
+            return False
+        entry = self._entry(actual)
+        return entry is not None and entry.is_dir()
+
+    # +-------------------------------------------------+
+    # Recursive queries
+    # +-------------------------------------------------+
+    def walk(self, root: Path|None=None, *,
+             max_depth: int|None=None, prune: Collection[str]=()) -> Iterator[DirListing]:
+        """
+        Recursively yield directory listings, breadth-first
+
+        Shallow matches are found first and the walk is lazy, so stopping
+        early avoids scanning the rest of the tree.
+
+        :param root: Where to start, defaults to the tree root
+        :param max_depth: Don't descend more than this many levels below root
+        :param prune: Directories to skip (case-insensitive). Plain names match
+                      anywhere, entries containing a slash match the end of the path
+                      relative to root (e.g. 'www/audio')
+        """
+        if root is None:
+            assert self.root is not None
+            root = self.root
+        prune_names = {p.casefold() for p in prune if "/" not in p}
+        prune_paths = [tuple(p.casefold().strip("/").split("/")) for p in prune if "/" in p]
+        queue: deque[tuple[Path, tuple[str, ...]]] = deque([(root, ())])
+        while queue:
+            path, parts = queue.popleft()
+            if (listing := self.listing(path)) is None:
+                continue
+            yield listing
+            if max_depth is not None and len(parts) >= max_depth:
+                continue
+            for entry in listing.subdirs():
+                folded = entry.name.casefold()
+                if folded in prune_names:
+                    continue
+                sub = (*parts, folded)
+                if any(sub[-len(p):] == p for p in prune_paths):
+                    continue
+                queue.append((path / entry.name, sub))
+
+    def glob(self, pattern: str, root: Path|None=None, *, casefold: bool=False,
+             max_depth: int|None=None, prune: Collection[str]=()) -> Iterator[Path]:
+        """ Find files with names matching pattern anywhere below root """
+        for listing in self.walk(root, max_depth=max_depth, prune=prune):
+            yield from listing.glob(pattern, casefold=casefold)
+
+    def find_suffix(self, suffix: str, root: Path|None=None, *, casefold: bool=False,
+                    max_depth: int|None=None, prune: Collection[str]=()) -> Iterator[Path]:
+        """ Find files with names ending in suffix anywhere below root """
+        if casefold:
+            suffix = suffix.casefold()
+        for listing in self.walk(root, max_depth=max_depth, prune=prune):
+            for name, entry in listing.entries.items():
+                if (name.casefold() if casefold else name).endswith(suffix) and entry.is_file():
+                    yield listing.path / name
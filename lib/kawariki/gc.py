@@ -0,0 +1,209 @@
+# :---------------------------------------------------------------------------:
+#   Garbage collection of distributions and caches
+# :---------------------------------------------------------------------------:
+# Each launch touches the manifest of the distributions it uses (App.use_dist),
+# so its mtime is the last-used time. Collection evicts the least recently used
+# entries until the disk usage of dist/ and of other caches passed in by the
+# caller (e.g. unpacked NW.js packages) fits into a budget.
+#
+# Files are hardlinked into the object store (see objects.py), so removing a
+# distribution only frees the files no other distribution links to. Usage is
+# therefore accounted per inode rather than per path.
+
+from collections.abc import Callable, Iterable, Iterator
+from dataclasses import dataclass, field
+from fcntl import LOCK_EX, LOCK_NB, flock
+from os import O_CLOEXEC, O_RDONLY, close, walk
+from os import open as os_open
+from pathlib import Path
+from shutil import rmtree
+from stat import S_ISDIR
+from typing import Any
+
+from .app import App
+from .distribution import MANIFEST_NAME
+from .lock import FileLock
+from .misc import size_str
+
+__all__ = ["CacheEntry", "GcResult", "collect_entries", "collect_garbage", "evict", "scan_entry"]
+
+
+@dataclass
+class CacheEntry:
+    """ Something that can be evicted from disk """
+    kind: str                               # Description of the kind of entry, e.g. the dist/ subdirectory
+    path: Path
+    last_used: float                        # Timestamp
+    # Files and directories it consists of by inode: (disk usage, total links, links within the entry)
+    inodes: dict[int, tuple[int, int, int]] = field(default_factory=dict)
+    lock: Path|None = None                  # Install lock to hold while removing it
+    in_use: Path|None = None                # File other launches hold a shared lock on while using it
+
+
+@dataclass
+class GcResult:
+    usage: int                              # Bytes used before collection
+    freed: int = 0
+    evicted: list[CacheEntry] = field(default_factory=list)
+    skipped: list[CacheEntry] = field(default_factory=list)  # LRU candidates that were in use
+
+
+def _walk(path: Path) -> Iterator[tuple[int, int, int]]:
+    """ (inode, disk usage, link count) of path and everything below it """
+    paths = [path]
+    if path.is_dir() and not path.is_symlink():
+        paths.extend(Path(parent, name) for parent, dirs, files in walk(path) for name in (*dirs, *files))
+    for p in paths:
+        try:
+            st = p.lstat()
+        except FileNotFoundError:
+            continue
+        # Links to a directory are its subdirectories, not other names for it
+        yield st.st_ino, st.st_blocks * 512, 1 if S_ISDIR(st.st_mode) else st.st_nlink
+
+
+def scan_entry(kind: str, path: Path, last_used: float, **kwds) -> CacheEntry:
+    """ Create a CacheEntry, recording the inodes below path """
+    entry = CacheEntry(kind, path, last_used, **kwds)
+    for ino, size, nlink in _walk(path):
+        _, _, count = entry.inodes.get(ino, (0, 0, 0))
+        entry.inodes[ino] = size, nlink, count + 1
+    return entry
+
+
+def collect_entries(app: App) -> Iterator[CacheEntry]:
+    """ Find all evictable entries below the dist/ directory """
+    if not app.dist_path.is_dir():
+        return
+    for component in sorted(app.dist_path.iterdir()):
+        if component.name.startswith(".") or not component.is_dir():
+            continue
+        for path in sorted(component.iterdir()):
+            if not path.is_dir():
+                continue
+            if path.name.startswith("."):
+                if not path.name.endswith(".partial"):
+                    continue
+                # Staging directory, evict only if stale. The install lock is held while it is being used
+                slug = path.name[1:].removesuffix(".partial")
+                manifest = None
+            else:
+                slug = path.name
+                manifest = path / MANIFEST_NAME
+            try:
+                last_used = (manifest if manifest is not None and manifest.exists() else path).stat().st_mtime
+            except FileNotFoundError:
+                continue
+            yield scan_entry(component.name, path, last_used,
+                         lock=app.locks_path / f"{component.name}-{slug}.lock", in_use=manifest)
+    if app.downloads_path.is_dir():
+        for path in sorted(app.downloads_path.iterdir()):
+            yield scan_entry("download", path, path.stat().st_mtime)
+
+
+def _try_lock_exclusive(path: Path) -> int|None:
+    """ Lock a file unless someone holds a (shared) lock on it. Returns the fd to close, -1 if it doesn't exist """
+    try:
+        fd = os_open(path, O_RDONLY | O_CLOEXEC)
+    except FileNotFoundError:
+        return -1
+    try:
+        flock(fd, LOCK_EX | LOCK_NB)
+    except BlockingIOError:
+        close(fd)
+        return None
+    return fd
+
+
+def evict(entries: Iterable[CacheEntry], budget: int, *, other: Iterable[tuple[int, int, int]]=(),
+          protect: set[Path]=set(), dry: bool=False, log: Callable[[str], Any]|None=print) -> GcResult:
+    """
+    Evict least recently used entries until they take up at most budget bytes
+
+    :param other: (inode, disk usage, link count) of files that count towards the budget but can't be evicted
+    :param protect: Paths that must not be evicted, e.g. the ones used by the current launch
+    :param dry: Only report what would be evicted
+    :param log: Called with a message for each evicted entry
+    """
+    entries = list(entries)
+
+    # An inode is freed once all entries containing it are evicted,
+    # unless it's linked from elsewhere (e.g. another install sharing the object store).
+    refs: dict[int, int] = {}       # Number of entries containing the inode
+    sizes: dict[int, int] = {}
+    external: dict[int, int] = {}   # Number of links outside of all entries
+    for entry in entries:
+        for ino, (size, nlink, count) in entry.inodes.items():
+            refs[ino] = refs.get(ino, 0) + 1
+            sizes[ino] = size
+            external[ino] = external.get(ino, nlink) - count
+    for ino, size, _ in other:
+        sizes.setdefault(ino, size)
+    usage = sum(sizes.values())
+    result = GcResult(usage)
+
+    for entry in sorted(entries, key=lambda e: e.last_used):
+        if usage - result.freed <= budget:
+            break
+        if entry.path in protect:
+            continue
+        lock = FileLock(entry.lock) if entry.lock is not None else None
+        if lock is not None and not lock.try_acquire():
+            result.skipped.append(entry)
+            continue
+        try:
+            fd = _try_lock_exclusive(entry.in_use) if entry.in_use is not None else -1
+            if fd is None:
+                result.skipped.append(entry)
+                continue
+            try:
+                freed = 0
+                for ino in entry.inodes:
+                    refs[ino] -= 1
+                    # A single external link may be the object store's, which collect_garbage() prunes
+                    if not refs[ino] and external[ino] <= 1:
+                        freed += sizes[ino]
+                if log is not None:
+                    log(f"{'Would remove' if dry else 'Removing'} {entry.kind} '{entry.path.name}', "
+                        f"freeing {size_str(freed)}")
+                if not dry:
+                    if entry.path.is_dir():
+                        rmtree(entry.path)
+                    else:
+                        entry.path.unlink()
+                result.freed += freed
+                result.evicted.append(entry)
+            finally:
+                if fd >= 0:
+                    close(fd)
+        finally:
+            if lock is not None:
+                lock.release()
+    return result
+
+
+def collect_garbage(app: App, budget: int, *, extra: Iterable[CacheEntry]=(), protect: set[Path]=set(),
+                    dry: bool=False, log: Callable[[str], Any]|None=print) -> GcResult:
+    """
+    Evict least recently used entries until dist/ and extra take up at most budget bytes
+
+    :param budget: Disk space to keep, in bytes
+    :param extra: Entries of other caches to collect together with dist/
+    :param protect: Paths that must not be evicted, e.g. the ones used by the current launch
+    :param dry: Only report what would be evicted
+    :param log: Called with a message for each evicted entry
+    """
+    store = app.objects
+    result = evict([*collect_entries(app), *extra], budget, protect=protect, dry=dry, log=log,
+                   other=_walk(store.root) if store.root.is_relative_to(app.dist_path) else ())
+
+    # Objects only linked from the store itself are no longer used by anything
+    if not dry:
+        for key, obj in store:
+            try:
+                if obj.stat().st_nlink <= 1:
+                    store.remove(key)
+            except FileNotFoundError:
+                pass
+    return result
+
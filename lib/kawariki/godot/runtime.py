@@ -5,11 +5,12 @@
 from collections.abc import Sequence
 from functools import cached_property
 
+from .. import trace
 from ..app import App, IRuntime
 from ..game import Game
 from ..process import ProcessLaunchInfo
 from ..misc import ErrorCode, version_str
-from ..distribution import DistributionInfo, Distribution
+from ..distribution import DistributionIndex, DistributionInfo, Distribution
 
 from .pack import PackReader
 
@@ -25,6 +26,7 @@ class Runtime(IRuntime):
         self.resources = app.app_root / "godot"
 
     # Runtime Versions
+    @trace.traced("download godot")
     def try_download_version(self, version: GodotDistro):
         """
         Download distribution
@@ -34,24 +36,28 @@ class Runtime(IRuntime):
         """
         from ..download import download_dist_progress_zip
 
-        download_dist_progress_zip(self.app, version)
-        version.binary.chmod(0o755) # Make sure it's executable
+        with self.app.dist_lock(version):
+            if version.available:
+                # Downloaded by another process while waiting
+                return
+            self.app.run_in_background(download_dist_progress_zip, self.app, version)
 
         self.app.show_info(f"Finished downloading Godot distribution '{version.name}'")
 
     @cached_property
-    def versions(self) -> Sequence[GodotDistro]:
-        return GodotDistro.load_json(self.resources / "versions.json", self.app.dist_path / "godot", self.app.platform)
+    def versions(self) -> DistributionIndex[GodotDistro]:
+        return GodotDistro.load_index(self.resources / "versions.json", self.app.dist_path / "godot", self.app.platform,
+                                      cache=self.app.versions_cache_path)
 
+    def distributions(self) -> dict[str, DistributionIndex]:
+        return {"godot": self.versions}
+
+    @trace.traced("select godot")
     def select_version(self, version: Sequence[int] = ()) -> GodotDistro:
         # TODO: Make selectable and such
-        versions = sorted(self.versions, key=lambda dist: dist.version, reverse=True)
         for granul in (3, 2, 1):
-            ggv = tuple(version[:granul])
-            try:
-                return next(dist for dist in versions if dist.version[:granul] == ggv)
-            except StopIteration:
-                pass
+            if len(version) >= granul and (dist := self.versions.select(prefix=version[:granul])) is not None:
+                return dist
         self.app.show_error(f"No Godot distribution available for version {version_str(version)}")
         raise ErrorCode(110)
 
@@ -61,7 +67,7 @@ class Runtime(IRuntime):
         if not pack:
             raise RuntimeError("Invalid Game instance passed to Godot Runtime")
 
-        with PackReader.open(pack) as reader:
+        with trace.span("read godot pack"), PackReader.open(pack) as reader:
             version = reader.engine_version
 
         print(f"Found Godot engine version {version_str(version)}")
@@ -73,6 +79,7 @@ class Runtime(IRuntime):
                 self.try_download_version(dist)
         except ErrorCode as e:
             return e.code
+        self.app.use_dist(dist)
 
         proc = ProcessLaunchInfo(self.app, [dist.binary, "--main-pack", pack.name])
         proc.workingdir = game.root
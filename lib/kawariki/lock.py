@@ -0,0 +1,79 @@
+# :---------------------------------------------------------------------------:
+#   Cross-process locks
+# :---------------------------------------------------------------------------:
+# Several Kawariki processes may run at the same time (e.g. two games started
+# from Steam). Work on shared state under dist/ is serialized with advisory
+# fcntl locks, which the kernel releases when the holding process dies.
+
+from collections.abc import Callable
+from fcntl import LOCK_EX, LOCK_NB, LOCK_UN, flock
+from os import O_CLOEXEC, O_CREAT, O_RDWR, close
+from os import open as os_open
+from pathlib import Path
+from time import monotonic, sleep
+from typing import Any
+
+__all__ = ["FileLock"]
+
+
+class FileLock:
+    """
+    Exclusive lock on a file, shared between processes
+
+    The lock file itself is never removed, deleting it while another
+    process waits on it would let a third process lock a new file.
+    Not reentrant.
+    """
+    path: Path
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._fd: int|None = None
+
+    @property
+    def locked(self) -> bool:
+        return self._fd is not None
+
+    def try_acquire(self) -> bool:
+        """ Acquire the lock if it is free, without waiting """
+        assert self._fd is None, "FileLock is not reentrant"
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        fd = os_open(self.path, O_RDWR | O_CREAT | O_CLOEXEC, 0o644)
+        try:
+            flock(fd, LOCK_EX | LOCK_NB)
+        except BlockingIOError:
+            close(fd)
+            return False
+        except BaseException:
+            close(fd)
+            raise
+        self._fd = fd
+        return True
+
+    def acquire(self, waiting: Callable[[float], Any]|None=None, interval: float=0.25):
+        """
+        Acquire the lock, waiting for other processes to release it
+
+        :param waiting: Called every interval with the seconds waited so far while another process holds the lock
+        :param interval: Seconds between attempts
+        """
+        start = monotonic()
+        while not self.try_acquire():
+            if waiting is not None:
+                waiting(monotonic() - start)
+            sleep(interval)
+
+    def release(self):
+        if self._fd is not None:
+            fd, self._fd = self._fd, None
+            try:
+                flock(fd, LOCK_UN)
+            finally:
+                close(fd)
+
+    def __enter__(self) -> 'FileLock':
+        self.acquire()
+        return self
+
+    def __exit__(self, et, e, tb):
+        self.release()
@@ -30,15 +30,22 @@ import pathlib
 import shlex
 import sys
 
-from .misc import ErrorCode, version_str, hardlink_or_copy
+from typing import TYPE_CHECKING
+
+from . import trace
+from .misc import ErrorCode, parse_size, version_str
 from .app import App, IRuntime
-from .game import Game
-from .quirks import STEAM_QUIRKS
+
+# Keep imports to a minimum here, verbs import what they need.
+# Use --startup-profile to check
+if TYPE_CHECKING:
+    from .game import Game
 
 
 # Common verb entrypoints
-def add_launcher(app: App, game: Game, args) -> int:
-    from .misc import format_launcher_script
+def add_launcher(app: App, game: 'Game', args) -> int:
+    from .misc import format_launcher_script, format_plan_launcher_script
+    from .plan import LaunchPlan, default_plan_dir
 
     selfpath = (app.app_root / pathlib.Path(sys.argv[0]).name).resolve()
     prefix = shlex.split(args.prefix) if args.prefix else []
@@ -47,7 +54,11 @@ def add_launcher(app: App, game: Game, args) -> int:
     try:
         with path.open("x") as f:
             binary_hint = game.binary_name_hint if game.binary_name_hint else "."
-            f.write(format_launcher_script(*prefix, selfpath, "run", "--", binary_hint))
+            if args.plan:
+                plan = LaunchPlan(default_plan_dir(app.cache_path, game.root, game.binary_name_hint))
+                f.write(format_plan_launcher_script(prefix, selfpath, plan.script_file, binary_hint))
+            else:
+                f.write(format_launcher_script(*prefix, selfpath, "run", "--", binary_hint))
     except FileExistsError:
         app.show_error("File already exists. Please choose a different name"
                        f"for the Kawariki launcher or delete it first:\n{path}")
@@ -71,6 +82,7 @@ def run_patcher(runtime, game, args) -> int:
         from .patcher.output.flat import PatcherToCopy
         out = PatcherToCopy(args.dest)
     elif args.link_dest:
+        from .misc import hardlink_or_copy
         from .patcher.output.flat import PatcherToCopy
         out = PatcherToCopy(args.link_dest, hardlink_or_copy)
     elif args.inplace:
@@ -84,6 +96,77 @@ def run_patcher(runtime, game, args) -> int:
     return 0
 
 
+def run_store(app: App, args) -> int:
+    import json
+    from .distribution import MANIFEST_NAME, mark_for_reinstall
+    from .misc import size_str
+
+    store = app.objects
+    print(f"Object store: {store.root}")
+    corrupted: list[str] = []
+    if args.verify or args.repair:
+        with app.show_progress("Verifying distribution files") as p:
+            corrupted = store.verify(lambda i, total, key: p.update(
+                text=f"Verifying distribution files\n\n{key}", progress=i, maximum=total or 1))
+        for key in corrupted:
+            print(f"Corrupted object: {key}")
+        if corrupted and args.repair:
+            corrupt = set(corrupted)
+            # Distribution files are the same inodes, reinstall the affected ones on next use
+            for manifest_path in sorted(app.dist_path.glob(f"*/*/{MANIFEST_NAME}")):
+                with open(manifest_path, encoding="utf-8") as f:
+                    objects = json.load(f).get("objects", {})
+                if not corrupt.isdisjoint(objects.values()):
+                    print(f"Marking '{manifest_path.parent.name}' for reinstallation")
+                    mark_for_reinstall(manifest_path.parent)
+            for key in corrupted:
+                store.remove(key)
+        elif corrupted:
+            print("Run with --repair to remove corrupted objects and reinstall affected distributions")
+    stats = store.stats()
+    print(f"{stats.objects} objects, {size_str(stats.size)}; saving {size_str(stats.saved)} through deduplication")
+    if stats.unused:
+        print(f"{stats.unused} objects ({size_str(stats.unused_size)}) are not used by any distribution")
+    return 1 if corrupted and not args.repair else 0
+
+
+def run_dist(app: App, args) -> int:
+    from .dists import component_indexes, find_dists, list_dists, prefetch, verify_dist
+
+    try:
+        indexes = component_indexes(app, getattr(args, "component", None))
+        if args.dist_action == "prefetch":
+            dists = find_dists(indexes, args.name)
+    except ValueError as e:
+        app.show_error(str(e))
+        return 2
+
+    if args.dist_action == "list":
+        for line in list_dists(indexes, args.installed):
+            print(line)
+    elif args.dist_action == "prefetch":
+        return 1 if prefetch(app, dists, args.jobs) else 0
+    elif args.dist_action == "verify":
+        broken = 0
+        for index in indexes.values():
+            for i in range(len(index)):
+                if not index.is_available(i):
+                    continue
+                dist = index[i]
+                problems = verify_dist(app, dist, hash=args.hash)
+                print(f"{dist.path.parent.name}:{dist.slug}: {'OK' if not problems else 'BROKEN'}")
+                for problem in problems:
+                    print(f"\t{problem}")
+                if problems:
+                    broken += 1
+                    if args.repair:
+                        with app.dist_lock(dist):
+                            mark_for_reinstall(dist.path)
+                        print("\tWill be reinstalled on next use")
+        return 1 if broken and not args.repair else 0
+    return 0
+
+
 # :---------------------------------------------------------------------------:
 #   Main
 # :---------------------------------------------------------------------------:
@@ -103,6 +186,8 @@ def add_common_args(parser: argparse.ArgumentParser, env, *, gamepath=True, nwjs
                         help="Manually select Kawariki runtime")
     parser.add_argument("--no-overlayns", action="store_true", default=env.get("no_overlayns"),
                         help="Don't try to use linux user namespaces")
+    parser.add_argument("--no-cache", action="store_true", default=env.get("no_cache"),
+                        help="Don't use or update the detection cache")
     # NW.js
     nwjs_ = parser.add_argument_group("NW.js Runtime")
     if sdk:
@@ -128,6 +213,10 @@ def parse_args(argv, env):
         formatter_class=argparse.RawDescriptionHelpFormatter)
     parser.add_argument("--version", action="version",
             version=f"Kawariki {__version__}, running on Python {version_str(sys.version_info)}")
+    parser.add_argument("--startup-profile", action="store_true",
+                        help="Run the command with import timing and print a startup time summary")
+    parser.add_argument("--startup-budget", type=float, metavar="MS",
+                        help="With --startup-profile, fail if imports take longer than this")
     sub = parser.add_subparsers(dest="action")
 
     def add_sub_parser(name, help=None):
@@ -139,6 +228,8 @@ def parse_args(argv, env):
     run.add_argument("--wait", action="store_true")
     run.add_argument("--dry", action="store_true",
                      help="Only print the resulting command, don't run the game")
+    run.add_argument("--from-plan", action="store_true", default=env.get("from_plan"),
+                     help="Execute the game's launch plan if it is up to date (see 'plan')")
     run.add_argument("game_args", nargs="*",
                      help="Pass additional arguments to the game", metavar="game args")
 
@@ -160,18 +251,68 @@ def parse_args(argv, env):
     patchgame_out.add_argument("--inplace", action="store_true",
                                help="Modify the game in place")
 
+    # Arguments for plan mode
+    plan = add_sub_parser("plan", help="Resolve everything needed to run a game into a launch plan"
+                                       " that can be executed quickly")
+    add_common_args(plan, env)
+    plan.add_argument("-o", "--output", type=pathlib.Path,
+                      help="Directory to store the plan in [Kawariki cache directory]")
+
     # Arguments for launcher mode
     create_launcher = add_sub_parser("launcher",
                                      help="Add a launcher script to the game directory")
     add_common_args(create_launcher, env)
     create_launcher.add_argument("-p", "--prefix",
                                  help="Prefix the command to run (e.g. primusrun/gamemode/gamescope)")
+    create_launcher.add_argument("--plan", action="store_true",
+                                 help="Create a launcher that executes a launch plan, skipping Kawariki when possible")
     create_launcher.add_argument("launcher", nargs="?", default="Game.sh",
                                  help="Filename of the launcher to create [%(default)s]")
 
+    # Arguments for object store maintenance
+    store = add_sub_parser("store", help="Show statistics of the distribution file store, optionally check it")
+    store.add_argument("--verify", action="store_true",
+                       help="Check all stored files for corruption")
+    store.add_argument("--repair", action="store_true",
+                       help="Verify, then remove corrupted files and reinstall affected distributions on next use")
+
+    # Arguments for distribution management
+    dist = add_sub_parser("dist", help="Manage downloaded runtime distributions")
+    dist_sub = dist.add_subparsers(dest="dist_action", required=True)
+    dist_list = dist_sub.add_parser("list", help="List distributions with their availability and size")
+    dist_list.add_argument("--installed", action="store_true",
+                           help="Only list installed distributions")
+    dist_list.add_argument("component", nargs="*",
+                           help="Only list distributions of these components (e.g. nwjs, godot)")
+    dist_prefetch = dist_sub.add_parser("prefetch", help="Download distributions concurrently")
+    dist_prefetch.add_argument("-j", "--jobs", type=int, default=3,
+                               help="Number of concurrent downloads [%(default)s]")
+    dist_prefetch.add_argument("name", nargs="+",
+                               help="Slug or alias of a distribution, optionally qualified with the component"
+                                    " like nwjs:0.100")
+    dist_verify = dist_sub.add_parser("verify", help="Check installed distributions against their manifests")
+    dist_verify.add_argument("--hash", action="store_true",
+                             help="Also check file contents")
+    dist_verify.add_argument("--repair", action="store_true",
+                             help="Reinstall broken distributions on next use")
+    dist_verify.add_argument("component", nargs="*",
+                             help="Only verify distributions of these components")
+
+    # Arguments for garbage collection
+    gc = add_sub_parser("gc", help="Remove least recently used distributions and unpacked packages"
+                                   " until they fit into a disk budget")
+    gc.add_argument("--budget", type=parse_size, default=env.get("gc_budget"), required=env.get("gc_budget") is None,
+                    help="Disk space to keep, e.g. 10G. Also set KAWARIKI_GC_BUDGET to collect after each game exits")
+    gc.add_argument("--dry-run", action="store_true",
+                    help="Only show what would be removed")
+
     return parser.parse_args(argv[1:])
 
+@trace.traced("main")
 def main(app, argv) -> int:
+    # Launch plans record changes relative to the original environment
+    base_environ = os.environ.copy()
+
     # Get defaults from environment variables
     env = {
         "sdk": check_environ("KAWARIKI_SDK", env_bool),
@@ -179,11 +320,18 @@ def main(app, argv) -> int:
         "no_overlayns": check_environ("KAWARIKI_NO_OVERLAYNS", env_bool),
         "no_unpack": check_environ("KAWARIKI_NO_UNPACK", env_bool),
         "runtime": check_environ("KAWARIKI_RUNTIME", str),
+        "no_cache": check_environ("KAWARIKI_NO_CACHE", env_bool),
+        "from_plan": check_environ("KAWARIKI_FROM_PLAN", env_bool),
+        "gc_budget": check_environ("KAWARIKI_GC_BUDGET", parse_size),
     }
 
     args = parse_args(argv, env)
 
     # -------------------------------------------
+    if args.startup_profile:
+        from .startup import profile_startup
+        return profile_startup(argv, args.startup_budget)
+
     if args.action == "fixpath":
         # Running native NW.js, try to strip out any backslashes that may have slipped in
         sys.stdout.buffer.write(pathlib.PureWindowsPath(args.path).as_posix().encode("utf-8"))
@@ -191,6 +339,14 @@ def main(app, argv) -> int:
 
     print(f"v{__version__}, python {version_str(sys.version_info)}; {shlex.join(argv[1:])}", file=sys.stderr)
 
+    if args.action == "store":
+        return run_store(app, args)
+    if args.action == "dist":
+        return run_dist(app, args)
+    if args.action == "gc":
+        app.collect_garbage(args.budget, dry=args.dry_run)
+        return 0
+
     if args.action == "run" and args.game.name in {"iscriptevaluator.exe", "d3ddriverquery64.exe"}:
         # Skip install scripts.
         print(f"Skipping {args.game.name} invocation", file=sys.stderr)
@@ -207,12 +363,30 @@ def main(app, argv) -> int:
         game_exe = game_root.name
         game_root = game_root.parent
 
-    game = Game(game_root, game_exe)
+    from .plan import LaunchPlan, PlanError, default_plan_dir
+
+    if args.action == "run" and args.from_plan:
+        plan = LaunchPlan.load(default_plan_dir(app.cache_path, game_root, game_exe))
+        if plan is None:
+            print("No launch plan found, run 'kawariki plan' to create one")
+        elif (reason := plan.check(__version__)) is not None:
+            print(f"Launch plan is out of date ({reason}), run 'kawariki plan' to update it")
+        else:
+            plan.exec(args.game_args)
+
+    from .detect_cache import DetectionCache
+    from .game import Game
+
+    # Plans depend on the detection stamps, so always keep them
+    use_cache = not args.no_cache or args.action == "plan"
+    cache = DetectionCache(app.cache_path / "detect", game_root, game_exe) if use_cache else None
+    game = Game(game_root, game_exe, cache)
 
     if args.action == "launcher":
         return add_launcher(app, game, args)
 
     # TODO: Do this better. It really shouldn't mess with the global environ
+    from .quirks import STEAM_QUIRKS
     quirk = STEAM_QUIRKS.get(game.steam_appid or "", None)
     if quirk is not None:
         print(f"Using quirks for Steam appid: {game.steam_appid}")
@@ -221,19 +395,18 @@ def main(app, argv) -> int:
 
     # Check game type
     if args.runtime in (None, "auto"):
-        if game.is_nwjs_app:
-            args.runtime = "nwjs"
-        elif game.is_rpgmaker_rgss:
-            args.runtime = "mkxp"
-        elif game.is_godot:
-            args.runtime = "godot"
-        elif game.is_renpy:
-            args.runtime = "renpy"
-        else:
+        args.runtime = game.runtime
+        if args.runtime is None:
             app.show_error(f"Couldn't detect Kawariki runtime for game: {game_root}")
             return 22
+
+    # Runtimes look at engine details, make sure they end up in the cache
+    if args.runtime in ("nwjs", "mkxp"):
+        game.detect_once()
+    game.save_cache()
     try:
-        runtime_module = importlib.import_module(f".{args.runtime}.runtime", __package__)
+        with trace.span("import runtime", runtime=args.runtime):
+            runtime_module = importlib.import_module(f".{args.runtime}.runtime", __package__)
     except ImportError:
         app.show_error(f"Could not load runtime '{args.runtime}'")
         return 22
@@ -248,6 +421,22 @@ def main(app, argv) -> int:
                                renpy_launcher=args.renpy_launcher)
         except ErrorCode as e:
             return e.code
+    elif args.action == "plan":
+        plan_dir = args.output or default_plan_dir(app.cache_path, game_root, game_exe)
+        app.plan = LaunchPlan.load(plan_dir) or LaunchPlan(plan_dir)
+        app.plan.prepare(__version__, game, base_environ)
+        try:
+            # Runtime will record the plan instead of executing the game
+            return runtime.run(game, [],
+                               nwjs_name=args.nwjs, sdk=args.sdk,
+                               no_overlayns=args.no_overlayns, no_unpack=args.no_unpack,
+                               renpy_launcher=args.renpy_launcher)
+        except ErrorCode as e:
+            return e.code
+        except PlanError as e:
+            app.show_error(f"Cannot create launch plan:\n{e}")
+            app.plan.discard()
+            return 1
     elif args.action == "patch":
         return run_patcher(runtime, game, args)
     else:
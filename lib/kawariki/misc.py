@@ -4,10 +4,10 @@
 
 from collections.abc import Sequence
 from errno import EXDEV
-from os import link, unlink
+from os import chmod, link, lstat, replace, unlink
 from os.path import exists
 from shlex import join as shlex_join
-from shutil import copy2
+from stat import S_IMODE, S_ISREG, S_IWUSR
 from textwrap import dedent
 from typing import Generic, TypeVar, overload
 
@@ -28,13 +28,40 @@ def size_str(size: int):
         expo += 1
     return f"{xsize:.2f} {desc[expo]}"
 
+def parse_size(size: str) -> int:
+    """ Parse a human-readable size like 10G, 512MiB or 1.5T (binary units) """
+    units = "BKMGT"
+    value = size.strip().upper().removesuffix("IB").removesuffix("B")
+    expo = 0
+    if value and value[-1] in units:
+        expo = units.index(value[-1])
+        value = value[:-1]
+    try:
+        return int(float(value) * 1024 ** expo)
+    except ValueError:
+        raise ValueError(f"Invalid size: {size}") from None
+
 
 def copy_unlink(src, dst):
     # Unlink first to be able to overwrite write-protected files
+    from shutil import copy2
     if exists(dst):
         unlink(dst)
     return copy2(src, dst)
 
+def unshare_file(path):
+    """ Replace a file with a writable copy if it has other hardlinks, so it can be modified in place """
+    try:
+        st = lstat(path)
+    except FileNotFoundError:
+        return
+    if S_ISREG(st.st_mode) and st.st_nlink > 1:
+        from shutil import copy2
+        temp = f"{path}.kawariki-unshare"
+        copy2(path, temp)
+        chmod(temp, S_IMODE(st.st_mode) | S_IWUSR)
+        replace(temp, path)
+
 def hardlink_or_copy(src, dst):
     try:
         link(src, dst)
@@ -43,6 +70,7 @@ def hardlink_or_copy(src, dst):
             raise
     else:
         return
+    from shutil import copy2
     copy2(src, dst)
 
 
@@ -54,6 +82,21 @@ def format_launcher_script(*args, append_args=True):
             ''')
 
 
+def format_plan_launcher_script(prefix, kawariki, plan_script, binary_hint):
+        """ Launcher that executes a launch plan, re-creating it if stale """
+        prefix_ = shlex_join(map(str, prefix)) + " " if prefix else ""
+        kawariki_, plan_, hint_ = (shlex_join([str(x)]) for x in (kawariki, plan_script, binary_hint))
+        return dedent(f'''\
+            #!/bin/sh
+            cd "`dirname "$0"`"
+            plan={plan_}
+            if "$plan" --check 2>/dev/null || {kawariki_} plan -- {hint_}; then
+                exec {prefix_}"$plan" "$@"
+            fi
+            exec {prefix_}{kawariki_} run -- {hint_} "$@"
+            ''')
+
+
 class ErrorCode(Exception):
     code: int
     def __init__(self, code: int):
@@ -9,11 +9,12 @@ from pathlib import Path
 from typing import Any, Literal
 from functools import cached_property
 
+from .. import trace
 from ..app import App, IRuntime
 from ..game import Game
 from ..process import ProcessLaunchInfo
 from ..misc import ErrorCode
-from ..distribution import DistributionInfo, Distribution
+from ..distribution import DistributionIndex, DistributionInfo, Distribution
 
 
 class MKXPDistributionInfo(DistributionInfo):
@@ -37,6 +38,7 @@ class Runtime(IRuntime):
         self.preload_path = self.mkxp_dir / "preload.rb"
 
     # Runtime Versions
+    @trace.traced("download mkxp")
     def try_download_version(self, version: MKXP):
         """
         Download mkxp distribution
@@ -46,34 +48,43 @@ class Runtime(IRuntime):
         """
         from ..download import download_dist_progress_archive
 
-        try:
-            download_dist_progress_archive(self.app, version)
-        except ErrorCode:
-            raise
-        except Exception:
-            import traceback
-            self.app.show_error(f"Couldn't download {version.name}:\n{traceback.format_exc()}")
-            raise ErrorCode(10)
-
+        with self.app.dist_lock(version):
+            if version.available:
+                # Downloaded by another process while waiting
+                return
+            try:
+                download_dist_progress_archive(self.app, version)
+            except ErrorCode:
+                raise
+            except Exception:
+                import traceback
+                self.app.show_error(f"Couldn't download {version.name}:\n{traceback.format_exc()}")
+                raise ErrorCode(10)
 
         self.app.show_info(f"Finished downloading MKXP distribution '{version.name}'")
 
     @cached_property
-    def mkxp_versions(self):
-        return MKXP.load_json(self.mkxp_dir / "versions.json", self.app.dist_path / "mkxp", self.app.platform)
+    def mkxp_versions(self) -> DistributionIndex[MKXP]:
+        return MKXP.load_index(self.mkxp_dir / "versions.json", self.app.dist_path / "mkxp", self.app.platform,
+                               cache=self.app.versions_cache_path)
+
+    def distributions(self) -> dict[str, DistributionIndex]:
+        return {"mkxp": self.mkxp_versions}
 
+    @trace.traced("select mkxp")
     def get_mkxp_version(self):
         # TODO: Make selectable and such
-        try:
-            ver = self.mkxp_versions[0]
-        except IndexError:
+        ver = self.mkxp_versions.select()
+        if ver is None:
             self.app.show_error(f"No suitable MKXP version found for platform {self.app.platform}")
             raise ErrorCode(10)
         if not ver.available:
             self.try_download_version(ver)
+        self.app.use_dist(ver)
         return ver
 
     # Run
+    @trace.traced("make_mkxp_config")
     def make_mkxp_config(self, version: MKXP, game: Game) -> str:
         config: dict[str, Any] = {}
 
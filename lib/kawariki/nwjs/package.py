@@ -1,11 +1,24 @@
 
+from collections.abc import Callable, Collection
 from json import load as json_load
-from pathlib import Path
-from typing import Any
-from zipfile import ZipFile, is_zipfile
+from pathlib import Path, PurePosixPath
+from typing import TYPE_CHECKING, Any
 
+from .. import trace
+from ..detect_cache import FsProbe
+from ..game_tree import GameTree
 from ..fs import Fs
 
+if TYPE_CHECKING:
+    from zipfile import ZipInfo
+
+# Assets that are usually loaded on demand, after the game started
+MEDIA_SUFFIXES = frozenset({
+    ".png", ".jpg", ".jpeg", ".gif", ".webp", ".bmp", ".svg",
+    ".ogg", ".m4a", ".mp3", ".wav", ".opus", ".webm", ".mp4", ".ogv",
+    ".rpgmvp", ".rpgmvo", ".rpgmvm", ".png_", ".ogg_", ".m4a_",
+})
+
 
 class PackageNw:
     """
@@ -77,37 +90,67 @@ class PackageNw:
             return json_load(f)
 
     # Unpack into directory
-    def unarchive(self, target: Path, *, as_temp: bool=False) -> 'PackageNw':
+    def boot_priority(self, learned: Collection[str]=()) -> Callable[['ZipInfo'], int]:
+        """
+        Rank archive members by how early the game is likely to need them
+
+        0: package.json, the main page and files a previous launch had to wait for (learned)
+        1: Other files that aren't media assets, like scripts and data
+        2: Everything else
+        """
+        main = self.read_json().get("main", "")
+        main = main.removeprefix("app://").split("?")[0].split("#")[0].lstrip("./")
+        main_path = PurePosixPath(self.json).parent / main
+        urgent = {self.json, str(main_path), *learned}
+
+        def rank(info: 'ZipInfo') -> int:
+            if info.filename in urgent:
+                return 0
+            return 2 if PurePosixPath(info.filename).suffix.lower() in MEDIA_SUFFIXES else 1
+        return rank
+
+    def unarchive(self, target: Path, *, as_temp: bool=False,
+                  progress: Callable[[int, int, str], Any]|None=None, **kwds) -> 'PackageNw':
+        """
+        Extract an archived package
+
+        :param progress: Called periodically as progress(bytes extracted, total bytes, current member name).
+                         May raise to abort extraction, e.g. worker.Cancelled
+        :param kwds: Passed on to extract.ZipExtractor, e.g. modify_entry or atomic
+        """
         if not isinstance(target, Path):
             target = Path(target)
         if not self.is_archive:
             raise ValueError("Package isn't archived")
-        if not target.exists():
-            target.mkdir(parents=True)
-        with ZipFile(self.path, "r") as zf:
-            zf.extractall(target)
+        from ..extract import ZipExtractor
+        extractor = ZipExtractor(self.path, target, **kwds)
+        with trace.span("unarchive", package=str(self.path)):
+            extractor.run(progress and (lambda e: progress(e.written, e.total, e.current)))
         return PackageNw(target, self.json, False, may_clobber=as_temp, original=self)
 
     # Find the NW package, if any, in a directory
     @classmethod
-    def find(cls, root: Path, binary_name_hint: str|None=None) -> 'PackageNw|None':
+    def find(cls, root: Path, binary_name_hint: str|None=None, *,
+             probe: FsProbe|None=None) -> 'PackageNw|None':
+        if probe is None:
+            probe = FsProbe(GameTree(root))
         # Plain
-        if (pkg := root / "package.json").exists():
+        if probe.exists(pkg := root / "package.json"):
             return cls(root, "package.json", False)
         # package.nw archive
-        if (pkg := root / "package.nw").exists():
-            return cls(pkg, "package.json", pkg.is_file())
+        if probe.exists(pkg := root / "package.nw"):
+            return cls(pkg, "package.json", probe.is_file(pkg))
         # Archive appended to executable
-        if (binary_name_hint is not None
-                and (pkg := root / binary_name_hint).exists()
-                and is_zipfile(pkg)):
-            # XXX: Should probably check if it actually contains a package.json
-            return cls(pkg, "package.json", True)
+        if binary_name_hint is not None and probe.exists(pkg := root / binary_name_hint):
+            from zipfile import is_zipfile
+            if is_zipfile(pkg):
+                # XXX: Should probably check if it actually contains a package.json
+                return cls(pkg, "package.json", True)
         # RPGMaker MV
-        if (p := root / "www" / "package.json").exists():
+        if probe.exists(p := root / "www" / "package.json"):
             return cls(p.parent, "package.json", False)
         # Last-ditch effort XXX: remove this?
-        for p in root.rglob("package.json"):
+        for p in probe.rglob(root, "package.json"):
             print(f"Using non-standard package.json location {p}")
             return cls(p.parent, "package.json", False)
         return None
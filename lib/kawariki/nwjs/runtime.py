@@ -1,23 +1,29 @@
 import json
 import os
-from collections.abc import Callable, Sequence
+from collections.abc import Callable, Mapping, Sequence
 from contextlib import AbstractContextManager, suppress
 from functools import cached_property
 from pathlib import Path
 from shlex import split as shlex_split
 from shutil import copytree
 from tempfile import NamedTemporaryFile
-from typing import IO, ClassVar, Literal, TypedDict
+from typing import IO, TYPE_CHECKING, Any, ClassVar, Literal, TypedDict
 
+from .. import trace
 from ..app import App, IRuntime
-from ..distribution import Distribution, DistributionInfo, DistributionInfoProperty, DistributionInfoPropertyOptional, get_first
+from ..distribution import (Distribution, DistributionIndex, DistributionInfo, DistributionInfoProperty,
+                            DistributionInfoPropertyOptional, get_first)
 from ..game import Game
-from ..misc import ErrorCode, copy_unlink, version_str
+from ..game_tree import GameTree
+from ..misc import ErrorCode, copy_unlink, unshare_file, version_str
 from ..process import ProcessLaunchInfo
 from ..utils.textwrap import dedent, indent
 from ..utils.html import HTMLBuilder, HTMLScriptsPatcher
 from .package import PackageNw
 
+if TYPE_CHECKING:
+    from .unpack_cache import UnpackCache
+
 
 class NWjsDistributionInfo(DistributionInfo):
     sdk: bool
@@ -70,7 +76,12 @@ class GreenworksDistribution(Distribution):
 
     def is_compatible(self, nwjs: NWjs) -> bool:
         """ Check whether this Greenworks distribution works with a specific NW.js version """
-        return any(nwjs.version[:len(ver)] == tuple(ver) for ver in self.info["nwjs"])
+        return self.info_compatible(self.info, nwjs)
+
+    @staticmethod
+    def info_compatible(info: Mapping[str, Any], nwjs: NWjs) -> bool:
+        """ is_compatible() on distribution info, for use with DistributionIndex """
+        return any(nwjs.version[:len(ver)] == tuple(ver) for ver in info["nwjs"])
 
     steamworks_version = DistributionInfoPropertyOptional[str]("steamworks", version_str)
     steamworks_url = DistributionInfoPropertyOptional[str]("steamworks-url")
@@ -96,6 +107,8 @@ def overlay_or_clobber(pkg: PackageNw, proc: ProcessLaunchInfo,
     """ Clobber file if pkg.may_clobber, otherwise use proc.replace_file  to overlay """
     path = pkg.path / filename
     if pkg.may_clobber:
+        # Working copies of cached packages are hardlinked to the cache
+        unshare_file(path)
         return path.open(mode)
     return proc.replace_file(path, mode)
 
@@ -475,16 +488,14 @@ class Runtime(IRuntime):
     # NW.js versions
     # +-------------------------------------------------+
     @cached_property
-    def nwjs_versions(self) -> Sequence[NWjs]:
+    def nwjs_versions(self) -> DistributionIndex[NWjs]:
         """ All compatible distributions of NW.js from versions.json """
-        return NWjs.load_json(self.base_path / "versions.json", self.nwjs_dist_path, self.app.platform)
+        return NWjs.load_index(self.base_path / "versions.json", self.nwjs_dist_path, self.app.platform,
+                               cache=self.app.versions_cache_path)
 
     def get_nwjs(self, version_name: str) -> NWjs|None:
         """ Get a specific NW.js distribution by alias """
-        for ver in self.nwjs_versions:
-            if ver.match(version_name):
-                return ver
-        return None
+        return self.nwjs_versions.get(version_name)
 
     def get_nwjs_version(self,
                          minver: tuple[int, ...]|None=None,
@@ -497,13 +508,9 @@ class Runtime(IRuntime):
         :param max: Maximum version (inclusive)
         :param sdk: Require DevTools-enabled distribution
         """
-        if v := sorted([ver for ver in self.nwjs_versions
-                        if all(((minver is None or minver <= ver.version),
-                                (maxver is None or maxver >= ver.version),
-                                (not sdk or ver.is_sdk)))],
-                       key=lambda ver: (ver.version, ver.available, not ver.is_sdk)):
-            return v[-1]
-        return None
+        return self.nwjs_versions.select(minver, maxver,
+                                         where=(lambda info: info.get("sdk", False)) if sdk else None,
+                                         prefer=lambda info: not info.get("sdk", False))
 
     def select_nwjs_version(self, game: Game, nwjs_name: str|None=None, sdk: bool|None=False) -> NWjs:
         """
@@ -557,6 +564,7 @@ class Runtime(IRuntime):
         return nwjs
 
     # Download
+    @trace.traced("download nwjs")
     def try_download_nwjs(self, nwjs: NWjs):
         """
         Download nwjs distribution
@@ -566,15 +574,24 @@ class Runtime(IRuntime):
         """
         from ..download import download_dist_progress_archive
 
-        try:
-            download_dist_progress_archive(self.app, nwjs)
-        except Exception as e:
-            import traceback
-            self.app.show_error(f"Couldn't download {nwjs.name}:\n{traceback.format_exc()}")
-            raise ErrorCode(10) from e
+        with self.app.dist_lock(nwjs):
+            if nwjs.available:
+                # Downloaded by another process while waiting
+                return
+            try:
+                download_dist_progress_archive(self.app, nwjs)
+            except ErrorCode:
+                raise
+            except Exception as e:
+                import traceback
+                self.app.show_error(f"Couldn't download {nwjs.name}:\n{traceback.format_exc()}")
+                raise ErrorCode(10) from e
+            finally:
+                self.nwjs_versions.invalidate()
 
         self.app.show_info(f"Finished downloading NW.js distribution '{nwjs.name}'")
 
+    @trace.traced("select_and_download_nwjs")
     def select_and_download_nwjs(self, game: Game, nwjs_name: str|None=None, sdk: bool|None=False) -> NWjs:
         """ Select and then (if needed) download an appropriate NW.js distribution """
         # Select nwjs version
@@ -588,61 +605,109 @@ class Runtime(IRuntime):
             self.app.show_error(f"Entry '{nwjs.name}' in nwjs/versions.json is broken:\n'{nwjs.binary}' doesn't exist")
             raise ErrorCode(6)
 
+        self.app.use_dist(nwjs)
         return nwjs
 
+    def distributions(self) -> dict[str, DistributionIndex]:
+        return {self.nwjs_dist_path.name: self.nwjs_versions,
+                self.greenworks_dist_path.name: self.greenworks_versions}
+
     @cached_property
-    def greenworks_versions(self) -> Sequence[GreenworksDistribution]:
+    def greenworks_versions(self) -> DistributionIndex[GreenworksDistribution]:
         """ All Greenworks distributions for the current platform """
-        return GreenworksDistribution.load_json(self.base_path / "greenworks.json",
+        return GreenworksDistribution.load_index(self.base_path / "greenworks.json",
                                                 self.greenworks_dist_path,
-                                                self.app.platform)
+                                                self.app.platform,
+                                                cache=self.app.versions_cache_path)
 
+    @trace.traced("try_get_greenworks")
     def try_get_greenworks(self, nwjs: NWjs) -> GreenworksDistribution|None:
         """ Select and download a Greenworks distribution compatible with a NW.js distribution """
-        for gw in self.greenworks_versions:
-            if gw.is_compatible(nwjs):
-                break
-        else:
+        gw = self.greenworks_versions.find(lambda info: GreenworksDistribution.info_compatible(info, nwjs))
+        if gw is None:
             self.app.show_warn(f"No Greenworks available for NW.js version {nwjs.version_str} ({nwjs.name})."
                 " Continuing without Steamworks Support")
             return None
-        if not gw.available:
-            from ..download import download_dist_progress_archive
-            download_dist_progress_archive(self.app, gw)
-            self.app.show_info(f"Downloaded {gw.name}")
-        if not gw.is_steamworks_included():
-            # Get steamworks
-            if not self.steamworks_dist_path.exists():
-                self.steamworks_dist_path.mkdir()
-            url = gw.info['steamworks-url']
-            filename = url.rsplit('/', 2)[-1]
-            filepath = self.steamworks_dist_path / filename
-            if not filepath.exists():
-                self.app.show_info(dedent(f"""
-                    For Steamworks to function with the Kawariki NW.js runtime,
-                    a matching version of the Steamworks redistributable libraries must be used.
-
-                    Please download Steamworks SDK {version_str(gw.info['steamworks'])} from Valve:
-                    {url}
-
-                    And place it in {self.steamworks_dist_path}, then click OK"""), title="Kawariki Steamworks Support")
+        with self.app.dist_lock(gw):
+            if not gw.available:
+                from ..download import download_dist_progress_archive
+                download_dist_progress_archive(self.app, gw)
+                self.app.show_info(f"Downloaded {gw.name}")
+            if not gw.is_steamworks_included():
+                # Get steamworks
+                if not self.steamworks_dist_path.exists():
+                    self.steamworks_dist_path.mkdir()
+                url = gw.info['steamworks-url']
+                filename = url.rsplit('/', 2)[-1]
+                filepath = self.steamworks_dist_path / filename
                 if not filepath.exists():
-                    self.app.show_error(f"{filename} not found. Continuing without Steamworks Support")
+                    self.app.show_info(dedent(f"""
+                        For Steamworks to function with the Kawariki NW.js runtime,
+                        a matching version of the Steamworks redistributable libraries must be used.
+
+                        Please download Steamworks SDK {version_str(gw.info['steamworks'])} from Valve:
+                        {url}
+
+                        And place it in {self.steamworks_dist_path}, then click OK"""),
+                        title="Kawariki Steamworks Support")
+                    if not filepath.exists():
+                        self.app.show_error(f"{filename} not found. Continuing without Steamworks Support")
+                        return None
+                # Unpack libs to greenworks dist
+                from ..fs.zip import ZipFs
+                from ..fs.util import copy_from
+                libdir = gw.path / "lib"
+
+                def unpack_steamworks():
+                    with self.app.show_progress(f"Adding Steamworks SDK to {gw.name}...", maximum=2) as p, \
+                            ZipFs(filepath) as sw:
+                        copy_from(sw.root / "sdk/public/steam/lib" / gw.steamworks_platform /
+                            gw.lib_filename("sdkencryptedappticket"), libdir)
+                        p.progress = 1
+                        copy_from(sw.root / "sdk/redistributable_bin" / gw.steamworks_platform /
+                            gw.lib_filename("steam_api"), libdir)
+                        p.progress = 2
+                self.app.run_in_background(unpack_steamworks)
+                if not gw.is_steamworks_included():
+                    self.app.show_error(f"Failed to add Steamworks SDK to {gw.name}."
+                        " Continuing without Steamworks Support")
                     return None
-            # Unpack libs to greenworks dist
-            from ..fs.zip import ZipFs
-            from ..fs.util import copy_from
-            libdir = gw.path / "lib"
-            with ZipFs(filepath) as sw:
-                copy_from(sw.root / "sdk/public/steam/lib" / gw.steamworks_platform /
-                    gw.lib_filename("sdkencryptedappticket"), libdir)
-                copy_from(sw.root / "sdk/redistributable_bin" / gw.steamworks_platform /
-                    gw.lib_filename("steam_api"), libdir)
-            if not gw.is_steamworks_included():
-                self.app.show_error(f"Failed to add Steamworks SDK to {gw.name}. Continuing without Steamworks Support")
-                return None
+        self.app.use_dist(gw)
         return gw
 
+    def unarchive_progress(self, pkg: PackageNw, target: Path, **kwds) -> PackageNw:
+        """ Unpack an archived package on a worker thread, showing progress. See PackageNw.unarchive """
+        text = f"Unpacking '{pkg.path.name}'"
+
+        def unarchive():
+            with self.app.show_progress(f"{text}...") as p:
+                def progress(done: int, total: int, name: str):
+                    p.update(text=f"{text}\n\n{name}", progress=done, maximum=total or 1)
+                return pkg.unarchive(target, as_temp=True, progress=progress, **kwds)
+        return self.app.run_in_background(unarchive)
+
+    @cached_property
+    def unpack_cache(self) -> 'UnpackCache|None':
+        """ Cache of unpacked archived packages. KAWARIKI_UNPACK_CACHE sets its size budget, 0 disables it """
+        from ..misc import parse_size
+        from .unpack_cache import UnpackCache
+        budget = parse_size(os.environ.get("KAWARIKI_UNPACK_CACHE") or "4G")
+        return UnpackCache(self.app, budget) if budget > 0 else None
+
+    def unpack_package(self, pkg: PackageNw, proc: ProcessLaunchInfo) -> PackageNw:
+        """ Get an unpacked copy of an archived package that may be modified for this launch """
+        if self.unpack_cache is not None and not proc.planning:
+            # Starting before everything is unpacked relies on the injected scripts to wait for missing files
+            stream = bool(os.environ.get("KAWARIKI_NWJS_STREAM_UNPACK")) \
+                and not os.environ.get("KAWARIKI_NWJS_RUN_UNMODIFIED")
+            unpacked = self.unpack_cache.checkout(pkg, proc, self.unarchive_progress, stream=stream)
+            if unpacked is not None:
+                return unpacked
+            print(f"'{pkg.path.name}' is too large for the unpack cache")
+        tmp = proc.temp_dir(prefix="package-", suffix=".nw")
+        print("Unpacking app to: ", tmp)
+        return self.unarchive_progress(pkg, Path(tmp))
+
     # +-------------------------------------------------+
     #   Run NW.js for Game
     # +-------------------------------------------------+
@@ -670,12 +735,17 @@ class Runtime(IRuntime):
             except:
                 os.unlink(f.name)
                 raise
-            proc.at_cleanup(lambda: os.unlink(f.name))
+            proc.generated_file(f.name)
             return name
 
-    def overlay_greenworks(self, pkg: PackageNw, nwjs: NWjs, proc: ProcessLaunchInfo):
+    @trace.traced("overlay_greenworks")
+    def overlay_greenworks(self, pkg: PackageNw, nwjs: NWjs, proc: ProcessLaunchInfo, tree: GameTree|None=None):
         """ Overlay appropriate Greenworks binaries over package """
-        for path in pkg.path.rglob("greenworks.js"):
+        if tree is None:
+            tree = GameTree(pkg.path)
+        with trace.span("find greenworks.js"):
+            found = list(tree.glob("greenworks.js", pkg.path))
+        for path in found:
             greenworks = self.try_get_greenworks(nwjs)
             if not greenworks:
                 break
@@ -684,7 +754,7 @@ class Runtime(IRuntime):
             ppath = path.parent
             # Just clobber files if we extracted package to temp
             if pkg.may_clobber:
-                copytree(greenworks.path, ppath, dirs_exist_ok=True)
+                copytree(greenworks.path, ppath, dirs_exist_ok=True, copy_function=copy_unlink)
                 continue
             # Unfortunately, overlayfs is currently incompatible with casefolding-enabled ext4.
             # Steam libraries are very likely to be on such a filesystem though.
@@ -697,13 +767,14 @@ class Runtime(IRuntime):
                 for fn in files:
                     proc.replace_file_from(pparent / fn, parent / fn)
 
+    @trace.traced("overlay_files")
     def overlay_files(self, game: Game, pkg: PackageNw, nwjs: NWjs, proc: ProcessLaunchInfo):
         if pkg.is_archive:
             raise RuntimeError("Cannot modify archived package directly")
 
         # Patch native greenworks (Steamworks API)
         if not os.environ.get("KAWARIKI_NWJS_NO_GREENWORKS"):
-            self.overlay_greenworks(pkg, nwjs, proc)
+            self.overlay_greenworks(pkg, nwjs, proc, game.tree)
 
         # TODO: make all this configurable
         conf = pkg.read_json()
@@ -714,10 +785,11 @@ class Runtime(IRuntime):
 
         js = self.base_path / 'js'
 
-        if game.is_rpgmaker:
-            inject.require(js / 'case-insensitive-nw.js', ('inject',))
-        else:
-            inject.require(js / 'case-insensitive-nw.js', ('preload',))
+        early_context: Sequence[InjectFileBuilder.Context] = ("inject",) if game.is_rpgmaker else ("preload",)
+        if "KAWARIKI_NWJS_STREAM_UNPACK_DIR" in proc.environ:
+            # Must come first to wait for files before anything looks at them
+            inject.require(js / 'stream-unpack-nw.js', early_context)
+        inject.require(js / 'case-insensitive-nw.js', early_context)
         inject.module("scriptobserver.mjs")
 
         if game.rpgmaker_release in ("MV", "MZ"):
@@ -832,9 +904,7 @@ class Runtime(IRuntime):
                 self.app.show_warn("Running archived NW.js apps without unpacking is not fully supported.")
                 no_overlayns = True
             else:
-                tmp = proc.temp_dir(prefix="package-", suffix=".nw")
-                print("Unpacking app to: ", tmp)
-                pkg = pkg.unarchive(tmp, as_temp=True)
+                pkg = self.unpack_package(pkg, proc)
 
         nwjs_args = shlex_split(os.environ.get('KAWARIKI_NWJS_ARGS', ''))
 
@@ -861,7 +931,8 @@ class Runtime(IRuntime):
         #        and offer to re-try without overlayns/greenworks support
         if not dry:
             proc.exec()
-        proc.cleanup()
+        with trace.span("cleanup"):
+            proc.cleanup()
 
         return 0
 
@@ -0,0 +1,328 @@
+# :---------------------------------------------------------------------------:
+#   Unpack cache for archived NW.js packages
+# :---------------------------------------------------------------------------:
+# Archived packages (package.nw or a zip appended to the executable) are
+# extracted once into $XDG_CACHE_HOME/kawariki/packages instead of into a
+# temporary directory on every launch. Entries are keyed by the identity of
+# the archive, so a changed archive is extracted again.
+#
+# The runtime modifies files of unpacked packages in place (may_clobber).
+# Each launch therefore gets its own working copy consisting of hardlinks to
+# the cached files. Files are unshared (misc.unshare_file) before they're
+# modified, so the cached tree stays pristine. Games may overwrite files they
+# ship with as well, e.g. RPG Maker's www/save/config.rpgsave. Files in save
+# directories are copied rather than linked for that, all other cached files
+# are read-only so in-place writes fail instead of modifying the cache.
+#
+# Entries are evicted least recently used first once the cache exceeds its
+# budget, except for ones used by running games (see App.use_file).
+#
+# Files are extracted into the entry under temporary names and renamed once
+# complete. The marker file is written last, an entry without it is completed
+# under the lock by the next launch, skipping the files that are already there.
+#
+# With streaming enabled, only the files a game likely needs to start (see
+# PackageNw.boot_priority) are extracted before it is launched. The rest is
+# extracted on a thread of the Kawariki process waiting for the game, which
+# links each file into the working copy once it is complete. Files the game
+# asks for before they're extracted are moved to the front of the queue, the
+# game waits for them (js/stream-unpack-nw.js). Those files are remembered and
+# extracted up front next time the package is unpacked.
+
+from collections.abc import Callable, Collection, Iterator
+from contextlib import ExitStack, suppress
+from hashlib import sha256
+from json import dump as json_dump
+from json import load as json_load
+from os import chmod, getpid, kill, link, lstat, makedirs, walk
+from os.path import lexists
+from pathlib import Path, PurePath
+from shutil import copy2, rmtree
+from stat import S_IMODE, S_ISREG, S_IWUSR
+from sys import stderr
+from tempfile import mkdtemp
+from threading import Thread
+from typing import Any
+from zipfile import ZipFile, ZipInfo
+
+from .. import trace
+from ..app import App
+from ..extract import ExtractionCancelled, ZipExtractor
+from ..gc import CacheEntry, GcResult, evict, scan_entry
+from ..process import ProcessEnvironment
+from .package import PackageNw
+
+__all__ = ["UnpackCache", "archive_key", "STREAM_DIR_VAR"]
+
+
+MARKER_NAME = ".kawariki-package.json"
+PART_SUFFIX = ".kawariki-part"
+# Environment variable pointing the game to the state of a streaming unpack
+STREAM_DIR_VAR = "KAWARIKI_NWJS_STREAM_UNPACK_DIR"
+# Number of learned files remembered per package
+LEARNED_LIMIT = 1000
+# Files games commonly write to in place, copied into working copies
+SAVE_DIRS = frozenset({"save", "saves", "savedata"})
+SAVE_SUFFIXES = frozenset({".rpgsave", ".rmmzsave", ".sav"})
+
+
+def archive_key(path: Path) -> str:
+    """ Identify an archive by its size, mtime and a hash of its zip central directory """
+    st = path.stat()
+    digest = sha256(f"{st.st_size}:{st.st_mtime_ns}:".encode())
+    with ZipFile(path) as zf, open(path, "rb") as f:
+        # The central directory and end record make up the end of the file
+        f.seek(zf.start_dir)
+        while chunk := f.read(1 << 20):
+            digest.update(chunk)
+    return digest.hexdigest()[:32]
+
+
+def _protect(info: ZipInfo, path: Path):
+    """ Make an extracted file read-only """
+    st = lstat(path)
+    if S_ISREG(st.st_mode):
+        chmod(path, S_IMODE(st.st_mode) & ~0o222)
+
+
+def _checkout_file(src: Path, dst: Path, name: PurePath):
+    """ Add a cached file to a working copy """
+    if name.suffix.lower() in SAVE_SUFFIXES or any(part.lower() in SAVE_DIRS for part in name.parts[:-1]):
+        # Like link(), don't replace existing files
+        if lexists(dst):
+            raise FileExistsError(f"File exists: '{dst}'")
+        copy2(src, dst, follow_symlinks=False)
+        if not dst.is_symlink():
+            chmod(dst, S_IMODE(lstat(dst).st_mode) | S_IWUSR)
+    else:
+        link(src, dst, follow_symlinks=False)
+
+
+class UnpackCache:
+    """
+    Persistent cache of extracted NW.js packages
+
+    :param budget: Disk space the cache may use, in bytes
+    """
+    app: App
+    root: Path
+    budget: int
+
+    def __init__(self, app: App, budget: int):
+        self.app = app
+        self.root = app.cache_path / "packages"
+        self.budget = budget
+
+    def entry_path(self, key: str) -> Path:
+        return self.root / key
+
+    def lock_path(self, key: str) -> Path:
+        return self.root / ".locks" / f"{key}.lock"
+
+    def learned_path(self, pkg: PackageNw) -> Path:
+        """ Files the game needed early, by archive location so they carry over to updated versions """
+        return self.root / ".learned" / f"{sha256(str(pkg.path.resolve()).encode()).hexdigest()[:32]}.json"
+
+    # +-------------------------------------------------+
+    # Checkout
+    # +-------------------------------------------------+
+    def checkout(self, pkg: PackageNw, env: ProcessEnvironment,
+                 unarchive: Callable[..., Any], *, stream: bool=False) -> PackageNw|None:
+        """
+        Get a working copy of an archived package, extracting it into the cache first if necessary
+
+        The working copy is removed when env is cleaned up.
+        :param unarchive: Called as unarchive(pkg, target, **kwds) to extract the package, see PackageNw.unarchive
+        :param stream: Only extract the files needed to start the game before returning,
+                       see STREAM_DIR_VAR. The rest is extracted until env is cleaned up
+        :return: None if the package is too large for the cache
+        """
+        key = archive_key(pkg.path)
+        entry = self.entry_path(key)
+        with ExitStack() as locks:
+            locks.enter_context(self.app.hold_lock(self.lock_path(key), f"unpacking of '{pkg.path.name}'"))
+            later: set[str] = set()
+            if (entry / MARKER_NAME).exists():
+                print(f"Using unpacked '{pkg.path.name}' from cache: {entry}")
+                extracted = False
+            else:
+                with ZipFile(pkg.path) as zf:
+                    infos = zf.infolist()
+                size = sum(info.file_size for info in infos)
+                if size > self.budget:
+                    return None
+                later = self._extract(pkg, entry, infos, unarchive, stream)
+                extracted = True
+            work = self._working_copy(entry)
+            env.at_cleanup(lambda: rmtree(work, ignore_errors=True))
+            if later:
+                print(f"Starting '{pkg.path.name}' while unpacking {len(later)} more files in the background")
+                # The streaming thread takes over the lock
+                _Streamer(self, pkg, entry, size, work, later, env, locks.pop_all())
+            else:
+                if extracted:
+                    self._complete(pkg, entry, size)
+                self.app.use_file(entry / MARKER_NAME)
+        if extracted:
+            self.collect_garbage(protect={entry})
+        return PackageNw(work, pkg.json, False, may_clobber=True, original=pkg)
+
+    @trace.traced("unpack cache: extract")
+    def _extract(self, pkg: PackageNw, entry: Path, infos: list[ZipInfo],
+                 unarchive: Callable[..., Any], stream: bool) -> set[str]:
+        """ Extract the files missing from entry. Returns the ones left to stream """
+        tree = entry / "tree"
+        # Continue where an interrupted extraction stopped, complete files are never partial
+        missing = {info.filename for info in infos if not info.is_dir() and not (tree / info.filename).exists()}
+        later = set()
+        if stream:
+            rank = pkg.boot_priority(self.load_learned(pkg))
+            later = {info.filename for info in infos if info.filename in missing and rank(info) > 1}
+        unarchive(pkg, tree, atomic=True, extracted=_protect,
+                  modify_entry=lambda info: info.is_dir() or (info.filename in missing and info.filename not in later))
+        return later
+
+    def _complete(self, pkg: PackageNw, entry: Path, size: int):
+        with open(entry / MARKER_NAME, "w") as f:
+            json_dump({"archive": str(pkg.path), "size": size}, f)
+
+    @trace.traced("unpack cache: working copy")
+    def _working_copy(self, entry: Path) -> Path:
+        """ Create a tree of hardlinks to the cached files, with copies of files in save directories """
+        # Left behind by launches that didn't clean up
+        for stale in entry.glob("work-*"):
+            try:
+                kill(int(stale.name.split("-")[1]), 0)
+            except ProcessLookupError:
+                rmtree(stale, ignore_errors=True)
+            except (ValueError, IndexError, PermissionError):
+                pass
+        tree = entry / "tree"
+        work = Path(mkdtemp(prefix=f"work-{getpid()}-", dir=entry))
+        for parent, dirs, files in walk(tree):
+            rel = Path(parent).relative_to(tree)
+            for name in dirs:
+                makedirs(work / rel / name, exist_ok=True)
+            for name in files:
+                if not name.endswith(PART_SUFFIX):
+                    _checkout_file(Path(parent, name), work / rel / name, rel / name)
+        return work
+
+    # +-------------------------------------------------+
+    # Learned files
+    # +-------------------------------------------------+
+    def load_learned(self, pkg: PackageNw) -> list[str]:
+        try:
+            with open(self.learned_path(pkg)) as f:
+                return json_load(f)
+        except (OSError, ValueError):
+            return []
+
+    def save_learned(self, pkg: PackageNw, names: Collection[str]):
+        """ Remember files the game had to wait for, most recent first """
+        if not names:
+            return
+        learned = list(dict.fromkeys([*names, *self.load_learned(pkg)]))[:LEARNED_LIMIT]
+        path = self.learned_path(pkg)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "w") as f:
+            json_dump(learned, f)
+
+    # +-------------------------------------------------+
+    # Eviction
+    # +-------------------------------------------------+
+    def entries(self) -> Iterator[CacheEntry]:
+        if not self.root.is_dir():
+            return
+        for path in sorted(self.root.iterdir()):
+            if not path.is_dir() or path.name.startswith("."):
+                continue
+            # Incomplete entries have no marker, the lock is held while they're being extracted
+            marker = path / MARKER_NAME
+            try:
+                last_used = (marker if marker.exists() else path).stat().st_mtime
+            except FileNotFoundError:
+                continue
+            yield scan_entry("package", path, last_used, lock=self.lock_path(path.name), in_use=marker)
+
+    def collect_garbage(self, protect: set[Path]=set(), dry: bool=False) -> GcResult:
+        """ Evict least recently used packages until the cache fits into its budget """
+        return evict(self.entries(), self.budget, protect=protect, dry=dry)
+
+
+class _Streamer:
+    """
+    Extracts the remaining files of a package while the game runs
+
+    The state is shared with the game through a directory named by STREAM_DIR_VAR:
+    pending.json lists the working copy and the files not extracted yet, the game
+    appends files it waits for to requests, done is created once nothing is pending anymore.
+    """
+    def __init__(self, cache: UnpackCache, pkg: PackageNw, entry: Path, size: int,
+                 work: Path, later: set[str], env: ProcessEnvironment, locks: ExitStack):
+        self.cache = cache
+        self.pkg = pkg
+        self.entry = entry
+        self.size = size
+        self.work = work
+        self.locks = locks
+        self.count = len(later)
+        self.requested: list[str] = []
+        self.extractor = ZipExtractor(pkg.path, entry / "tree", modify_entry=lambda info: info.filename in later,
+                                      atomic=True, extracted=self._extracted)
+
+        self.control = Path(env.temp_dir(prefix="stream-unpack-"))
+        with open(self.control / "pending.json", "w") as f:
+            json_dump({"root": str(work), "pending": sorted(later)}, f)
+        (self.control / "requests").touch()
+        self._requests_offset = 0
+        env.environ[STREAM_DIR_VAR] = str(self.control)
+
+        self._thread = Thread(target=self._run, name="kawariki-unpack", daemon=True)
+        self._thread.start()
+        # Runs before the working copy is removed
+        env.at_cleanup(self.stop)
+
+    def stop(self):
+        """ Stop extracting if the game exited before it finished, the next launch continues """
+        self.extractor.cancel()
+        self._thread.join()
+        self.cache.save_learned(self.pkg, self.requested)
+
+    def _run(self):
+        try:
+            with trace.span("unpack cache: stream", files=self.count):
+                self.extractor.run(self._poll_requests, interval=0.05)
+            self.cache._complete(self.pkg, self.entry, self.size)
+            self.cache.app.use_file(self.entry / MARKER_NAME)
+            print(f"Finished unpacking '{self.pkg.path.name}'")
+        except ExtractionCancelled:
+            print(f"Unpacking '{self.pkg.path.name}' stopped, it will be continued on the next launch")
+        except Exception as e:
+            print(f"Unpacking '{self.pkg.path.name}' in the background failed: {e}", file=stderr)
+        finally:
+            with suppress(OSError):
+                (self.control / "done").touch()
+            self.locks.close()
+
+    def _poll_requests(self, extractor: ZipExtractor):
+        try:
+            with open(self.control / "requests", "rb") as f:
+                f.seek(self._requests_offset)
+                data = f.read()
+        except OSError:
+            return
+        # Leave incomplete lines for the next time
+        data = data[:data.rfind(b"\n") + 1]
+        self._requests_offset += len(data)
+        for name in data.decode(errors="replace").splitlines():
+            if extractor.promote(name):
+                self.requested.append(name)
+
+    def _extracted(self, info: ZipInfo, path: Path):
+        _protect(info, path)
+        name = path.relative_to(self.extractor.dest)
+        makedirs((self.work / name).parent, exist_ok=True)
+        # Files already in the working copy were overlaid by the runtime, keep those
+        with suppress(FileExistsError, FileNotFoundError):
+            _checkout_file(path, self.work / name, name)
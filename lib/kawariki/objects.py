@@ -0,0 +1,187 @@
+# :---------------------------------------------------------------------------:
+#   Content-addressed object store
+# :---------------------------------------------------------------------------:
+# Distributions share most of their files: NW.js sdk and nosdk variants of the
+# same version, consecutive versions of a component and so on. Installed files
+# are moved into a store keyed by their content and hardlinked back into the
+# distribution directory, so each distinct file occupies disk space only once.
+#
+# Objects are named <sha256>-<mode>, since hardlinks share permission bits.
+# Installed files must therefore never be chmod'ed, that would change the mode
+# of every distribution sharing the object. Fix permissions before importing.
+# The number of links of an object tells how many distribution files use it.
+# An object with a single link is no longer used by any distribution.
+
+from collections.abc import Callable, Iterator
+from dataclasses import dataclass
+from errno import EMLINK, EXDEV
+from os import link, replace, walk
+from pathlib import Path
+from stat import S_IMODE, S_ISREG
+from typing import Any
+
+__all__ = ["ObjectStore", "StoreStats"]
+
+
+def hash_file(path: Path, buffer_size: int=1 << 20) -> str:
+    from hashlib import sha256
+    digest = sha256()
+    with open(path, "rb", buffering=0) as f:
+        buffer = bytearray(buffer_size)
+        view = memoryview(buffer)
+        while read := f.readinto(buffer):
+            digest.update(view[:read])
+    return digest.hexdigest()
+
+
+@dataclass
+class StoreStats:
+    objects: int = 0        # Number of objects in the store
+    size: int = 0           # Bytes occupied by the objects
+    referenced: int = 0     # Bytes of distribution files backed by objects
+    unused: int = 0         # Number of objects not linked from any distribution
+    unused_size: int = 0
+
+    @property
+    def saved(self) -> int:
+        """ Bytes that would be used additionally without deduplication """
+        return self.referenced - (self.size - self.unused_size)
+
+
+class ObjectStore:
+    """
+    Deduplicate files by hardlinking them to content-addressed objects
+
+    :param root: Store directory. Must be on the same filesystem as the
+                 distributions for deduplication to take effect.
+    """
+    root: Path
+
+    def __init__(self, root: Path):
+        self.root = root
+        self._cross_device = False
+
+    def object_path(self, key: str) -> Path:
+        return self.root / key[:2] / key
+
+    @staticmethod
+    def object_key(digest: str, mode: int) -> str:
+        return f"{digest}-{S_IMODE(mode):03o}"
+
+    # +-------------------------------------------------+
+    # Adding files
+    # +-------------------------------------------------+
+    def import_file(self, path: Path) -> tuple[str|None, int]:
+        """
+        Replace a file with a link to the object with the same content, adding it if necessary
+
+        :return: The object key (None if the file can't be stored) and the number of bytes saved
+        """
+        st = path.lstat()
+        if not S_ISREG(st.st_mode) or st.st_size == 0 or self._cross_device:
+            return None, 0
+        key = self.object_key(hash_file(path), st.st_mode)
+        obj = self.object_path(key)
+        obj.parent.mkdir(parents=True, exist_ok=True)
+        for _ in range(2):
+            try:
+                # Existing object: Replace the new file with a link to it
+                temp = path.with_name(f".{path.name}.link")
+                link(obj, temp)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                if e.errno == EXDEV:
+                    self._warn_cross_device()
+                    return None, 0
+                if e.errno == EMLINK:
+                    # Too many links to this object, keep the copy
+                    return key, 0
+                raise
+            else:
+                replace(temp, path)
+                return key, st.st_size
+            try:
+                # New object
+                link(path, obj)
+            except FileExistsError:
+                # Added concurrently by another process, link to that one instead
+                continue
+            except OSError as e:
+                if e.errno == EXDEV:
+                    self._warn_cross_device()
+                    return None, 0
+                raise
+            return key, 0
+        return None, 0
+
+    def _warn_cross_device(self):
+        if not self._cross_device:
+            print(f"Warning: Object store at '{self.root}' is on a different filesystem, not deduplicating files")
+            self._cross_device = True
+
+    def import_tree(self, root: Path) -> tuple[dict[str, str], int]:
+        """
+        Deduplicate all files in a directory tree
+
+        :return: Object keys by relative file path and the number of bytes saved
+        """
+        objects: dict[str, str] = {}
+        saved = 0
+        for parent, _, filenames in walk(root):
+            for name in filenames:
+                path = Path(parent, name)
+                key, saved_ = self.import_file(path)
+                if key is not None:
+                    objects[str(path.relative_to(root))] = key
+                saved += saved_
+        return objects, saved
+
+    # +-------------------------------------------------+
+    # Inspection
+    # +-------------------------------------------------+
+    def __iter__(self) -> Iterator[tuple[str, Path]]:
+        """ Iterate (key, path) of all objects """
+        if not self.root.is_dir():
+            return
+        for shard in sorted(self.root.iterdir()):
+            if shard.is_dir():
+                for obj in sorted(shard.iterdir()):
+                    if not obj.name.startswith("."):
+                        yield obj.name, obj
+
+    def stats(self) -> StoreStats:
+        stats = StoreStats()
+        for _, obj in self:
+            st = obj.stat()
+            stats.objects += 1
+            stats.size += st.st_size
+            stats.referenced += st.st_size * (st.st_nlink - 1)
+            if st.st_nlink <= 1:
+                stats.unused += 1
+                stats.unused_size += st.st_size
+        return stats
+
+    def verify(self, progress: Callable[[int, int, str], Any]|None=None) -> list[str]:
+        """
+        Check the content and permission bits of all objects against their keys
+
+        :param progress: Called with (index, total, key) before checking each object
+        :return: Keys of corrupted objects
+        """
+        objects = list(self)
+        corrupted = []
+        for i, (key, obj) in enumerate(objects):
+            if progress is not None:
+                progress(i, len(objects), key)
+            if self.object_key(hash_file(obj), obj.stat().st_mode) != key:
+                corrupted.append(key)
+        return corrupted
+
+    def remove(self, key: str):
+        """
+        Remove an object from the store
+
+        Distribution files linked to it are unaffected, but won't be deduplicated with new files anymore.
+        """
+        self.object_path(key).unlink(missing_ok=True)
@@ -0,0 +1,219 @@
+# :---------------------------------------------------------------------------:
+#   Precompiled launch plans
+# :---------------------------------------------------------------------------:
+# A launch plan is the fully resolved result of running a game through a
+# runtime: The final argv (including overlayns mounts), environment changes,
+# working directory and any files generated for the process.
+# Executing a plan skips detection, distribution selection and file generation.
+
+from __future__ import annotations
+
+from collections.abc import Mapping, Sequence
+from json import dump as json_dump
+from json import load as json_load
+from os import chdir, environ, execve, unlink
+from pathlib import Path
+from shlex import join as shlex_join
+from shlex import quote
+from shutil import rmtree
+from sys import stderr, stdout
+from typing import TYPE_CHECKING, Any, NoReturn
+
+from . import trace
+from .detect_cache import FsProbe, RecordingProbe, game_key
+
+if TYPE_CHECKING:
+    from .game import Game
+
+__all__ = ["LaunchPlan", "PlanError", "default_plan_dir"]
+
+
+class PlanError(RuntimeError):
+    """ The launch cannot be expressed as a plan """
+
+
+def default_plan_dir(cache_path: Path, root: Path, binary_name_hint: str|None) -> Path:
+    return cache_path / "plans" / game_key(root, binary_name_hint)
+
+
+class LaunchPlan:
+    """
+    A serialized process launch
+
+    Stored as two files inside the plan directory:
+        launch.json - Read by 'kawariki run --from-plan'
+        launch.sh   - Standalone shell version. Run with --check to test for staleness
+    """
+    FORMAT = 1
+
+    path: Path
+    data: dict[str, Any]
+
+    # Set by prepare() when creating a new plan
+    version: str
+    game: Game
+    base_environ: Mapping[str, str]
+
+    def __init__(self, path: Path, data: dict[str, Any]|None=None):
+        self.path = path
+        self.data = data if data is not None else {}
+
+    @property
+    def json_file(self) -> Path:
+        return self.path / "launch.json"
+
+    @property
+    def script_file(self) -> Path:
+        return self.path / "launch.sh"
+
+    @property
+    def files_dir(self) -> Path:
+        """ Directory holding generated files that don't need to be in a specific place """
+        return self.path / "files"
+
+    # Loading
+    @classmethod
+    def load(cls, path: Path) -> LaunchPlan|None:
+        try:
+            with (path / "launch.json").open("r", encoding="utf-8") as f:
+                data = json_load(f)
+        except (OSError, ValueError):
+            return None
+        if not isinstance(data, dict) or data.get("format") != cls.FORMAT:
+            return None
+        return cls(path, data)
+
+    @trace.traced("check plan")
+    def check(self, version: str) -> str|None:
+        """ Return the reason the plan is stale or None if it can be used """
+        if self.data.get("version") != version:
+            return f"Created by Kawariki {self.data.get('version')}"
+        probe = RecordingProbe()
+        probe.stamps = {path: tuple(st) if st is not None else None for path, st in self.data["inputs"].items()}
+        probe.listings = {path: tuple(st) if st is not None else None for path, st in self.data["listings"].items()}
+        if not probe.is_valid():
+            return "Game files changed"
+        for path in self.data["required"]:
+            if not Path(path).exists():
+                return f"Missing: {path}"
+        return None
+
+    # Creating
+    def discard(self):
+        """ Remove a previous plan and the files generated for it """
+        for path in self.data.get("generated", ()):
+            try:
+                unlink(path)
+            except FileNotFoundError:
+                pass
+        rmtree(self.files_dir, ignore_errors=True)
+        for f in self.json_file, self.script_file:
+            if f.exists():
+                f.unlink()
+        self.data = {}
+
+    def prepare(self, version: str, game: Game, base_environ: Mapping[str, str]):
+        """
+        Start a new plan, replacing any previous one
+
+        :param version: The Kawariki version
+        :param game: The game. Everything its detection probe looked at becomes an input of the plan
+        :param base_environ: The environment the plan will be executed in, changes to it are recorded
+        """
+        self.discard()
+        self.files_dir.mkdir(parents=True)
+        self.version = version
+        self.game = game
+        self.base_environ = base_environ
+
+    def record(self, argv: Sequence[str], env: Mapping[str, str], workingdir: str|None,
+               overlayns: Sequence[str], generated: Sequence[str]):
+        """ Fill in the plan from a resolved process launch """
+        probe: FsProbe = self.game.probe
+        if isinstance(probe, RecordingProbe):
+            # Generating files may have touched directories, stamp the current state
+            probe = probe.refresh()
+        else:
+            probe = RecordingProbe()
+        base_environ = self.base_environ
+        self.data = {
+            "format": self.FORMAT,
+            "version": self.version,
+            "game": str(self.game.root),
+            "binary_name_hint": self.game.binary_name_hint,
+            "argv": list(argv),
+            "environ": {k: v for k, v in env.items() if base_environ.get(k) != v},
+            "unset": [k for k in base_environ if k not in env],
+            "workingdir": workingdir,
+            "overlayns": list(overlayns),
+            "generated": list(generated),
+            "required": [*(arg for arg in argv if arg.startswith("/") and Path(arg).exists()), *generated],
+            "inputs": probe.stamps,
+            "listings": probe.listings,
+        }
+
+    def save(self):
+        self.path.mkdir(parents=True, exist_ok=True)
+        with self.json_file.open("w", encoding="utf-8") as f:
+            json_dump(self.data, f, indent=1)
+        with self.script_file.open("w", encoding="utf-8") as f:
+            f.write(self.format_script())
+        self.script_file.chmod(0o755)
+
+    def format_script(self) -> str:
+        """ Standalone shell script version of the plan """
+        data = self.data
+        files = [path for path, st in data["inputs"].items() if st is not None and not Path(path).is_dir()]
+        dirs = [path for path, st in data["inputs"].items() if st is not None and Path(path).is_dir()]
+        missing = [path for path, st in data["inputs"].items() if st is None]
+        # Shell only has mtime comparison, everything must be older than the plan itself
+        newer = [*files, *(path for path, st in data["listings"].items() if st is not None)]
+        lines = [
+            "#!/bin/sh",
+            f"# Kawariki launch plan for {data['game']}",
+            "# Generated file, re-create using 'kawariki plan'",
+            'if [ "$1" = "--check" ]; then',
+        ]
+        if newer:
+            lines += [f"    for f in {shlex_join(newer)}; do",
+                      '        [ -e "$f" ] && [ ! "$f" -nt "$0" ] || exit 1',
+                      "    done"]
+        if dirs:
+            lines += [f"    for f in {shlex_join(dirs)}; do",
+                      '        [ -d "$f" ] || exit 1',
+                      "    done"]
+        if missing:
+            lines += [f"    for f in {shlex_join(missing)}; do",
+                      '        [ -e "$f" ] && exit 1',
+                      "    done"]
+        lines += [f"    for f in {shlex_join(data['required'])}; do",
+                  '        [ -e "$f" ] || exit 1',
+                  "    done",
+                  "    exit 0",
+                  "fi"]
+        if data["workingdir"] is not None:
+            lines.append(f"cd {quote(data['workingdir'])} || exit 1")
+        if data["unset"]:
+            lines.append(f"unset {shlex_join(data['unset'])}")
+        lines += (f"export {quote(k)}={quote(v)}" for k, v in data["environ"].items())
+        lines.append(f'exec {shlex_join(data["argv"])} "$@"')
+        return "\n".join(lines) + "\n"
+
+    # Executing
+    def exec(self, arguments: Sequence[str]=()) -> NoReturn:
+        data = self.data
+        argv = [*data["argv"], *arguments]
+        env = environ.copy()
+        for k in data["unset"]:
+            env.pop(k, None)
+        env.update(data["environ"])
+
+        print(f"Executing plan [{shlex_join(argv)}] in '{data['workingdir']}'")
+        for f in stdout, stderr:
+            f.flush()
+
+        if data["workingdir"] is not None:
+            chdir(data["workingdir"])
+        trace.instant("exec", argv=argv, plan=str(self.path))
+        trace.flush()
+        execve(argv[0], argv, env)
@@ -3,7 +3,7 @@ from __future__ import annotations
 from collections.abc import Callable, Iterator, Sequence
 from contextlib import contextmanager
 from functools import cached_property
-from os import chdir, environ, execve
+from os import chdir, environ, execve, unlink
 from pathlib import Path, PurePath
 from shlex import join as shlex_join
 from shutil import copy, copyfileobj
@@ -13,6 +13,7 @@ from tempfile import NamedTemporaryFile, TemporaryDirectory, mkdtemp
 from typing import Any, BinaryIO, IO, Literal, NoReturn, TextIO, overload
 from warnings import warn
 
+from . import trace
 from .app import App
 from .utils.exceptiongroup import ExceptionGroup, format_exception
 
@@ -31,6 +32,8 @@ class ProcessEnvironment:
     workingdir: PathLike|None
     have_overlayns: bool
 
+    generated: list[str]
+
     _overlayns: list[str]
     _cleanups: list[Callable[[], Any]]
 
@@ -39,10 +42,16 @@ class ProcessEnvironment:
         self.argv_prepend = []
         self.environ = environ.copy()
         self.workingdir = None
+        self.generated = []
         self._overlayns = []
         self._cleanups = []
         self.have_overlayns = app.overlayns_binary is not None and not no_overlayns
 
+    @property
+    def planning(self) -> bool:
+        """ Whether the process is being recorded as a launch plan instead of executed """
+        return self.app.plan is not None
+
     def prepend_argv(self, *argv_parts: str):
         self.argv_prepend.extend(argv_parts)
 
@@ -55,6 +64,7 @@ class ProcessEnvironment:
         assert self.have_overlayns
         self._overlayns.append("-m")
         self._overlayns.append(f"bind,{src},{mp}")
+        trace.count("bind mounts")
 
     def makedirs_with_cleanup(self, path: Path):
         create_parents = []
@@ -65,6 +75,24 @@ class ProcessEnvironment:
             path.mkdir()
             self.at_cleanup(path.rmdir)
 
+    def generated_file(self, path: PathLike):
+        """ Register a file that was created for the process. It's removed on cleanup """
+        self.generated.append(str(path))
+        self.at_cleanup(lambda: unlink(path))
+
+    def _backup_original(self, path: Path) -> Path:
+        """ Move file out of the way and restore it on cleanup """
+        if self.planning:
+            from .plan import PlanError
+            raise PlanError(f"Replacing '{path}' in a launch plan requires overlayns")
+        backup = path.parent / f"{path.stem}.kawariki-backup{path.suffix}"
+        if backup.exists():
+            raise FileExistsError(backup)
+        print(f"Overwriting {path.name} (Preserved as {backup.name}, will restore after session)")
+        path.rename(backup)
+        self.at_cleanup(lambda: backup.rename(path))
+        return backup
+
     @contextmanager
     def replace_file(self, path: Path, mode: Literal["w", "a"]="w") -> Iterator[IO[str]]:
         """ Replace the content of a file for the process while keeping the original version.
@@ -80,17 +108,12 @@ class ProcessEnvironment:
                     yield tf
                     self.overlayns_bind(tf.name, path)
                 return
-            backup = path.parent / f"{path.stem}.kawariki-backup{path.suffix}"
-            if backup.exists():
-                raise FileExistsError(backup)
-            print(f"Overwriting {path.name} (Preserved as {backup.name}, will restore after session)")
-            path.rename(backup)
-            self.at_cleanup(lambda: backup.rename(path))
+            backup = self._backup_original(path)
             if mode == "a":
                 copy(backup, path)
         else:
             self.makedirs_with_cleanup(path.parent)
-            self.at_cleanup(path.unlink)
+            self.generated_file(path)
         with path.open(mode) as f:
             yield f
 
@@ -100,15 +123,10 @@ class ProcessEnvironment:
             if self.have_overlayns:
                 self.overlayns_bind(source, path)
                 return
-            backup = path.parent / f"{path.stem}.kawariki-backup{path.suffix}"
-            if backup.exists():
-                raise FileExistsError(backup)
-            print(f"Overwriting {path.name} (Preserved as {backup.name}, will restore after session)")
-            path.rename(backup)
-            self.at_cleanup(lambda: backup.rename(path))
+            self._backup_original(path)
         else:
             self.makedirs_with_cleanup(path.parent)
-            self.at_cleanup(path.unlink)
+            self.generated_file(path)
         path.symlink_to(source)
 
     def add_overlays_from_file(self, path: Path):
@@ -119,18 +137,22 @@ class ProcessEnvironment:
                 if line:
                     self._overlayns.append("-m")
                     self._overlayns.append(line)
+                    trace.count("bind mounts")
 
     # Temporary files
     @cached_property
-    def _tempdir(self) -> TemporaryDirectory:
+    def _tempdir(self) -> str:
+        if self.app.plan is not None:
+            # Needs to stick around for the plan
+            return str(self.app.plan.files_dir)
         tempdir = TemporaryDirectory(prefix="kawariki-")
         print("Created temporary directory: ", tempdir.name)
         self._cleanups.append(tempdir.cleanup)
-        return tempdir
+        return tempdir.name
 
     def temp_dir(self, suffix: str|None=None, prefix: str|None=None) -> str:
         """ Create a temporary directory that will be removed on cleanup() """
-        return mkdtemp(suffix, prefix, self._tempdir.name)
+        return mkdtemp(suffix, prefix, self._tempdir)
 
     @overload
     def temp_file(self, mode: Literal['w', 'w+']="w",
@@ -150,7 +172,7 @@ class ProcessEnvironment:
         """ Create a temporary file that will be removed on cleanup() """
         return NamedTemporaryFile(mode,  # noqa: SIM115 # Caller should use context manager
                                   buffering, encoding, newline,
-                                  suffix, prefix, self._tempdir.name,
+                                  suffix, prefix, self._tempdir,
                                   delete, **kwds)
 
     # Cleanup
@@ -225,6 +247,19 @@ class ProcessLaunchInfo(ProcessEnvironment):
     def exec(self) -> NoReturn:
         argv, env = self._prepare()
 
+        if (plan := self.app.plan) is not None:
+            plan.record(argv, env, str(self.workingdir) if self.workingdir is not None else None,
+                        self._overlayns, self.generated)
+            plan.save()
+            print(f"Saved launch plan to '{plan.path}'")
+            # Everything else is part of the plan now
+            self._cleanups.clear()
+            exit(0)
+
+        if self.app.gc_budget is not None:
+            # Stay around after the game exits
+            self.at_cleanup(self.app.collect_garbage)
+
         print(f"Executing [{shlex_join(argv)}] in '{self.workingdir}'")
 
         # Free resources & flush IO
@@ -236,11 +271,16 @@ class ProcessLaunchInfo(ProcessEnvironment):
         if not self._cleanups:
             if self.workingdir is not None:
                 chdir(self.workingdir)
+            trace.instant("exec", argv=argv)
+            trace.flush()
             execve(argv[0], argv, env)
         else:
             try:
-                exit(call(argv, cwd=self.workingdir, env=env))
+                with trace.span("exec", argv=argv):
+                    status = call(argv, cwd=self.workingdir, env=env)
+                exit(status)
             finally:
-                self.cleanup()
+                with trace.span("cleanup"):
+                    self.cleanup()
 
     # TODO: add a call() variant that isn't NoReturn()
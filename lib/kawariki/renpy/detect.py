@@ -3,8 +3,9 @@ from functools import cached_property
 from itertools import zip_longest
 from pathlib import Path
 from re import compile as re_compile
-from typing import ClassVar
+from typing import Any, ClassVar
 
+from ..detect_cache import FsProbe
 from ..utils.typing import Self
 
 
@@ -47,9 +48,10 @@ class RenpyVersion:
         return None, None
 
     @classmethod
-    def _guess_version_from_initpy(cls, initpy: Path) -> tuple[tuple[int, ...], str]:
+    def _guess_version_from_initpy(cls, initpy: Path, probe: FsProbe) -> tuple[tuple[int, ...], str]:
         # 8.0 and 7.5 share the same python code and contain both version numbers
         # Try to figure it out from the included python library folder
+        probe.read(initpy)
         with initpy.open() as f:
             buf = f.read()
         tups: list[Sequence[int]] = []
@@ -59,7 +61,7 @@ class RenpyVersion:
         for m in cls.RE_NAM.finditer(buf):
             nams.append(m.group(1))
         if tups:
-            is_py3 = (initpy.parent.parent / "lib" / "python3.9").exists()
+            is_py3 = probe.exists(initpy.parent.parent / "lib" / "python3.9")
             for t, n in zip_longest(tups, nams, fillvalue=""):
                 if not t:
                     break
@@ -68,8 +70,11 @@ class RenpyVersion:
                     return t, n
         return (), ""
 
-    def __init__(self, vc_version: Path):
+    def __init__(self, vc_version: Path, probe: FsProbe|None=None):
+        if probe is None:
+            probe = FsProbe()
         if vc_version.suffix == ".py":
+            probe.read(vc_version)
             with vc_version.open() as f:
                 for line in f:
                     k, v = self._parse_pykv_line(line)
@@ -81,7 +86,8 @@ class RenpyVersion:
                     self.vc_version = self.version_info[-1]
             elif self.version == "0" :
                 # Previously version was embedded in __init__.py
-                tup, self.version_name = self._guess_version_from_initpy(vc_version.with_name("__init__.py"))
+                tup, self.version_name = self._guess_version_from_initpy(vc_version.with_name("__init__.py"),
+                                                                               probe)
                 if tup:
                     self.version_info = (*tup, self.vc_version)
                     self.version = ".".join(map(str, self.version_info))
@@ -101,20 +107,35 @@ class RenpyVersion:
         return self.version_info[0] >= 8
 
     @staticmethod
-    def find_version_file(path: Path) -> Path|None:
+    def find_version_file(path: Path, probe: FsProbe|None=None) -> Path|None:
+        if probe is None:
+            probe = FsProbe()
         vc_version = path / "renpy" / "vc_version"
         for ext in (".py", ".pyo", ".pyc"):
             candidate = vc_version.with_suffix(ext)
-            if candidate.exists():
+            if probe.exists(candidate):
                 return candidate
         return None
 
     @classmethod
-    def find(cls, path: Path) -> Self|None:
-        if vc_version := cls.find_version_file(path):
-            return cls(vc_version)
+    def find(cls, path: Path, probe: FsProbe|None=None) -> Self|None:
+        if vc_version := cls.find_version_file(path, probe):
+            return cls(vc_version, probe)
         return None
 
+    # Detection cache
+    def as_dict(self) -> dict[str, Any]:
+        return {"valid": self.valid, "version_info": list(self.version_info),
+                **{k: getattr(self, k) for k in self.KEYS}}
+
+    @classmethod
+    def from_dict(cls, data: dict[str, Any]) -> Self:
+        self = cls.__new__(cls)
+        for k, v in data.items():
+            setattr(self, k, v)
+        self.version_info = tuple(data["version_info"])
+        return self
+
     def __repr__(self) -> str:
         if self.valid:
             return f"<{self.__class__.__name__} {self.version} '{self.version_name}'>"
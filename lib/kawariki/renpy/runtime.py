@@ -1,8 +1,9 @@
 from collections.abc import Sequence
 from functools import cached_property
 
+from .. import trace
 from ..app import App, IRuntime
-from ..distribution import Distribution
+from ..distribution import Distribution, DistributionIndex
 from ..game import Game
 from ..misc import ErrorCode
 from ..process import ProcessLaunchInfo
@@ -17,6 +18,7 @@ class Runtime(IRuntime):
         self.resources = app.app_root / "renpy"
 
     # Runtime Versions
+    @trace.traced("download renpy")
     def try_download_version(self, version: Distribution):
         """
         Download distribution
@@ -26,24 +28,32 @@ class Runtime(IRuntime):
         """
         from ..download import download_dist_progress_tar
 
-        download_dist_progress_tar(self.app, version)
+        with self.app.dist_lock(version):
+            if version.available:
+                # Downloaded by another process while waiting
+                return
+            self.app.run_in_background(download_dist_progress_tar, self.app, version)
 
         self.app.show_info(f"Finished downloading Ren'Py distribution '{version.name}'")
 
     @cached_property
-    def versions(self) -> Sequence[Distribution]:
-        return Distribution.load_json(
+    def versions(self) -> DistributionIndex[Distribution]:
+        return Distribution.load_index(
             self.resources / "versions.json",
             self.app.dist_path / "renpy",
-            self.app.platform)
+            self.app.platform,
+            cache=self.app.versions_cache_path)
 
+    def distributions(self) -> dict[str, DistributionIndex]:
+        return {"renpy": self.versions}
+
+    @trace.traced("select renpy")
     def select_version(self, gamever: RenpyVersion) -> Distribution|None:
         # Try to match MAJOR.MINOR version if possible, then try latest available for MAJOR
         for granul in (2, 1):
-            ggv = gamever.version_info[:granul]
-            if v := sorted((dist for dist in self.versions if dist.version[:granul] == ggv),
-                           key=lambda dist: dist.version):
-                return v[-1]
+            if len(gamever.version_info) >= granul \
+                    and (dist := self.versions.select(prefix=gamever.version_info[:granul])) is not None:
+                return dist
         # XXX: Allow manual selection, upgrading to latest compatible?
         return None
 
@@ -72,6 +82,7 @@ class Runtime(IRuntime):
                 self.try_download_version(dist)
             except ErrorCode as e:
                 return e.code
+        self.app.use_dist(dist)
 
         if renpy_launcher:
             proc = ProcessLaunchInfo(self.app, [dist.binary])
@@ -0,0 +1,100 @@
+# :---------------------------------------------------------------------------:
+#   Startup profiling
+# :---------------------------------------------------------------------------:
+# Runs Kawariki again under 'python -X importtime' and summarizes where
+# time is spent before it gets to do any actual work.
+
+from collections.abc import Iterable, Sequence
+from subprocess import PIPE, Popen
+from sys import executable, stderr
+from time import perf_counter
+from typing import NamedTuple
+
+__all__ = ["HEAVY_MODULES", "ImportTime", "parse_importtime", "profile_startup", "strip_profile_args"]
+
+
+# Modules that should only be loaded by code paths that actually need them
+HEAVY_MODULES = ("zipfile", "tarfile", "urllib.request", "html.parser", "configparser",
+                 "tkinter", "subprocess", "tempfile")
+
+
+class ImportTime(NamedTuple):
+    name: str
+    depth: int          # Nesting level, 0 for imports not triggered by another import
+    self_us: int        # Time spent in the module itself
+    cumulative_us: int  # Including nested imports
+
+
+def parse_importtime(lines: Iterable[str]) -> tuple[list[ImportTime], list[str]]:
+    """ Split stderr output into -X importtime entries and other lines """
+    imports: list[ImportTime] = []
+    other: list[str] = []
+    for line in lines:
+        if not line.startswith("import time:"):
+            other.append(line)
+            continue
+        try:
+            self_us, cumulative_us, name = line[12:].split("|", 2)
+            name = name.rstrip("\n")
+            stripped = name.lstrip(" ")
+            imports.append(ImportTime(stripped, (len(name) - len(stripped) - 1) // 2,
+                                      int(self_us), int(cumulative_us)))
+        except ValueError:
+            pass # Header line
+    return imports, other
+
+
+def strip_profile_args(argv: Sequence[str]) -> list[str]:
+    """ Remove startup profiling options from a command line """
+    result: list[str] = []
+    it = iter(argv)
+    for arg in it:
+        if arg == "--startup-profile" or arg.startswith("--startup-budget="):
+            continue
+        elif arg == "--startup-budget":
+            next(it, None)
+            continue
+        elif arg == "--":
+            result.append(arg)
+            result.extend(it)
+            break
+        result.append(arg)
+    return result
+
+
+def profile_startup(argv: Sequence[str], budget_ms: float|None=None, top: int=15) -> int:
+    """
+    Run a Kawariki command line with import timing and print a summary
+
+    :param argv: The full Kawariki command line, including the script path and profiling options
+    :param budget_ms: Fail if total import time exceeds this budget
+    :param top: Number of slowest imports to show
+    :return: The exit code of the profiled command, or 1 if it went over budget
+    """
+    args = strip_profile_args(argv[1:])
+    start = perf_counter()
+    with Popen([executable, "-X", "importtime", argv[0], *args], stderr=PIPE, text=True) as proc:
+        assert proc.stderr is not None
+        imports, other = parse_importtime(proc.stderr)
+    elapsed_ms = (perf_counter() - start) * 1000
+
+    stderr.writelines(other)
+
+    total_ms = sum(i.cumulative_us for i in imports if i.depth == 0) / 1000
+    kawariki_ms = sum(i.self_us for i in imports if i.name.split(".", 1)[0] == "kawariki") / 1000
+    print(f"Startup profile for: {' '.join(args)}", file=stderr)
+    print(f"  Process:           {elapsed_ms:8.1f} ms (exit code {proc.returncode})", file=stderr)
+    print(f"  Imports total:     {total_ms:8.1f} ms ({len(imports)} modules)", file=stderr)
+    print(f"  Kawariki modules:  {kawariki_ms:8.1f} ms (self)", file=stderr)
+    print("  Slowest imports (cumulative):", file=stderr)
+    for i in sorted(imports, key=lambda i: i.cumulative_us, reverse=True)[:top]:
+        print(f"    {i.cumulative_us / 1000:8.1f} ms  {i.name}", file=stderr)
+    if heavy := [i for i in imports if i.name in HEAVY_MODULES]:
+        print("  Heavy modules loaded:", file=stderr)
+        for i in heavy:
+            print(f"    {i.cumulative_us / 1000:8.1f} ms  {i.name}", file=stderr)
+
+    if budget_ms is not None and total_ms > budget_ms:
+        print(f"Startup import time {total_ms:.1f} ms exceeds budget of {budget_ms:.1f} ms", file=stderr)
+        return 1
+    return proc.returncode
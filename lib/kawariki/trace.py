@@ -0,0 +1,127 @@
+# :---------------------------------------------------------------------------:
+#   Launch tracing
+# :---------------------------------------------------------------------------:
+# Set KAWARIKI_TRACE=<file> to record the time spent in each launch phase.
+# The file is written in Chrome trace-event JSON format and can be loaded into
+# chrome://tracing, https://ui.perfetto.dev or speedscope.
+# When disabled, span() returns a shared no-op context manager and counters
+# return immediately, so instrumentation can stay in place.
+
+from collections.abc import Callable
+from contextlib import nullcontext
+from functools import wraps
+from os import environ, getpid
+from threading import Lock, get_native_id
+from time import perf_counter_ns
+from typing import Any, ContextManager, TypeVar
+
+__all__ = ["count", "enabled", "flush", "instant", "span", "traced"]
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+
+_path: str|None = environ.get("KAWARIKI_TRACE") or None
+_events: list[dict[str, Any]] = []
+_counters: dict[str, int] = {}
+_open: set['_Span'] = set()
+_lock = Lock()
+_pid = getpid()
+_NULL_SPAN = nullcontext()
+
+
+def enabled() -> bool:
+    return _path is not None
+
+
+def _now() -> int:
+    # Trace-event timestamps are in microseconds
+    return perf_counter_ns() // 1000
+
+
+class _Span:
+    __slots__ = ("name", "args", "tid", "start")
+
+    def __init__(self, name: str, args: dict[str, Any]):
+        self.name = name
+        self.args = args
+
+    def event(self, end: int) -> dict[str, Any]:
+        return {"name": self.name, "ph": "X", "ts": self.start, "dur": end - self.start,
+                "pid": _pid, "tid": self.tid, "args": self.args}
+
+    def __enter__(self):
+        self.tid = get_native_id()
+        self.start = _now()
+        with _lock:
+            _open.add(self)
+        return self
+
+    def __exit__(self, *exc):
+        end = _now()
+        with _lock:
+            _open.discard(self)
+            _events.append(self.event(end))
+
+
+def span(name: str, **args: Any) -> ContextManager[Any]:
+    """ Record the wall-clock duration of a with-block """
+    if _path is None:
+        return _NULL_SPAN
+    return _Span(name, args)
+
+
+def traced(name: str) -> Callable[[F], F]:
+    """ Decorator version of span(). Leaves the function untouched if tracing is disabled """
+    def decorator(func: F) -> F:
+        if _path is None:
+            return func
+        @wraps(func)
+        def wrapper(*args, **kwds):
+            with _Span(name, {}):
+                return func(*args, **kwds)
+        return wrapper  # type: ignore[return-value]
+    return decorator
+
+
+def count(name: str, n: int=1):
+    """ Add n to a counter. Counters are shown as a running total """
+    if _path is None:
+        return
+    with _lock:
+        value = _counters[name] = _counters.get(name, 0) + n
+        _events.append({"name": name, "ph": "C", "ts": _now(), "pid": _pid, "args": {name: value}})
+
+
+def instant(name: str, **args: Any):
+    """ Record a point in time """
+    if _path is None:
+        return
+    with _lock:
+        _events.append({"name": name, "ph": "i", "s": "p", "ts": _now(), "pid": _pid,
+                        "tid": get_native_id(), "args": args})
+
+
+def flush():
+    """
+    Write the trace file
+
+    Spans that are still open (e.g. main() when the game is exec'd) are
+    closed at the current time and marked as unfinished.
+    Must be called before replacing the process, as atexit handlers don't run then.
+    """
+    if _path is None:
+        return
+    from json import dump as json_dump
+    end = _now()
+    with _lock:
+        events = [*_events, *({**s.event(end), "args": {**s.args, "unfinished": True}} for s in _open)]
+    try:
+        with open(_path, "w", encoding="utf-8") as f:
+            json_dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+    except OSError as e:
+        print(f"Warning: Could not write trace to {_path}: {e}")
+
+
+if _path is not None:
+    from atexit import register
+    register(flush)
@@ -2,9 +2,7 @@
 #   UI
 # :---------------------------------------------------------------------------:
 
-from importlib.util import find_spec
 from os import environ
-from shutil import which
 
 from .common import AKawarikiUi
 
@@ -14,12 +12,14 @@ _HAVE_TK = None
 def have_tkinter() -> bool:
     global _HAVE_TK
     if _HAVE_TK is None:
+        from importlib.util import find_spec
         _HAVE_TK = find_spec("tkinter") is not None
     return _HAVE_TK
 
 
 # Dynamic creation
 def _try_create_gui(what):
+    from shutil import which
     if what == "tkinter":
         if have_tkinter():
             from .tkinter import TkGui
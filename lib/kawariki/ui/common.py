@@ -4,6 +4,8 @@
 
 import enum
 import abc
+from time import monotonic
+from typing import Any
 
 
 class MsgType(enum.Enum):
@@ -17,9 +19,25 @@ def _setter_only(fn):
 
 
 class AKawarikiProgressUi:
+    """
+    Progress dialog
+
+    Callers may update it as often as they like, e.g. for every archive member.
+    Updates are coalesced and passed on to the backend's _update() at most
+    max_rate times per second. Updates held back are rendered by the next update,
+    by flush_due() once the interval has passed and when the dialog ends, so the
+    latest state is always shown. Event loops driving a dialog call flush_due()
+    regularly, so this doesn't depend on the caller updating again (see worker.py).
+    """
+    max_rate: float = 15    # Renders per second
+    cancellable = False     # Offer the user to cancel, must be set before begin()
+    cancelled = False       # The user asked to cancel
+
     def __init__(self, title: str, text: str, progress=0, maximum=100):
         self._progress = progress
         self._maximum = maximum
+        self._pending: dict[str, Any] = {}
+        self._rendered = 0.0
 
     # Abstract
     def begin(self):
@@ -32,19 +50,40 @@ class AKawarikiProgressUi:
     def end(self):
         pass
 
+    def poll(self):
+        """ Process UI events between updates, see worker.py """
+        pass
+
     # Property interface
     def update(self, *, title=None, text=None, progress=None, maximum=None):
-        self._update(title, text, progress, maximum)
+        if title is not None:
+            self._pending["title"] = title
+        if text is not None:
+            self._pending["text"] = text
         if progress is not None:
-            self._progress = progress
+            self._progress = self._pending["progress"] = progress
         if maximum is not None:
-            self._maximum = maximum
+            self._maximum = self._pending["maximum"] = maximum
+        self.flush_due()
+
+    def flush_due(self):
+        """ Render pending updates if the last render was at least 1/max_rate seconds ago """
+        if self._pending and monotonic() - self._rendered >= 1 / self.max_rate:
+            self.flush()
+
+    def flush(self):
+        """ Render pending updates now """
+        if self._pending:
+            pending, self._pending = self._pending, {}
+            self._rendered = monotonic()
+            self._update(pending.get("title"), pending.get("text"), pending.get("progress"), pending.get("maximum"))
 
     def __enter__(self):
         self.begin()
         return self
 
     def __exit__(self, et, e, tb):
+        self.flush()
         self.end()
 
     @_setter_only
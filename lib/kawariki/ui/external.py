@@ -4,7 +4,7 @@
 
 import subprocess
 
-from .common import MsgType, AKawarikiUi
+from .common import AKawarikiProgressUi, AKawarikiUi, MsgType
 
 
 class ZenityGui(AKawarikiUi):
@@ -19,51 +19,54 @@ class ZenityGui(AKawarikiUi):
         }
         subprocess.check_call([self.prog, types[type], "--title", title, "--text", message])
 
-    class ProgressDialog:
+    class ProgressDialog(AKawarikiProgressUi):
         # TODO: Fix newline in text
         def __init__(self, prog, /, title, text, progress=0, maximum=100):
+            super().__init__(title, text, progress, maximum)
             self.prog = prog
-            self.title = title
+            self._title = title
             self._text = text
-            self._progress = progress
-            self.maximum = maximum
+            self._percentage = self.percentage
             self.proc = None
 
         @property
         def percentage(self):
-            return self._progress * 100 // self.maximum
+            return self.progress * 100 // self.maximum if self.maximum else 0
 
-        def __enter__(self):
-            self.proc = subprocess.Popen([self.prog, "--progress", "--no-cancel", "--auto-close",
-                "--title", self.title, "--text", self._text, "--percentage", f"{self.percentage}"],
+        def begin(self):
+            self.proc = subprocess.Popen([self.prog, "--progress", "--auto-close",
+                *(() if self.cancellable else ("--no-cancel",)),
+                "--title", self._title, "--text", self._text, "--percentage", f"{self._percentage}"],
                 stdin=subprocess.PIPE)
-            return self
 
-        def __exit__(self, t, e, tb):
-            self.proc.stdin.close()
+        def end(self):
+            try:
+                self.proc.stdin.close()
+            except BrokenPipeError:
+                pass
             self.proc.wait()
 
-        @property
-        def progress(self):
-            return self._progress
-
-        @progress.setter
-        def progress(self, progress):
-            self._progress = progress
-            if self.proc:
-                self.proc.stdin.write(f"{self.percentage:.0f}\n".encode())
-                self.proc.stdin.flush()
-
-        @property
-        def text(self):
-            return self._text
-
-        @text.setter
-        def text(self, text):
-            self._text = text
-            if self.proc:
-                self.proc.stdin.write(f"#{text}\n".encode())
-                self.proc.stdin.flush()
+        def poll(self):
+            # Zenity exits with status 1 when cancelled
+            if self.proc and self.proc.poll():
+                self.cancelled = True
+
+        def _update(self, title=None, text=None, progress=None, maximum=None):
+            if not self.proc:
+                return
+            lines = []
+            if text is not None:
+                lines.append(f"#{text}\n")
+            if (percentage := self.percentage) != self._percentage:
+                self._percentage = percentage
+                lines.append(f"{percentage:.0f}\n")
+            if lines:
+                try:
+                    self.proc.stdin.write("".join(lines).encode())
+                    self.proc.stdin.flush()
+                except BrokenPipeError:
+                    # Dialog was closed
+                    self.poll()
 
     def show_progress(self, *args, **kwds):
         return self.ProgressDialog(self.prog, *args, **kwds)
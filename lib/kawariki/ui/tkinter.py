@@ -22,8 +22,17 @@ class TkProgressDialog(AKawarikiProgressUi):
         self.progress_var = tkinter.DoubleVar(value=progress)
         self.progress_bar = tkinter.ttk.Progressbar(self.body, variable=self.progress_var, maximum=maximum, length=600)
         self.progress_bar.grid(row=1, column=0)
+        dialog.protocol("WM_DELETE_WINDOW", self._cancel)
+
+    def _cancel(self):
+        # Closing the window would destroy it under our feet
+        if self.cancellable:
+            self.cancelled = True
+            self.label.configure(text="Cancelling...")
 
     def begin(self):
+        if self.cancellable:
+            tkinter.ttk.Button(self.body, text="Cancel", command=self._cancel).grid(row=2, column=0, pady=(5, 0))
         self.dialog.deiconify()
         self.body.focus_set()
         self.dialog.grab_set()
@@ -43,6 +52,9 @@ class TkProgressDialog(AKawarikiProgressUi):
             self.progress_bar.configure(max=maximum)
         if progress is not None:
             self.progress_var.set(progress)
+        self.poll()
+
+    def poll(self):
         self.dialog.update()
         self.dialog.update_idletasks()
 
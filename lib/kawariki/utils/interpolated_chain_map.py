@@ -1,9 +1,9 @@
-from collections.abc import Mapping
-from fnmatch import fnmatchcase
-from functools import cached_property
+from collections.abc import Callable, Mapping
+from fnmatch import translate
+from functools import cache, cached_property
 from re import compile as re_compile
 from string import Formatter
-from typing import TypeVar
+from typing import Any, TypeVar
 
 T = TypeVar("T")
 
@@ -12,6 +12,128 @@ class InterpolationError(LookupError):
     pass
 
 
+# :---------------------------------------------------------------------------:
+#   Compiled templates
+# :---------------------------------------------------------------------------:
+# Templates in versions.json files are shared by many distributions.
+# Parse each distinct format string and pattern once and reuse the result
+# for every InterpolatedChainMap instance.
+
+class CompiledFormat:
+    """ A format string parsed into literal text and replacement fields """
+    __slots__ = ("source", "parts", "simple", "text")
+
+    source: str
+    # (literal, field_name, format_spec, conversion, plain) like Formatter.parse()
+    # format_spec is pre-compiled if it contains nested replacement fields,
+    # plain is set if field_name is a plain key without attribute or index access
+    parts: tuple[tuple[str, str|None, 'str|CompiledFormat', str|None, bool], ...]
+    simple: bool  # Contains no replacement fields
+    text: str     # The rendered result if simple, with escaped braces unescaped
+
+    def __init__(self, source: str):
+        self.source = source
+        parts = []
+        for literal, field_name, spec, conversion in Formatter().parse(source):
+            if field_name is not None:
+                if field_name == "" or field_name[0].isdigit():
+                    raise ValueError(f"Positional replacement field in template: {source}")
+                parts.append((literal, field_name, compile_format(spec) if "{" in spec else spec, conversion,
+                              "." not in field_name and "[" not in field_name))
+            else:
+                parts.append((literal, None, "", None, False))
+        self.parts = tuple(parts)
+        self.simple = all(field is None for _, field, _, _, _ in self.parts)
+        self.text = "".join(literal for literal, _, _, _, _ in self.parts) if self.simple else ""
+
+    def render(self, formatter: Formatter, mapping: Mapping[str, Any]) -> str:
+        """ Equivalent to formatter.vformat(self.source, (), mapping) """
+        if self.simple:
+            return self.text
+        # Plain keys can be looked up directly unless the formatter customizes that
+        direct = type(formatter).get_field is Formatter.get_field and type(formatter).get_value is Formatter.get_value
+        result = []
+        for literal, field_name, spec, conversion, plain in self.parts:
+            result.append(literal)
+            if field_name is None:
+                continue
+            if plain and direct:
+                obj = mapping[field_name]
+            else:
+                obj, _ = formatter.get_field(field_name, (), mapping)
+            obj = formatter.convert_field(obj, conversion)
+            if not isinstance(spec, str):
+                spec = spec.render(formatter, mapping)
+            result.append(formatter.format_field(obj, spec))
+        return "".join(result)
+
+
+@cache
+def compile_format(source: str) -> CompiledFormat:
+    return CompiledFormat(source)
+
+
+class CompiledPattern:
+    """ One part of a pattern interpolation key, see PatternInterpolatedChainMap """
+    __slots__ = ("source", "op", "key", "negate", "value", "match")
+
+    _PATTERN_RE = re_compile(r"^(?:(?P<not>!)?(?P<truth>[^=]+?)|(?P<key>.+?)(?P<op>!?=)(?P<pattern>.+))$")
+
+    op: str|None  # None if invalid
+    key: str
+    negate: bool
+    value: str  # Lower-cased for boolean comparison
+    match: Callable[[str], Any]|None
+
+    def __init__(self, source: str):
+        self.source = source
+        self.op = None
+        self.match = None
+        if not source:
+            self.op = "always"
+        elif m := self._PATTERN_RE.match(source):
+            if truth := m.group("truth"):
+                self.op = "truth"
+                self.key = truth
+                self.negate = m.group("not") is not None
+            else:
+                self.op = "fnmatch"
+                self.key = m.group("key")
+                self.negate = m.group("op") == "!="
+                pattern = m.group("pattern")
+                self.value = pattern.lower()
+                self.match = re_compile(translate(pattern)).match
+
+    def matches(self, mapping: Mapping[str, Any], key: str) -> bool:
+        if self.op == "always":
+            return True
+        if self.op is None:
+            raise ValueError(f"Invalid interpolation pattern {self.source} in key {key}")
+        try:
+            value = mapping[self.key]
+        except KeyError:
+            return False
+        if self.op == "truth":
+            return bool(value) ^ self.negate
+        if isinstance(value, bool):
+            res = self.value == str(value).lower()
+        else:
+            value = ",".join(map(str, value)) if isinstance(value, list | tuple) else str(value)
+            res = self.match(value) is not None  # type: ignore[misc]
+        return res ^ self.negate
+
+
+@cache
+def compile_condition(source: str) -> tuple[CompiledPattern, ...]:
+    """ Compile a ';'-separated pattern key, all parts must match """
+    return tuple(CompiledPattern(part) for part in source.split(";"))
+
+
+# :---------------------------------------------------------------------------:
+#   Chain maps
+# :---------------------------------------------------------------------------:
+
+
 class InterpolatedChainMap(Mapping[str, T]):
     """ Read-only chain map with lazy (recursive) string interpolation """
     _maps: list[dict[str, T]]
@@ -43,11 +165,19 @@ class InterpolatedChainMap(Mapping[str, T]):
                 pass
         raise KeyError(key)
 
+    def _format(self, val: str) -> str:
+        if self._formatter is None:
+            return val.format_map(self)
+        try:
+            compiled = compile_format(val)
+        except ValueError:
+            return self._formatter.vformat(val, (), self)
+        return compiled.render(self._formatter, self)
+
     def _interpolate(self, key: str, val: T) -> T:
         if isinstance(val, str):
             try:
-                return self._formatter.vformat(val, (), self) \
-                    if self._formatter else val.format_map(self) # type: ignore[return-value]
+                return self._format(val) # type: ignore[return-value]
             except KeyError as e:
                 raise InterpolationError(key, f"Missing interpolated key '{e.args[0]}'")
             except ValueError as e:
@@ -89,37 +219,8 @@ class PatternInterpolatedChainMap(InterpolatedChainMap[T]):
     def _interpolate(self, key: str, val: T) -> T:
         if isinstance(val, dict):
             for pattern, newval in val.items():
-                if all(self._match_pattern(key, part) for part in pattern.split(';')):
+                if all(part.matches(self, key) for part in compile_condition(pattern)):
                     return self._interpolate(key, newval)
             raise KeyError(key, f"No matching pattern interpolation: {'|'.join(val.keys())}", self._cache)
         else:
             return super()._interpolate(key, val)
-
-    _PATTERN_RE = re_compile(r"^(?:(?P<not>!)?(?P<truth>[^=]+?)|(?P<key>.+?)(?P<op>!?=)(?P<pattern>.+))$")
-
-    def _match_pattern(self, key, pattern: str) -> bool:
-        if not pattern:
-            return True
-        m = self._PATTERN_RE.match(pattern)
-        if not m:
-            raise ValueError(f"Invalid interpolation pattern {pattern} in key {key}")
-        if ikey := m.group("truth"):
-            op = "truth"
-        else:
-            op = m.group("op")
-            ikey = m.group("key")
-        value: T|str
-        try:
-            value = self[ikey]
-        except KeyError:
-            return False
-        if op == "truth":
-            return bool(value) ^ (m.group("not") is not None)
-        elif op in ("=", "!="):
-            if isinstance(value, bool):
-                res = m.group("pattern").lower() == str(value).lower()
-            else:
-                value = ",".join(map(str, value)) if isinstance(value, list | tuple) else str(value)
-                res = fnmatchcase(value, m.group("pattern"))
-            return res ^ (op == "!=")
-        raise RuntimeError("Pattern match error")
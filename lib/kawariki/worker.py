@@ -0,0 +1,182 @@
+# :---------------------------------------------------------------------------:
+#   Background jobs
+# :---------------------------------------------------------------------------:
+# Long-running work like downloading and extracting distributions runs on a
+# worker thread, so a slow read doesn't freeze the progress dialog and drawing
+# the dialog doesn't stall the read. GUI toolkits must only be used from the
+# thread that created them, so the worker doesn't touch the UI: Progress
+# dialogs and messages it opens are posted to a queue, which the main thread
+# drains while processing UI events in between. Progress updates aren't queued,
+# the worker publishes its latest state and the main thread renders it at its
+# own rate, so the state before a blocking call is shown while it blocks.
+
+from collections.abc import Callable
+from queue import Empty, SimpleQueue
+from sys import stderr
+from threading import Event, Lock, Thread, current_thread, local, main_thread
+from typing import TYPE_CHECKING, Any, TypeVar
+
+from .misc import ErrorCode
+from .ui.common import AKawarikiProgressUi, MsgType
+
+if TYPE_CHECKING:
+    from .app import App
+
+__all__ = ["Cancelled", "current_job", "run_in_background"]
+
+T = TypeVar("T")
+
+_local = local()
+
+
+class Cancelled(ErrorCode):
+    """ The user cancelled a background job """
+    def __init__(self):
+        super().__init__(130)
+
+
+class _ProgressProxy(AKawarikiProgressUi):
+    """ Progress dialog of a worker thread, rendered by the main thread """
+    def __init__(self, job: '_Job', title, text, progress=0, maximum=100):
+        super().__init__(title, text, progress, maximum)
+        self._job = job
+        self._initial = title, text, progress, maximum
+        self._lock = Lock()
+        self._latest: dict[str, Any] = {}
+
+    def begin(self):
+        self._job.events.put(("begin", self, self._initial))
+
+    def _update(self, title=None, text=None, progress=None, maximum=None):
+        pass
+
+    def end(self):
+        self._job.events.put(("end", self, None))
+
+    def update(self, *, title=None, text=None, progress=None, maximum=None):
+        # Progress updates double as cancellation points
+        self._job.check_cancelled()
+        # Not rate limited here, the main thread picks up the latest state
+        with self._lock:
+            if title is not None:
+                self._latest["title"] = title
+            if text is not None:
+                self._latest["text"] = text
+            if progress is not None:
+                self._progress = self._latest["progress"] = progress
+            if maximum is not None:
+                self._maximum = self._latest["maximum"] = maximum
+
+    # Called on the main thread
+    def take_latest(self) -> dict[str, Any]:
+        """ Take the state published since the last call """
+        with self._lock:
+            latest, self._latest = self._latest, {}
+        return latest
+
+
+class _Job:
+    events: 'SimpleQueue[tuple[str, Any, Any]]'
+    cancel: Event
+
+    def __init__(self):
+        self.events = SimpleQueue()
+        self.cancel = Event()
+
+    def check_cancelled(self):
+        """ :raise Cancelled: if the user cancelled the job """
+        if self.cancel.is_set():
+            raise Cancelled()
+
+    # Called on the worker thread
+    def show_msg(self, type: MsgType, title: str, message: str):
+        """ Show a message on the main thread and wait until the user closed it """
+        shown = Event()
+        self.events.put(("msg", shown, (type, title, message)))
+        shown.wait()
+
+    def show_progress(self, title, text, progress=0, maximum=100) -> AKawarikiProgressUi:
+        return _ProgressProxy(self, title, text, progress, maximum)
+
+
+def current_job() -> _Job|None:
+    """ The background job running on the current thread, if any """
+    return getattr(_local, "job", None)
+
+
+def run_in_background(app: 'App', func: Callable[..., T], /, *args, **kwds) -> T:
+    """
+    Run func on a worker thread while the main thread shows its progress and messages
+
+    Progress updates made by func raise Cancelled once the user cancelled the job,
+    by closing the progress dialog or with Ctrl+C. A second Ctrl+C stops waiting for it.
+    When not called on the main thread (e.g. from within another job), func runs directly.
+    :return: The return value of func. Exceptions raised by func are re-raised.
+    """
+    if current_thread() is not main_thread():
+        return func(*args, **kwds)
+
+    job = _Job()
+
+    def work():
+        _local.job = job
+        try:
+            outcome = True, func(*args, **kwds)
+        except BaseException as e:
+            outcome = False, e
+        job.events.put(("done", None, outcome))
+
+    Thread(target=work, name="kawariki-worker", daemon=True).start()
+    dialogs: dict[_ProgressProxy, AKawarikiProgressUi] = {}
+
+    def render(proxy: _ProgressProxy):
+        if latest := proxy.take_latest():
+            dialogs[proxy].update(**latest)
+    try:
+        while True:
+            try:
+                try:
+                    kind, target, data = job.events.get(timeout=1 / AKawarikiProgressUi.max_rate)
+                except Empty:
+                    pass
+                else:
+                    if kind == "done":
+                        break
+                    elif kind == "begin":
+                        title, text, progress, maximum = data
+                        dialog = app.show_progress(text, progress, maximum, title)
+                        dialog.cancellable = True
+                        dialogs[target] = dialog.__enter__()
+                    elif kind == "end":
+                        render(target)
+                        dialogs.pop(target).__exit__(None, None, None)
+                    elif kind == "msg":
+                        try:
+                            if app.gui:
+                                app.gui.show_msg(*data)
+                        finally:
+                            target.set()
+                for proxy, dialog in dialogs.items():
+                    render(proxy)
+                    dialog.flush_due()
+                    dialog.poll()
+                    if dialog.cancelled and not job.cancel.is_set():
+                        print("Cancelling...", file=stderr)
+                        job.cancel.set()
+            except KeyboardInterrupt:
+                if job.cancel.is_set():
+                    raise
+                print("Cancelling, press Ctrl+C again to quit immediately", file=stderr)
+                job.cancel.set()
+    except BaseException:
+        # The worker is a daemon thread and won't keep the process alive
+        job.cancel.set()
+        raise
+    finally:
+        for dialog in dialogs.values():
+            dialog.__exit__(None, None, None)
+
+    success, value = data
+    if not success:
+        raise value
+    return value
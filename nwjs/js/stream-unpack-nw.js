@@ -0,0 +1,164 @@
+(()=>{
+    // Archived games may be started before Kawariki finished unpacking them (KAWARIKI_NWJS_STREAM_UNPACK).
+    // Make requests for files that aren't there yet wait until Kawariki extracted them.
+    const stateDir = process.env.KAWARIKI_NWJS_STREAM_UNPACK_DIR;
+    if (!stateDir)
+        return;
+
+    const path = require('path');
+    const {URL} = require('url');
+    const fs_module = require('fs');
+    const fsp_module = require('fs/promises');
+
+    // Keep real functions around since we patch some of fs below
+    const fs = Object.assign({}, fs_module);
+
+    const pathDone = path.join(stateDir, "done");
+    const pathRequests = path.join(stateDir, "requests");
+    const timeout = 60000;
+
+    let root, pending;
+    try {
+        const state = JSON.parse(fs.readFileSync(path.join(stateDir, "pending.json"), "utf-8"));
+        root = state.root;
+        pending = new Set(state.pending);
+    } catch (e) {
+        console.error("[Kawariki] Could not read unpacking state:", e);
+        return;
+    }
+
+    /**
+     * Map a path to the name of a pending file
+     * @param {any} path_
+     * @returns {string|null}
+     */
+    const pendingName = (path_) => {
+        if (!pending.size || typeof path_ !== "string")
+            return null;
+        const rel = path.relative(root, path.resolve(path_));
+        if (!pending.has(rel))
+            return null;
+        if (fs.existsSync(path.join(root, rel)) || fs.existsSync(pathDone)) {
+            pending.delete(rel);
+            return null;
+        }
+        return rel;
+    };
+
+    const request = (rel) => {
+        console.log("[Kawariki] Waiting for", rel, "to be unpacked");
+        fs.appendFileSync(pathRequests, rel + "\n");
+    };
+
+    const ready = (rel) => {
+        if (fs.existsSync(path.join(root, rel)) || fs.existsSync(pathDone)) {
+            pending.delete(rel);
+            return true;
+        }
+        return false;
+    };
+
+    // Atomics.wait isn't allowed on the browser main thread, spin there instead
+    const sleepSync = (() => {
+        try {
+            const cell = new Int32Array(new SharedArrayBuffer(4));
+            Atomics.wait(cell, 0, 0, 0);
+            return (ms) => Atomics.wait(cell, 0, 0, ms);
+        } catch (e) {
+            return (ms) => {
+                const end = Date.now() + ms;
+                while (Date.now() < end);
+            };
+        }
+    })();
+
+    /**
+     * Block until a path is unpacked, if it is pending
+     * @param {any} path_
+     */
+    const waitForSync = (path_) => {
+        const rel = pendingName(path_);
+        if (rel === null)
+            return;
+        request(rel);
+        const end = Date.now() + timeout;
+        while (!ready(rel) && Date.now() < end)
+            sleepSync(5);
+    };
+
+    /**
+     * Wait until a path is unpacked, if it is pending
+     * @param {any} path_
+     * @returns {Promise<void>}
+     */
+    const waitFor = (path_) => {
+        const rel = pendingName(path_);
+        if (rel === null)
+            return Promise.resolve();
+        request(rel);
+        const end = Date.now() + timeout;
+        return new Promise(resolve => {
+            const check = () => {
+                if (ready(rel) || Date.now() >= end)
+                    resolve();
+                else
+                    setTimeout(check, 10);
+            };
+            check();
+        });
+    };
+
+    // Patches ------------------------
+    const interceptWebRequests = () => {
+        chrome.webRequest.onBeforeRequest.addListener(details => {
+            const url = new URL(details.url);
+            waitForSync(path.join(root, decodeURIComponent(url.pathname.substring(1))));
+            return {};
+        },
+        {urls:[chrome.runtime.getURL("/*")]}, ["blocking"]);
+    };
+
+    const patchNodeFilesystem = () => {
+        // fs functions reading the file at their first argument
+        const fs_functions = ["access", "copyFile", "createReadStream", "exists", "lstat", "open", "readFile", "stat"];
+
+        fs_functions.forEach(name => {
+            // 1. Sync
+            /** @type {Function|undefined} */
+            const sync_fn = fs_module[name + "Sync"];
+            if (sync_fn !== undefined) {
+                fs_module[name + "Sync"] = function(...args) {
+                    waitForSync(args[0]);
+                    return sync_fn.apply(this, args);
+                };
+            }
+            // 2. Callback (createReadStream opens the file asynchronously)
+            /** @type {Function|undefined} */
+            const cb_fn = fs_module[name];
+            if (cb_fn !== undefined) {
+                fs_module[name] = name === "createReadStream" ?
+                    function(...args) {
+                        waitForSync(args[0]);
+                        return cb_fn.apply(this, args);
+                    } :
+                    function(...args) {
+                        waitFor(args[0]).then(() => cb_fn.apply(this, args));
+                    };
+            }
+            // 3. Promise
+            /** @type {Function|undefined} */
+            const promise_fn = fsp_module[name];
+            if (promise_fn !== undefined) {
+                fsp_module[name] = async function(...args) {
+                    await waitFor(args[0]);
+                    return promise_fn.apply(this, args);
+                };
+            }
+        });
+    };
+
+    if (typeof chrome !== "undefined" && chrome.webRequest)
+        interceptWebRequests();
+    patchNodeFilesystem();
+    console.log("[Kawariki] Waiting for files that are still being unpacked");
+})();